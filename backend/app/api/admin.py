@@ -0,0 +1,27 @@
+from fastapi import APIRouter, HTTPException, Request
+from app.api.deps import get_current_user
+from app.db.session import get_pool_stats
+import loguru
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["admin"]
+)
+
+logger = loguru.logger
+
+
+def check_admin(request: Request) -> dict:
+    user = get_current_user(request)
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return user
+
+
+@router.get("/db/pool")
+async def get_pool_stats_endpoint(request: Request):
+    """
+    Checked out and idle connections, overflow, wait time and checkout timeouts of the connection pools of this worker
+    """
+    check_admin(request)
+    return get_pool_stats()
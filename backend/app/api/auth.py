@@ -1,5 +1,7 @@
-from fastapi import APIRouter, HTTPException, Request
-from app.db.functions import *
+from fastapi import APIRouter, Depends, HTTPException, Request
+from app.db.async_functions import *
+from app.db.session import get_request_db
+from app.api.deps import get_current_user
 from app.db.models import User
 from app.settings import settings
 from app.utils.auth import generate_jwt_token, hash_password
@@ -18,11 +20,11 @@ router = APIRouter(
 logger = loguru.logger
 
 @router.post("/signup")
-async def signup(request: Request):
+async def signup(request: Request, db: AsyncSession = Depends(get_request_db, scope="function")):
     signup_data = await request.json()
     logger.info(f"Received signup request for email: {signup_data.get('email')}, name: {signup_data.get('name')}")
 
-    user = get_user_by_email(signup_data["email"])
+    user = await get_user_by_email(signup_data["email"], db=db)
     if user:
         logger.warning(f"Signup attempt for existing user: {signup_data.get('email')}")
         raise HTTPException(status_code=400, detail="User already exists")
@@ -33,7 +35,7 @@ async def signup(request: Request):
         "password": signup_data["password"]
     }
 
-    success = create_user(user_data)
+    success = await create_user(user_data, db=db)
     if success:
         logger.info(f"User created successfully: {signup_data.get('email')}")
     else:
@@ -46,11 +48,11 @@ async def signup(request: Request):
 
 
 @router.post("/login")
-async def signup(request: Request):
+async def signup(request: Request, db: AsyncSession = Depends(get_request_db, scope="function")):
     login_data = await request.json()
     logger.info(f"Received login request for email: {login_data.get('email')}")
 
-    user = get_user_by_email(login_data["email"])
+    user = await get_user_by_email(login_data["email"], db=db)
     if not user:
         logger.warning(f"Loging attempt for non-existing user: {login_data.get('email')}")
         raise HTTPException(status_code=400, detail="User does not exists")
@@ -175,7 +177,7 @@ async def send_email_endpoint(request: Request):
 
 
 @router.post("/verify_code")
-async def verify_code_endpoint(request: Request):
+async def verify_code_endpoint(request: Request, db: AsyncSession = Depends(get_request_db, scope="function")):
     logger.debug(f"Received verify code request for email: {request.state.email}")
     data = await request.json()
     email = request.state.email
@@ -190,11 +192,8 @@ async def verify_code_endpoint(request: Request):
         raise HTTPException(status_code=400, detail="Invalid code")
     del codes[email]
 
-    if old_email:
-        user = get_user_by_email(old_email)
-    else:
-        user = get_user_by_email(email)
+    user = get_current_user(request)
     user["is_verified"] = True
-    set_user(user)
+    await set_user(user, db=db)
 
     return {"success": True, "message": "Code verified successfully"}
@@ -0,0 +1,75 @@
+from fastapi import Depends, HTTPException, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.async_functions import get_object_owner
+from app.db.functions import ownership_cache
+from app.db.session import get_request_db
+from app.db.pagination import Page, MAX_PAGE_SIZE, decode_cursor
+
+
+def get_current_user(request: Request) -> dict:
+    """
+    Returns the user resolved by JWTAuthMiddleware. Every call is a user lookup the handler doesn't send to the database
+    """
+    user = getattr(request.state, "user", None)
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    request.state.user_lookups_saved += 1
+    return user
+
+
+async def check_access(request: Request, db: AsyncSession, kind: str, object_id: int, project_id: int = None):
+    """
+    Raises 404 if the project, prompt, prompt version or testset doesn't exist (or isn't in project_id, when given)
+    and 401 if it belongs to another user. Granted accesses are kept in ownership_cache for a short time
+    """
+    user_id = get_current_user(request)["id"]
+    key = (kind, int(object_id))
+
+    owner = ownership_cache.get(key)
+    if owner is None:
+        owner = await get_object_owner(kind, int(object_id), db=db)
+        if owner and owner[0] == user_id:
+            ownership_cache.set(key, owner)
+
+    if not owner or (project_id is not None and owner[1] != int(project_id)):
+        raise HTTPException(status_code=404, detail=f"{kind.capitalize()} not found")
+    if owner[0] != user_id:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
+async def require_project(request: Request, project_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
+    await check_access(request, db, "project", project_id)
+
+
+async def require_prompt(request: Request, project_id: int, prompt_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
+    await check_access(request, db, "prompt", prompt_id, project_id=project_id)
+
+
+async def require_version(request: Request, prompt_version_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
+    await check_access(request, db, "version", prompt_version_id)
+
+
+async def require_testset(request: Request, testset_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
+    await check_access(request, db, "testset", testset_id)
+
+
+def page_args(cursor: str = None, limit: int = None) -> dict:
+    """
+    cursor and limit of a paginated list helper from the query parameters. Raises 400 for a cursor that isn't one,
+    the limit is kept between 1 and MAX_PAGE_SIZE
+    """
+    if cursor is not None:
+        try:
+            decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return {"cursor": cursor, "limit": max(1, min(limit, MAX_PAGE_SIZE))}
+
+
+def paged(response: Response, page: Page) -> Page:
+    """
+    Sends the cursor of the next page as the X-Next-Cursor header, the body stays the list of items
+    """
+    if page.next_cursor:
+        response.headers["X-Next-Cursor"] = page.next_cursor
+    return page
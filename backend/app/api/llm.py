@@ -1,9 +1,14 @@
-from fastapi import APIRouter, HTTPException, Request
-from app.db.functions import *
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from app.db.async_functions import *
+from app.db.session import get_request_db
+from app.api.deps import get_current_user
 from app.db.models import User
 from app.settings import settings
 import loguru
+import traceback
 from app.utils.openrouter import *
+from app.utils.sse import format_sse, SSE_HEADERS
 
 router = APIRouter(
     prefix="/llm",
@@ -23,24 +28,23 @@ async def search_models_endpoint(request: Request):
 
 
 @router.post("/openrouter_key")
-async def update_openrouter_key(request: Request):
+async def update_openrouter_key(request: Request, db: AsyncSession = Depends(get_request_db, scope="function")):
     email = request.state.email
     data = await request.json()
     openrouter_key = data["openrouter_key"]
 
-    current_keys = get_user_keys(email)
+    current_keys = dict(get_current_user(request)["keys"] or {})
     
     current_keys["openrouter"] = openrouter_key
 
-    set_user_keys(email, current_keys)
+    await set_user_keys(email, current_keys, db=db)
 
     return {"message": "OpenRouter key updated", "success": True}
 
 
 @router.get("/keys")
 async def get_keys(request: Request):
-    email = request.state.email
-    keys = get_user_keys(email)
+    keys = get_current_user(request)["keys"]
     if not keys:
         return {"error": "No keys found", "success": False}
     
@@ -49,20 +53,20 @@ async def get_keys(request: Request):
 
 @router.post("/request")
 async def make_llm_request_endpoint(request: Request):
-    email = request.state.email
     data = await request.json()
 
     system_prompt = data["system_prompt"]
     user_prompt = data["user_prompt"]
     model = data["model"]
 
-    user_keys = get_user_keys(email)
+    user_keys = get_current_user(request)["keys"]
     if not user_keys:
         return {"error": "No keys found", "success": False}
     
     openrouter_key = user_keys["openrouter"]
+    params = {name: data[name] for name in SAMPLING_PARAMS if data.get(name) is not None}
 
-    result = make_llm_request(openrouter_key, system_prompt, user_prompt, model)
+    result = await make_llm_request_async(openrouter_key, system_prompt, user_prompt, model, use_cache=data.get("cache", True), **params)
 
     # with get_db_session() as db:
     #     project_id = db.query(Project).filter(Project.prompts == email).first().id
@@ -74,3 +78,45 @@ async def make_llm_request_endpoint(request: Request):
     return {"result": result, "success": True}
 
 
+@router.post("/request/stream")
+async def stream_llm_request_endpoint(request: Request):
+    """
+    Same as /request, but the completion is relayed as Server-Sent Events while it is generated:
+    "token" events with text deltas, then a "done" event with usage and cost, or an "error" event
+    """
+    data = await request.json()
+
+    system_prompt = data["system_prompt"]
+    user_prompt = data["user_prompt"]
+    model = data["model"]
+
+    user_keys = get_current_user(request)["keys"]
+    if not user_keys:
+        return {"error": "No keys found", "success": False}
+
+    openrouter_key = user_keys["openrouter"]
+    params = {name: data[name] for name in SAMPLING_PARAMS if data.get(name) is not None}
+
+    async def events():
+        completion = stream_llm_completion(openrouter_key, system_prompt, user_prompt, model, use_cache=data.get("cache", True), **params)
+        try:
+            async for event, payload in completion:
+                if await request.is_disconnected():
+                    logger.debug(f"Client disconnected, stopping stream of {model}")
+                    break
+                yield format_sse(event, payload if event == "done" else {"text": payload})
+        except Exception as e:
+            logger.error(f"Error streaming completion of {model}: {traceback.format_exc()}")
+            yield format_sse("error", {"detail": str(e)})
+        finally:
+            await completion.aclose()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.get("/cache/stats")
+async def get_cache_stats_endpoint(request: Request):
+    stats = llm_cache.get_stats()
+    stats["coalesced"] = llm_flights.coalesced
+    stats["in_flight"] = llm_flights.in_flight()
+    return {"stats": stats, "success": True}
@@ -1,13 +1,20 @@
-from fastapi import APIRouter, HTTPException, Request
-from app.db.functions import *
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from app.db.async_functions import *
+from app.db.session import get_request_db
+from app.api.deps import get_current_user, check_access, require_project, require_testset, require_version, page_args, paged
 from app.db.models import User
 from app.settings import settings
 import loguru
 from openai import OpenAI
 import requests
 from app.utils.agents import get_agent
-from app.utils.openrouter import make_llm_request
-import threading
+from app.utils.runner import testset_runner
+from app.utils.events import run_events
+from app.utils.sse import format_sse, SSE_HEADERS
+from app.utils.test_import import PARSERS, IMPORT_FORMATS, import_format
+from app.utils.export import ENCODERS, EXPORT_MEDIA_TYPES, PARQUET_AVAILABLE
 
 
 router = APIRouter(
@@ -18,137 +25,265 @@ router = APIRouter(
 logger = loguru.logger
 
 
-def run_testset(email, testset_data, prompt_id, model, version_id=-1):
-    try:
-        versions = get_prompt(prompt_id)["versions"]
-        if version_id != -1:
-            for version in versions:
-                if version["id"] == version_id:
-                    system_prompt = version["prompt _text"]
-                    break
-                else:
-                    raise HTTPException(status_code=404, detail="Version not found")
-        else:
-            version_id = versions[-1]["id"]
-            system_prompt = versions[-1]["prompt_text"]
-
-        user_api_key = get_user_keys(email)["openrouter"]
-
-        project_id = testset_data["project_id"]
-
-        logger.debug(f"Running testset {testset_data['id']} for prompt {prompt_id} with model {model}")
-
-        number_of_tests = len(testset_data["tests"])
+async def run_testset(user, testset_data, prompt_id, model, version_id=-1, concurrency=None, db=None):
+    """
+    Prepares a run of the testset and hands it over to the testset runner. Returns the created run
+    """
+    if version_id != -1:
+        version = await get_prompt_version(version_id, db=db)
+    else:
+        version = await get_latest_prompt_version(prompt_id, db=db)
+    if not version or version["prompt_id"] != prompt_id:
+        raise HTTPException(status_code=404, detail="Version not found")
+    version_id = version["id"]
+    system_prompt = version["prompt_text"]
 
-        run = create_run(model, version_id, email, prompt_id, number_of_tests=number_of_tests)
+    email = user["email"]
+    user_api_key = (user["keys"] or {}).get("openrouter")
+    if not user_api_key:
+        raise HTTPException(status_code=400, detail="OpenRouter key not set")
 
-        logger.debug(f"Created run {run['id']}")
+    project_id = testset_data["project_id"]
+    number_of_tests = testset_data["case_count"]
 
-        update_run(run["id"], status="In Progress")
-        test_number = 0
-        for test in testset_data["tests"]:
-            test_user_prompt = test["prompt"]
+    logger.debug(f"Running testset {testset_data['id']} for prompt {prompt_id} with model {model}")
 
-            logger.debug(f"Running test {test_number} of {number_of_tests} with key {user_api_key}")
+    run = await create_run(model, version_id, email, prompt_id, number_of_tests=number_of_tests, db=db)
+    if not run:
+        await log_action(project_id, f"Error running testset model {model}", "error", db=db)
+        raise HTTPException(status_code=500, detail="Could not create run")
 
-            result = make_llm_request(user_api_key, system_prompt, test_user_prompt, model)
+    logger.debug(f"Created run {run['id']}")
 
-            logger.debug(f"Result: {result}")
+    # the runner works with sessions of its own, so the run has to be visible to them before it starts
+    if db is not None:
+        await db.commit()
 
-            update_run_result(run["id"], result)
-        
-        update_run(run["id"], status="Finished")
-        log_action(project_id, f"Finished running testset model {model}", "success")
-    except:
-        log_action(project_id, f"Error running testset model {model}", "error")
-        logger.error(f"Error running testset with model {model}")
+    testset_runner.start(run["id"], email, project_id, testset_data["id"], number_of_tests, system_prompt, model, user_api_key, concurrency=concurrency)
+    return run
 
 
-@router.get("/testsets/{project_id}")
-async def get_testset_endpoint(request: Request, project_id: int):
-    email = request.state.email
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return get_project_testsets(project_id)
+@router.get("/testsets/{project_id}", dependencies=[Depends(require_project)])
+async def get_testset_endpoint(request: Request, response: Response, project_id: int, cursor: Optional[str] = None, limit: int = settings.PAGE_SIZE, db: AsyncSession = Depends(get_request_db, scope="function")):
+    """
+    Page of the testsets of the project, without their tests (GET /testsets/{testset_id}/tests). The cursor of the next page is
+    sent in the X-Next-Cursor header
+    """
+    return paged(response, await get_project_testsets(project_id, **page_args(cursor, limit), db=db))
 
 
-@router.post("/testsets/{project_id}")
-async def create_testset_endpoint(request: Request, project_id: int):
-    email = request.state.email
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+@router.post("/testsets/{project_id}", dependencies=[Depends(require_project)])
+async def create_testset_endpoint(request: Request, project_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
     testset_data = await request.json()
     testset_data["project_id"] = project_id
-    result = create_testset(testset_data)
+    result = await create_testset(testset_data, db=db)
 
     if result:
-        log_action(project_id, f"Created new testset", "new")
+        await log_action(project_id, f"Created new testset", "new", db=db)
     else:
-        log_action(project_id, f"Error creating testset", "error")
+        await log_action(project_id, f"Error creating testset", "error", db=db)
     return result
 
 
-@router.post("/testsets/{testset_id}/tests")
-async def add_test_to_testset_endpoint(request: Request, testset_id: int):
-    email = request.state.email
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+@router.post("/testsets/{testset_id}/tests", dependencies=[Depends(require_testset)])
+async def add_test_to_testset_endpoint(request: Request, testset_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
     test_prompt = await request.json()
-    return add_test_to_testset(testset_id, test_prompt["prompt"])
+    return await add_test_to_testset(testset_id, test_prompt["prompt"], meta=test_prompt.get("meta"), db=db)
 
 
-@router.delete("/testsets/{testset_id}/tests/{test_id}")
-async def delete_test_from_testset_endpoint(request: Request, testset_id: int, test_id: int):
-    email = request.state.email
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return delete_test_from_testset(testset_id, test_id)
+@router.post("/testsets/{testset_id}/tests/bulk", dependencies=[Depends(require_testset)])
+async def add_test_cases_endpoint(request: Request, testset_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
+    """
+    Appends many tests at once. The body is {"tests": [...]}, every test a prompt string or {"prompt": ..., "meta": {...}}.
+    Either all tests are added or, when one of them is invalid, none
+    """
+    data = await request.json()
+    tests = data.get("tests") if isinstance(data, dict) else None
+    if not isinstance(tests, list):
+        raise HTTPException(status_code=400, detail="tests must be a list")
+    try:
+        added = await add_test_cases(testset_id, tests, db=db)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "added": added}
+
+
+@router.post("/testsets/{testset_id}/tests/import", dependencies=[Depends(require_testset)])
+async def import_test_cases_endpoint(request: Request, testset_id: int, format: Optional[str] = None, atomic: bool = False, db: AsyncSession = Depends(get_request_db, scope="function")):
+    """
+    Appends the tests of an uploaded file, sent as the raw body. The format is ?format= (csv, jsonl or text),
+    otherwise the Content-Type. The body is parsed while it arrives and inserted in batches in one transaction.
+    Invalid rows are skipped and reported with their line, with ?atomic=true any invalid row rolls back the whole upload
+    """
+    upload_format = import_format(format, request.headers.get("content-type"))
+    if upload_format is None:
+        raise HTTPException(status_code=400, detail=f"Unknown format, use one of {', '.join(IMPORT_FORMATS)}")
+    try:
+        result = await import_test_cases(
+            testset_id, PARSERS[upload_format](request.stream()), chunk_size=settings.TESTSET_IMPORT_CHUNK_SIZE, db=db
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if atomic and result["failed"]:
+        # raising rolls back the transaction of the request, so none of the valid rows were added
+        raise HTTPException(status_code=400, detail={**result, "added": 0})
+    return {"success": True, **result}
 
 
-@router.delete("/testsets/{testset_id}")
-async def delete_testset_endpoint(request: Request, testset_id: int):
-    email = request.state.email
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return delete_testset(testset_id)
+@router.get("/testsets/{testset_id}/tests", dependencies=[Depends(require_testset)])
+async def get_test_cases_endpoint(request: Request, response: Response, testset_id: int, cursor: Optional[str] = None, limit: int = settings.PAGE_SIZE, db: AsyncSession = Depends(get_request_db, scope="function")):
+    """
+    Page of the tests of the testset in their order. The cursor of the next page is sent in the X-Next-Cursor header
+    """
+    return paged(response, await get_test_cases(testset_id, **page_args(cursor, limit), db=db))
 
 
-@router.post("/run_testset/{project_id}")
-async def run_testset_endpoint(request: Request, project_id: int):
-    email = request.state.email
+@router.delete("/testsets/{testset_id}/tests/{test_id}", dependencies=[Depends(require_testset)])
+async def delete_test_from_testset_endpoint(request: Request, testset_id: int, test_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
+    return await delete_test_from_testset(testset_id, test_id, db=db)
+
+
+@router.delete("/testsets/{testset_id}", dependencies=[Depends(require_testset)])
+async def delete_testset_endpoint(request: Request, testset_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
+    return await delete_testset(testset_id, db=db)
+
+
+def _run_concurrency(value) -> Optional[int]:
+    """
+    Concurrency requested for a run, None for the default. Raises 400 unless it is a positive integer
+    """
+    if value is None:
+        return None
+    try:
+        concurrency = int(value) if isinstance(value, (int, str)) and not isinstance(value, bool) else 0
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        raise HTTPException(status_code=400, detail="concurrency has to be a positive integer")
+    return concurrency
+
+
+@router.post("/run_testset/{project_id}", dependencies=[Depends(require_project)])
+async def run_testset_endpoint(request: Request, project_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
     data = await request.json()
     testset_id = data["testset_id"]
-    prompt_id = data["prompt_id"]
+    prompt_id = int(data["prompt_id"])
     model = data["model"]
+    concurrency = _run_concurrency(data.get("concurrency"))
+    await check_access(request, db, "prompt", prompt_id, project_id=project_id)
 
 
-    testsets = get_project_testsets(project_id)
-    needed_testset = None
-    for testset in testsets:
-        if testset["id"] == testset_id:
-            needed_testset = testset
-            break
-    if not needed_testset:
+    needed_testset = await get_testset(int(testset_id), db=db)
+    if not needed_testset or needed_testset["project_id"] != project_id:
         raise HTTPException(status_code=404, detail="Testset not found")
     
     logger.debug(f"Running testset {testset_id} for prompt {prompt_id} with model {model}")
-    
-    thread = threading.Thread(target=run_testset, args=(email, needed_testset, prompt_id, model))
-    thread.start()
-    logger.debug(f"Started thread for testset {testset_id}")
-    return {"success": True, "message": "Testset run successfully"}
 
+    run = await run_testset(get_current_user(request), needed_testset, prompt_id, model, concurrency=concurrency, db=db)
+    logger.debug(f"Scheduled run {run['id']} for testset {testset_id}")
+    return {"success": True, "message": "Testset run successfully", "run_id": run["id"]}
+
+
+
+@router.get("/check_run/{prompt_version_id}", dependencies=[Depends(require_version)])
+async def check_run_endpoint(request: Request, response: Response, prompt_version_id: int, cursor: Optional[str] = None, limit: int = settings.PAGE_SIZE, db: AsyncSession = Depends(get_request_db, scope="function")):
+    """
+    Latest run of the prompt version with a page of its results. The cursor of the next page of results is sent in the X-Next-Cursor header,
+    GET /runs/{run_id}/results continues with it
+    """
+    run = await check_run(prompt_version_id, **page_args(cursor, limit), db=db)
+    if run:
+        paged(response, run["results"])
+    return run
+
+
+@router.get("/runs/{run_id}/results")
+async def get_run_results_endpoint(request: Request, response: Response, run_id: int, cursor: Optional[str] = None, limit: int = settings.PAGE_SIZE, db: AsyncSession = Depends(get_request_db, scope="function")):
+    """
+    Page of the results of the run in the order of their tests. The cursor of the next page is sent in the X-Next-Cursor header
+    """
+    email = request.state.email
+    run = await get_run(run_id, db=db)
+    if not run or run["email"] != email:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return paged(response, await get_run_results(run_id, **page_args(cursor, limit), db=db))
+
+
+def export_results(scope: str, scope_id: int, format: str, filename: str) -> StreamingResponse:
+    """
+    Streams the results of the scope (see stream_run_results) as a download. The rows go from a server-side cursor
+    through the encoder straight into the response, one batch at a time
+    """
+    if format not in ENCODERS:
+        raise HTTPException(status_code=400, detail=f"Unknown format, use one of {', '.join(ENCODERS)}")
+    if format == "parquet" and not PARQUET_AVAILABLE:
+        raise HTTPException(status_code=501, detail="Parquet exports need pyarrow installed on the server")
+    batches = stream_run_results(scope, scope_id, batch_size=settings.EXPORT_BATCH_SIZE)
+    return StreamingResponse(
+        ENCODERS[format](batches),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{format}"'},
+    )
+
+
+@router.get("/runs/{run_id}/export")
+async def export_run_results_endpoint(request: Request, run_id: int, format: str = "jsonl", db: AsyncSession = Depends(get_request_db, scope="function")):
+    email = request.state.email
+    run = await get_run(run_id, db=db)
+    if not run or run["email"] != email:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return export_results("run", run_id, format, f"run-{run_id}-results")
+
+
+@router.get("/versions/{prompt_version_id}/export", dependencies=[Depends(require_version)])
+async def export_version_results_endpoint(request: Request, prompt_version_id: int, format: str = "jsonl"):
+    return export_results("version", prompt_version_id, format, f"version-{prompt_version_id}-results")
+
+
+@router.get("/projects/{project_id}/export", dependencies=[Depends(require_project)])
+async def export_project_results_endpoint(request: Request, project_id: int, format: str = "jsonl"):
+    return export_results("project", project_id, format, f"project-{project_id}-results")
+
+
+SNAPSHOT_RESULTS = 1000
 
 
-@router.get("/check_run/{prompt_version_id}")
-async def check_run_endpoint(request: Request, prompt_version_id: int):
+@router.get("/runs/{run_id}/events")
+async def run_events_endpoint(request: Request, run_id: int, offset: int = 0, db: AsyncSession = Depends(get_request_db, scope="function")):
+    """
+    Pushes the progress of the run as Server-Sent Events: run_started, test_started, test_finished (with the result of that test only) and run_finished.
+    Every event has an id, so a client can resume with ?offset= or the Last-Event-ID header.
+    Runs that are not in memory anymore are sent as a single snapshot event read from the database, like the events
+    a client missed when they aren't kept in memory anymore (see RunEventBus)
+    """
     email = request.state.email
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return check_run(prompt_version_id)
\ No newline at end of file
+    last_event_id = request.headers.get("Last-Event-ID")
+    if last_event_id is not None and last_event_id.isdigit():
+        offset = int(last_event_id) + 1
+
+    log = run_events.get(run_id)
+    if log is None:
+        run = await get_run_with_results(run_id, limit=SNAPSHOT_RESULTS, db=db)
+        if not run or run["email"] != email:
+            raise HTTPException(status_code=404, detail="Run not found")
+
+        async def snapshot():
+            yield format_sse("snapshot", run)
+
+        return StreamingResponse(snapshot(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    if log.email != email:
+        raise HTTPException(status_code=404, detail="Run not found")
+
+    async def events():
+        async for item in run_events.subscribe(run_id, offset):
+            if item is None:
+                yield ": ping\n\n"
+                continue
+            event_offset, event, data = item
+            if event == "resync":
+                # the session of the request is closed once the stream starts, the snapshot is read with one of its own
+                event, data = "snapshot", await get_run_with_results(run_id, limit=SNAPSHOT_RESULTS)
+            yield format_sse(event, data, event_id=event_offset)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
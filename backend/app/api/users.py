@@ -1,12 +1,16 @@
-from fastapi import APIRouter, HTTPException, Request
-from app.db.functions import *
+from typing import Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Response
+from starlette.concurrency import run_in_threadpool
+from app.db.async_functions import *
+from app.db.session import get_request_db
+from app.api.deps import get_current_user, require_project, require_prompt, page_args, paged
 from app.db.models import User
 from app.settings import settings
 from app.utils.auth import generate_jwt_token, hash_password
 import loguru
 import hashlib
 
-from difflib import SequenceMatcher, ndiff
+from app.utils.diffing import check_prompt_change, cached_diff, precompute_diffs, DIFF_GRANULARITIES
 
 router = APIRouter(
     prefix="/users",
@@ -27,47 +31,21 @@ These endpoints are divided into two groups: one for editing the prompt object (
 """
 
 
-def check_prompt_change(new_text: str, old_text: str): 
-    logger.debug(f"Checking prompt change: {new_text} - new text, {old_text} - old text")
-    if not old_text:
-        return True, None
-
-    matcher = SequenceMatcher(None, new_text, old_text)
-    ratio = matcher.ratio()
-
-    logger.debug(f"Checking prompt change: {ratio}")
-
-    if ratio < 0.92:
-        new_lines = new_text.splitlines()
-        old_lines = old_text.splitlines()
-        diff = ndiff(old_lines, new_lines)
-        return True, "\n".join(diff)
-    
-    return False, None
-
-
-
 @router.get("/me")
 async def get_me_endpoint(request: Request):
-    email = request.state.email
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+    user = get_current_user(request)
     return user
 
 
 @router.post("/me/email")
-async def update_email_endpoint(request: Request):
-    email = request.state.email
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+async def update_email_endpoint(request: Request, db: AsyncSession = Depends(get_request_db, scope="function")):
+    user = get_current_user(request)
     response = await request.json()
     new_email = response["new_email"]
-    if not get_user_by_email(new_email):
+    if not await get_user_by_email(new_email, db=db):
         user["email"] = new_email
         user["verified"] = False
-        set_user(user)
+        await set_user(user, db=db)
 
         token = generate_jwt_token(new_email)
 
@@ -77,24 +55,25 @@ async def update_email_endpoint(request: Request):
 
 
 @router.get("/projects")
-async def get_projects_endpoint(request: Request):
-    email = request.state.email
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    projects = get_projects_by_user(user["id"])
-    return projects
+async def get_projects_endpoint(request: Request, response: Response, cursor: Optional[str] = None, limit: int = settings.PAGE_SIZE, db: AsyncSession = Depends(get_request_db, scope="function")):
+    """
+    Page of the projects of the user. The cursor of the next page is sent in the X-Next-Cursor header
+    """
+    user = get_current_user(request)
+    projects = await get_projects_by_user(user["id"], **page_args(cursor, limit), db=db)
+    return paged(response, projects)
 
 
 @router.post("/projects")
-async def create_project_endpoint(request: Request):
+async def create_project_endpoint(request: Request, db: AsyncSession = Depends(get_request_db, scope="function")):
     try:
-        email = request.state.email
-        user_id = get_user_by_email(email)["id"]
+        user_id = get_current_user(request)["id"]
         project = await request.json()
+        # always a new project, set_project would update the project of a given id and hand it to the caller
+        project.pop("id", None)
         project["user_id"] = user_id
 
-        result = set_project(project)
+        result = await set_project(project, db=db)
 
         return result
     except Exception as e:
@@ -102,96 +81,94 @@ async def create_project_endpoint(request: Request):
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
-@router.get("/projects/{project_id}")
-async def get_project_endpoint(request: Request, project_id: str):
-    email = request.state.email
-    project = get_project(project_id)
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    if project["user_id"] != get_user_by_email(email)["id"]:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return project
+@router.get("/projects/{project_id}", dependencies=[Depends(require_project)])
+async def get_project_endpoint(request: Request, project_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
+    return await get_project(project_id, db=db)
 
 
-@router.put("/projects/{project_id}")
-async def update_project_endpoint(project_id: str, request: Request):
-    email = request.state.email
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+@router.put("/projects/{project_id}", dependencies=[Depends(require_project)])
+async def update_project_endpoint(project_id: int, request: Request, db: AsyncSession = Depends(get_request_db, scope="function")):
+    user = get_current_user(request)
     project = await request.json()
-    if project["user_id"] != user["id"]:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return set_project(project_id, project)
+    project["id"] = project_id
+    project["user_id"] = user["id"]
+    return await set_project(project, db=db)
 
 
-@router.delete("/projects/{project_id}")
-async def delete_project_endpoint(request: Request, project_id: str):
-    email = request.state.email
-    user_id = get_user_by_email(email)["id"]
-    if user_id != get_project(project_id)["user_id"]:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return delete_project(project_id)
+@router.delete("/projects/{project_id}", dependencies=[Depends(require_project)])
+async def delete_project_endpoint(request: Request, project_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
+    return await delete_project(project_id, db=db)
 
 
-@router.get("/projects/{project_id}/prompts")
-async def get_prompts_endpoint(request: Request, project_id: str):
+@router.get("/projects/{project_id}/prompts", dependencies=[Depends(require_project)])
+async def get_prompts_endpoint(request: Request, response: Response, project_id: int, cursor: Optional[str] = None, limit: int = settings.PAGE_SIZE, db: AsyncSession = Depends(get_request_db, scope="function")):
     """
-    Returns all prompts in the project including all versions of each prompt
+    Returns a page of the prompts in the project. The cursor of the next page is sent in the X-Next-Cursor header
     """
-    email = request.state.email
-    user_id = get_user_by_email(email)["id"]
-    if user_id != get_project(project_id)["user_id"]:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    prompts = get_project_prompts(project_id)
+    prompts = await get_project_prompts(project_id, **page_args(cursor, limit), db=db)
 
-    return prompts
+    return paged(response, prompts)
 
 
-@router.post("/projects/{project_id}/prompts")
-async def create_prompt_endpoint(request: Request, project_id: str):
+@router.post("/projects/{project_id}/prompts", dependencies=[Depends(require_project)])
+async def create_prompt_endpoint(request: Request, project_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
     """
     Creates a new prompt in the project. This endpoints is used to create a new prompt object from the sidebar menu and immediately assign a first version to it
     """
-    email = request.state.email
-    user_id = get_user_by_email(email)["id"]
-    if user_id != get_project(project_id)["user_id"]:
-        raise HTTPException(status_code=401, detail="Unauthorized")
     prompt = await request.json()
     prompt["project_id"] = project_id
 
-    result = create_prompt_with_version(prompt)
+    result = await create_prompt_with_version(prompt, db=db)
 
     if result:
-        log_action(project_id, "Prompt created", "new")
+        await log_action(project_id, "Prompt created", "new", db=db)
     else:
-        log_action(project_id, "Prompt creation failed", "error")
+        await log_action(project_id, "Prompt creation failed", "error", db=db)
 
     return result
 
 
-@router.get("/projects/{project_id}/prompts/{prompt_id}")
-async def get_prompt_endpoint(request: Request, project_id: str, prompt_id: str):
+@router.get("/projects/{project_id}/prompts/{prompt_id}", dependencies=[Depends(require_prompt)])
+async def get_prompt_endpoint(
+    request: Request,
+    project_id: int,
+    prompt_id: int,
+    runs: str = "summary",
+    runs_limit: Optional[int] = None,
+    results_limit: int = 100,
+    include_text: bool = True,
+    db: AsyncSession = Depends(get_request_db, scope="function"),
+):
     """
-    Get info about a particular prompt including all versions of the prompt. Also may include runs of the versions (get_prompt function has a parameter to include runs)
+    Get info about a particular prompt including all versions of the prompt and their runs.
+    runs is one of "summary" (runs without their results), "full" (with the first results_limit results of each run) or "none".
+    runs_limit keeps the last runs of every version, include_text=false leaves out the prompt texts
     """
-    email = request.state.email
-    user_id = get_user_by_email(email)["id"]
-    if user_id != get_project(project_id)["user_id"]:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    prompt = get_prompt(prompt_id)
+    if runs not in ("summary", "full", "none"):
+        raise HTTPException(status_code=400, detail="runs must be one of summary, full, none")
+    prompt = await get_prompt(
+        prompt_id,
+        include_runs=runs != "none",
+        run_summaries=runs == "summary",
+        runs_limit=runs_limit,
+        results_limit=min(results_limit, 1000),
+        include_text=include_text,
+        db=db,
+    )
     return prompt
 
 
-@router.put("/projects/{project_id}/prompts/{prompt_id}")
-async def update_prompt_version_endpoint(request: Request, project_id: str, prompt_id: str):
+@router.put("/projects/{project_id}/prompts/{prompt_id}", dependencies=[Depends(require_prompt)])
+async def update_prompt_version_endpoint(
+    request: Request,
+    project_id: int,
+    prompt_id: int,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_request_db, scope="function"),
+):
     """
     Update info about some version of the prompt. This is used to edit the prompt text, comments, etc.
     """
-    email = request.state.email
-    user_id = get_user_by_email(email)["id"]
-    if user_id != get_project(project_id)["user_id"]:
-        raise HTTPException(status_code=401, detail="Unauthorized")
     prompt = await request.json()
     prompt["prompt_id"] = prompt_id
 
@@ -200,41 +177,67 @@ async def update_prompt_version_endpoint(request: Request, project_id: str, prom
 
     new_text = prompt.get("prompt_text")
 
-    previous_versions = get_prompt_versions_by_prompt(prompt_id)
-
-    old_version = previous_versions[-1] if previous_versions else None
+    old_version = await get_latest_prompt_version(prompt_id, db=db)
     logger.debug(f"Old version: {old_version}")
     old_text = old_version.get("prompt_text") if old_version else None
-    old_version_number = old_version.get("version_number") if old_version else None
 
-    if "comments" in prompt:
-        prompt["version_number"] = old_version_number + 1 if old_version_number else 1
-        return create_prompt_version(prompt)
-    else:
+    # new versions get the next number of the prompt from create_prompt_version
+    if "comments" not in prompt:
         is_significant_change, _ = check_prompt_change(new_text, old_text)
-        if is_significant_change:
-            prompt["version_number"] = old_version_number + 1 if old_version_number else 1
-            return create_prompt_version(prompt)
-        else:
-            return set_prompt_version(prompt)
-
-
-@router.delete("/projects/{project_id}/prompts/{prompt_id}")
-async def delete_prompt_endpoint(request: Request, project_id: str, prompt_id: str):
+        if not is_significant_change:
+            return await set_prompt_version(prompt, db=db)
+
+    created = await create_prompt_version(prompt, db=db)
+    if created and old_text and new_text:
+        # the diff against the previous version is the one the history view asks for first
+        background_tasks.add_task(precompute_diffs, old_text, new_text)
+    return created
+
+
+@router.get("/projects/{project_id}/prompts/{prompt_id}/diff", dependencies=[Depends(require_prompt)])
+async def get_prompt_diff_endpoint(
+    request: Request,
+    project_id: int,
+    prompt_id: int,
+    from_version: int,
+    to_version: Optional[int] = None,
+    granularity: str = "line",
+    db: AsyncSession = Depends(get_request_db, scope="function"),
+):
+    """
+    Changes between two versions of the prompt, given by their version numbers. to_version defaults to the current version.
+    - granularity: line or word, large changes may fall back to line (the response has the granularity that was used)
+    """
+    if granularity not in DIFF_GRANULARITIES:
+        raise HTTPException(status_code=400, detail="granularity must be one of line, word")
+    if to_version is None:
+        latest = await get_latest_prompt_version(prompt_id, db=db)
+        if not latest:
+            raise HTTPException(status_code=404, detail="Prompt has no versions")
+        to_version = latest["version_number"]
+
+    versions = await get_prompt_versions_by_numbers(prompt_id, [from_version, to_version], db=db)
+    for version_number in (from_version, to_version):
+        if version_number not in versions:
+            raise HTTPException(status_code=404, detail=f"Version {version_number} not found")
+
+    old_text = versions[from_version]["prompt_text"] or ""
+    new_text = versions[to_version]["prompt_text"] or ""
+    diff = await run_in_threadpool(cached_diff, old_text, new_text, granularity)
+    return {"prompt_id": prompt_id, "from_version": from_version, "to_version": to_version, **diff}
+
+
+@router.delete("/projects/{project_id}/prompts/{prompt_id}", dependencies=[Depends(require_prompt)])
+async def delete_prompt_endpoint(request: Request, project_id: int, prompt_id: int, db: AsyncSession = Depends(get_request_db, scope="function")):
     """
     Deletes a prompt and all its versions
     """
-    email = request.state.email
-    user_id = get_user_by_email(email)["id"]
-    if user_id != get_project(project_id)["user_id"]:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return delete_prompt(prompt_id)
+    return await delete_prompt(prompt_id, db=db)
 
 
-@router.get("/actions/{project_id}")
-async def get_project_actions_endpoint(request: Request, project_id: str):
-    email = request.state.email
-    user_id = get_user_by_email(email)["id"]
-    if user_id != get_project(project_id)["user_id"]:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return get_project_actions(project_id)
+@router.get("/actions/{project_id}", dependencies=[Depends(require_project)])
+async def get_project_actions_endpoint(request: Request, response: Response, project_id: int, cursor: Optional[str] = None, limit: int = 20, db: AsyncSession = Depends(get_request_db, scope="function")):
+    """
+    Page of the actions of the project, newest first. The cursor of the next page is sent in the X-Next-Cursor header
+    """
+    return paged(response, await get_project_actions(project_id, **page_args(cursor, limit), db=db))
@@ -0,0 +1,987 @@
+"""
+Async equivalents of the app.db.functions API used by the routers. They run on the asyncpg engine,
+so a slow query only suspends the request that issued it instead of blocking the whole event loop.
+Return values and error handling are the same as in app.db.functions.
+
+Every helper takes an optional db session. The routers pass the session of the request (get_request_db),
+so all queries of a request share one connection and one transaction; without it a helper opens a session of its own
+"""
+from typing import Dict, List, Optional, Union, Any
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, insert, func, inspect, case, null
+from sqlalchemy.orm import selectinload, defer
+from sqlalchemy.orm.attributes import flag_modified
+import loguru
+import traceback
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.session import use_session
+from app.db.models import User, Project, Prompt, PromptVersion, Run, RunResult, TestSet, TestCase, Action, LLMCacheEntry
+from app.db.functions import user_cache, ownership_cache
+# the queries and row helpers are shared with the sync functions, only the execution differs
+from app.db.functions import latest_version_query, dependents_query, claim_version_number_query, loaded_dict
+from app.db.functions import run_results_query, results_page, versions_runs_query, runs_results_query, group_results, with_results
+from app.db.functions import testset_cases_query, cases_page
+from app.db.functions import testset_summary_query, case_row, lock_testset_query, next_position_query, position_rows
+from app.db.version_storage import store_text, cache_text, reencode, chain_query, missing_snapshots, rebuild_texts
+from app.db.pagination import Page, keyset, to_page
+from app.utils.auth import hash_password
+
+
+logger = loguru.logger
+
+
+# ------ User functions ------
+
+async def get_user(user_id: int, db: AsyncSession = None) -> dict:
+    try:
+        async with use_session(db) as db:
+            user = await db.scalar(select(User).where(User.id == user_id))
+            if not user:
+                return False
+            return user.to_dict()
+    except Exception as e:
+        logger.error(f"Error getting user: {traceback.format_exc()}")
+        return False
+
+
+async def get_user_by_email(email: str, db: AsyncSession = None) -> dict:
+    try:
+        logger.debug(f"Getting user by email: {email}")
+        async with use_session(db) as db:
+            user = await db.scalar(select(User).where(User.email == email))
+            if not user:
+                return False
+            return user.to_dict()
+    except Exception as e:
+        logger.error(f"Error finding user by email: {traceback.format_exc()}")
+        return False
+
+
+async def get_cached_user_by_email(email: str, db: AsyncSession = None) -> dict:
+    user = user_cache.get(email)
+    if user is None:
+        user = await get_user_by_email(email, db=db)
+        if not user:
+            return False
+        user_cache.set(email, user)
+    return dict(user)
+
+
+async def create_user(user_data, db: AsyncSession = None):
+    try:
+        name = user_data.get("name")
+        email = user_data.get("email")
+        password = user_data.get("password")
+        async with use_session(db, savepoint=True) as db:
+            existing_user = await db.scalar(select(User).where(User.email == email))
+            if existing_user:
+                return False
+            db.add(User(name=name, email=email, hashed_password=hash_password(password)))
+            await db.flush()
+            return True
+    except Exception as e:
+        logger.error(f"Error creating user: {traceback.format_exc()}")
+        return False
+
+
+async def set_user(user_data: dict, db: AsyncSession = None) -> bool:
+    try:
+        user_id = user_data.get("id")
+        if user_id is None:
+            logger.error("No user ID provided in user_data")
+            return False
+
+        async with use_session(db, savepoint=True) as db:
+            user = await db.scalar(select(User).where(User.id == user_id))
+            if not user:
+                user = User(**user_data)
+                db.add(user)
+                await db.flush()
+                user_cache.delete(user.email)
+                return True
+
+            old_email = user.email
+            for key, value in user_data.items():
+                if hasattr(user, key):
+                    setattr(user, key, value)
+            await db.flush()
+            user_cache.delete(old_email)
+            user_cache.delete(user.email)
+            return True
+    except Exception as e:
+        logger.error(f"Error setting user: {traceback.format_exc()}")
+        return False
+
+
+async def delete_user(user_id: int, db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            user = await db.scalar(select(User).where(User.id == user_id).options(selectinload(User.projects)))
+            if not user:
+                return False
+            await db.delete(user)
+            await db.flush()
+            user_cache.delete(user.email)
+            return True
+    except Exception as e:
+        logger.error(f"Error deleting user: {traceback.format_exc()}")
+        return False
+
+
+async def get_user_keys(email: str, db: AsyncSession = None) -> dict:
+    try:
+        async with use_session(db) as db:
+            keys = await db.scalar(select(User.keys).where(User.email == email))
+            return keys if keys else {}
+    except Exception as e:
+        logger.error(f"Error getting user keys: {traceback.format_exc()}")
+        return False
+
+
+async def set_user_keys(email: str, keys: dict, db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            result = await db.execute(update(User).where(User.email == email).values(keys=keys))
+            await db.flush()
+            user_cache.delete(email)
+            return result.rowcount > 0
+    except Exception as e:
+        logger.error(f"Error setting user keys: {traceback.format_exc()}")
+        return False
+
+
+# ------ Project functions ------
+
+async def get_project(project_id: int, db: AsyncSession = None) -> dict:
+    try:
+        async with use_session(db) as db:
+            project = await db.scalar(select(Project).where(Project.id == int(project_id)))
+            if not project:
+                return False
+            return project.to_dict()
+    except Exception as e:
+        logger.error(f"Error getting project: {traceback.format_exc()}")
+        return False
+
+
+async def get_projects_by_user(user_id: int, cursor: str = None, limit: int = None, db: AsyncSession = None) -> Page:
+    try:
+        query = keyset(select(Project).where(Project.user_id == user_id), Project.id, cursor, limit)
+        async with use_session(db) as db:
+            projects = await db.scalars(query)
+            return to_page([project.to_dict() for project in projects], limit, lambda project: project["id"])
+    except Exception as e:
+        logger.error(f"Error getting projects by user: {traceback.format_exc()}")
+        return Page()
+
+
+async def set_project(project_data: dict, db: AsyncSession = None) -> bool:
+    try:
+        project_id = project_data.get("id")
+        async with use_session(db, savepoint=True) as db:
+            project = await db.scalar(select(Project).where(Project.id == int(project_id))) if project_id else None
+            if not project:
+                db.add(Project(**project_data))
+                await db.flush()
+                return True
+            for key, value in project_data.items():
+                if hasattr(project, key):
+                    setattr(project, key, value)
+            await db.flush()
+            ownership_cache.clear()
+            return True
+    except Exception as e:
+        logger.error(f"Error setting project: {traceback.format_exc()}")
+        return False
+
+
+async def delete_project(project_id: int, db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            # relationships are loaded upfront, the ORM can't lazy load them in async mode when it detaches the children
+            project = await db.scalar(
+                select(Project)
+                .where(Project.id == int(project_id))
+                .options(selectinload(Project.prompts), selectinload(Project.tests), selectinload(Project.actions))
+            )
+            if not project:
+                return False
+            await db.delete(project)
+            await db.flush()
+            ownership_cache.clear()
+            return True
+    except Exception as e:
+        logger.error(f"Error deleting project: {traceback.format_exc()}")
+        return False
+
+
+async def get_project_prompts(project_id: int, cursor: str = None, limit: int = None, db: AsyncSession = None) -> Page:
+    try:
+        query = keyset(select(Prompt).where(Prompt.project_id == int(project_id)), Prompt.id, cursor, limit)
+        async with use_session(db) as db:
+            prompts = await db.scalars(query)
+            return to_page([prompt.to_dict() for prompt in prompts], limit, lambda prompt: prompt["id"])
+    except Exception as e:
+        logger.error(f"Error getting project prompts: {traceback.format_exc()}")
+        return Page()
+
+
+async def get_object_owner(kind: str, object_id: int, db: AsyncSession = None):
+    """
+    Owner of a project, prompt, prompt version or testset as (user id, project id), in one query that goes from the object
+    to its project by primary keys. Returns None if the object doesn't exist
+    """
+    query = select(Project.user_id, Project.id)
+    if kind == "project":
+        query = query.where(Project.id == object_id)
+    elif kind == "prompt":
+        query = query.join(Prompt, Prompt.project_id == Project.id).where(Prompt.id == object_id)
+    elif kind == "version":
+        query = (
+            query.join(Prompt, Prompt.project_id == Project.id)
+            .join(PromptVersion, PromptVersion.prompt_id == Prompt.id)
+            .where(PromptVersion.id == object_id)
+        )
+    elif kind == "testset":
+        query = query.join(TestSet, TestSet.project_id == Project.id).where(TestSet.id == object_id)
+    else:
+        raise ValueError(f"Unknown object kind: {kind}")
+
+    try:
+        async with use_session(db) as db:
+            row = (await db.execute(query)).first()
+            return tuple(row) if row else None
+    except Exception as e:
+        logger.error(f"Error getting owner of {kind} {object_id}: {traceback.format_exc()}")
+        return None
+
+
+# ------ Prompt functions ------
+
+async def _query_run_results(db, run_id, cursor=None, limit=None) -> Page:
+    return results_page(await db.scalars(run_results_query(run_id, cursor, limit)), limit)
+
+
+async def _run_with_results(db, run, cursor=None, limit=100) -> dict:
+    return with_results(run.to_dict(), await _query_run_results(db, run.id, cursor, limit))
+
+
+async def _query_runs_results(db, run_ids: List[int], limit: int = 100) -> Dict[int, List[dict]]:
+    if not run_ids:
+        return {}
+    return group_results(run_ids, await db.scalars(runs_results_query(run_ids, limit)))
+
+
+async def get_prompt(
+    prompt_id: int,
+    include_runs = True,
+    results_limit: int = 100,
+    run_summaries: bool = False,
+    runs_limit: int = None,
+    include_text: bool = True,
+    db: AsyncSession = None,
+) -> dict:
+    """
+    Prompt with its versions. Every level is loaded with one query for all rows:
+    - include_runs adds the runs of each version, runs_limit keeps only the last runs of every version
+    - run_summaries returns the runs without results (neither the result JSON nor the run_results rows),
+      otherwise each run carries its first results_limit results
+    - include_text=False leaves out prompt_text of the versions
+    """
+    try:
+        async with use_session(db) as db:
+            prompt = await db.scalar(select(Prompt).where(Prompt.id == int(prompt_id)))
+            if not prompt:
+                return False
+            prompt_dict = prompt.to_dict()
+
+            query = select(PromptVersion).where(PromptVersion.prompt_id == int(prompt_id)).order_by(PromptVersion.version_number.asc())
+            if not include_text:
+                query = query.options(defer(PromptVersion.prompt_text), defer(PromptVersion.delta))
+            versions = list(await db.scalars(query))
+            if include_text:
+                await _load_texts(db, versions)
+            prompt_dict['versions'] = [loaded_dict(version) for version in versions]
+            if not include_runs or not versions:
+                return prompt_dict
+
+            runs = list(await db.scalars(versions_runs_query([version.id for version in versions], runs_limit, run_summaries)))
+            if run_summaries:
+                run_dicts = [loaded_dict(run) for run in runs]
+            else:
+                results = await _query_runs_results(db, [run.id for run in runs], results_limit)
+                run_dicts = [with_results(run.to_dict(), results[run.id]) for run in runs]
+
+            version_runs = {version.id: [] for version in versions}
+            for run_dict in run_dicts:
+                version_runs[run_dict["prompt_version_id"]].append(run_dict)
+            for version_dict in prompt_dict['versions']:
+                version_dict['runs'] = version_runs[version_dict["id"]]
+            return prompt_dict
+    except Exception as e:
+        logger.error(f"Error getting prompt: {traceback.format_exc()}")
+        return False
+
+
+async def create_prompt_with_version(prompt_data: dict, db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            prompt = Prompt(**prompt_data)
+            db.add(prompt)
+            await db.flush()
+            if prompt.versions:
+                prompt.current_version_id = prompt.versions[-1].id
+                await db.flush()
+            return True
+    except Exception as e:
+        logger.error(f"Error creating prompt with version: {traceback.format_exc()}")
+        return False
+
+
+async def delete_prompt(prompt_id: int, db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            prompt = await db.scalar(
+                select(Prompt)
+                .where(Prompt.id == int(prompt_id))
+                .options(selectinload(Prompt.versions).selectinload(PromptVersion.runs), selectinload(Prompt.runs))
+            )
+            if not prompt:
+                return False
+            await db.delete(prompt)
+            await db.flush()
+            ownership_cache.delete(("prompt", int(prompt_id)))
+            return True
+    except Exception as e:
+        logger.error(f"Error deleting prompt: {traceback.format_exc()}")
+        return False
+
+
+# ------ PromptVersion functions ------
+
+async def get_prompt_versions(prompt_id: int, cursor: str = None, limit: int = None, db: AsyncSession = None) -> Page:
+    try:
+        query = keyset(select(PromptVersion).where(PromptVersion.prompt_id == int(prompt_id)), PromptVersion.version_number, cursor, limit)
+        async with use_session(db) as db:
+            versions = list(await db.scalars(query))
+            return to_page(
+                [version.to_dict() for version in await _load_texts(db, versions)], limit, lambda version: version["version_number"]
+            )
+    except Exception as e:
+        logger.error(f"Error getting prompt versions: {traceback.format_exc()}")
+        return Page()
+
+
+async def get_prompt_version(version_id: int, db: AsyncSession = None) -> dict:
+    try:
+        async with use_session(db) as db:
+            version = await db.scalar(select(PromptVersion).where(PromptVersion.id == version_id))
+            if not version:
+                return False
+            await _load_texts(db, [version])
+            return version.to_dict()
+    except Exception as e:
+        logger.error(f"Error getting prompt version: {traceback.format_exc()}")
+        return False
+
+
+async def _load_texts(db, versions: List[PromptVersion]) -> List[PromptVersion]:
+    """
+    Rebuilds prompt_text of the versions stored as deltas, the chains whose texts are not cached are loaded with one query each
+    """
+    rows = list(versions)
+    for snapshot_id in missing_snapshots(versions):
+        rows.extend(await db.scalars(chain_query(snapshot_id)))
+    rebuild_texts(rows)
+    return versions
+
+
+async def _dependents(db, version: PromptVersion) -> List[PromptVersion]:
+    """
+    Versions stored as a delta against version, with their texts
+    """
+    dependents = list(await db.scalars(dependents_query(version.id)))
+    await _load_texts(db, dependents + [version])
+    return dependents
+
+
+async def _delta_base(db, version: PromptVersion) -> PromptVersion:
+    base = await db.get(PromptVersion, version.base_version_id) if version.delta is not None else None
+    if base is not None:
+        await _load_texts(db, [base])
+    return base
+
+
+async def _set_version_text(db, version: PromptVersion, text: str):
+    """
+    Changes the text of an existing version, the deltas based on it are rewritten against the new text
+    """
+    await _load_texts(db, [version])
+    if version.prompt_text == text:
+        return
+    dependents = await _dependents(db, version)
+    reencode(version, text, await _delta_base(db, version))
+    for dependent in dependents:
+        reencode(dependent, dependent.prompt_text, version)
+
+
+async def _add_version(db, version_data: dict) -> PromptVersion:
+    """
+    Adds a version with the next number of its prompt and makes it the current one. Claiming the number locks
+    the row of the prompt until the transaction ends, so concurrent saves get consecutive numbers.
+    The number is written to version_data
+    """
+    prompt_id = int(version_data["prompt_id"])
+    claimed = (await db.execute(claim_version_number_query(prompt_id))).first()
+    if claimed is None:
+        raise ValueError(f"Prompt {prompt_id} not found")
+    version_data["version_number"], base_id = claimed
+
+    # the version is stored against the one it was saved over
+    base = await db.get(PromptVersion, base_id) if base_id else None
+    if base is not None:
+        await _load_texts(db, [base])
+    text = version_data.get("prompt_text")
+    version = PromptVersion(**version_data)
+    store_text(version, text, base)
+    db.add(version)
+    await db.flush()
+    cache_text(version, text)
+    await db.execute(update(Prompt).where(Prompt.id == prompt_id).values(current_version_id=version.id))
+    return version
+
+
+async def get_latest_prompt_version(prompt_id: int, db: AsyncSession = None) -> dict:
+    try:
+        async with use_session(db) as db:
+            version = await db.scalar(latest_version_query(prompt_id))
+            if not version:
+                return False
+            await _load_texts(db, [version])
+            return version.to_dict()
+    except Exception as e:
+        logger.error(f"Error getting latest prompt version: {traceback.format_exc()}")
+        return False
+
+
+async def get_prompt_versions_by_prompt(prompt_id: int, db: AsyncSession = None) -> List[dict]:
+    try:
+        async with use_session(db) as db:
+            versions = await db.scalars(
+                select(PromptVersion).where(PromptVersion.prompt_id == int(prompt_id)).order_by(PromptVersion.version_number.asc())
+            )
+            return [version.to_dict() for version in await _load_texts(db, list(versions))]
+    except Exception as e:
+        logger.error(f"Error getting prompt versions by prompt: {traceback.format_exc()}")
+        return []
+
+
+async def get_prompt_versions_by_numbers(prompt_id: int, version_numbers: List[int], db: AsyncSession = None) -> Dict[int, dict]:
+    """
+    Versions of the prompt with the given numbers, by number
+    """
+    try:
+        async with use_session(db) as db:
+            versions = list(await db.scalars(
+                select(PromptVersion).where(PromptVersion.prompt_id == int(prompt_id), PromptVersion.version_number.in_(version_numbers))
+            ))
+            return {version.version_number: version.to_dict() for version in await _load_texts(db, versions)}
+    except Exception as e:
+        logger.error(f"Error getting prompt versions by numbers: {traceback.format_exc()}")
+        return {}
+
+
+async def create_prompt_version(version_data: dict, db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as session:
+            await _add_version(session, version_data)
+
+        await log_action(version_data.get("project_id"), f"New prompt version {version_data.get('version_number')} created", "new", db=db)
+        return True
+    except Exception as e:
+        logger.error(f"Error creating prompt version: {traceback.format_exc()}")
+        await log_action(version_data.get("project_id"), f"New prompt version {version_data.get('version_number')} creation failed", "error", db=db)
+        return False
+
+
+async def set_prompt_version(version_data: dict, latest_version: bool = True, db: AsyncSession = None) -> bool:
+    try:
+        version_id = version_data.get("id")
+        logger.debug(f"Setting prompt version: {version_id}")
+        async with use_session(db, savepoint=True) as session:
+            if latest_version:
+                version = await session.scalar(latest_version_query(version_data.get("prompt_id")))
+            else:
+                version = await session.scalar(select(PromptVersion).where(PromptVersion.id == version_id)) if version_id else None
+            if not version:
+                logger.debug(f"Creating new prompt version: {version_data}")
+                await _add_version(session, version_data)
+                action = (f"New prompt version {version_data.get('version_number')} created", "new")
+            else:
+                logger.debug(f"Updating existing prompt version: {version_data}")
+                for key, value in version_data.items():
+                    if key == "prompt_text":
+                        await _set_version_text(session, version, value)
+                    elif hasattr(version, key) and key not in PromptVersion.STORAGE_COLUMNS:
+                        setattr(version, key, value)
+                await session.flush()
+                action = (f"Prompt version {version_data.get('version_number')} updated", "update")
+
+        await log_action(version_data.get("project_id"), *action, db=db)
+        return True
+    except Exception as e:
+        logger.error(f"Error setting prompt version: {traceback.format_exc()}")
+        return False
+
+
+# ------ Run functions ------
+
+async def get_run(run_id: int, db: AsyncSession = None) -> dict:
+    try:
+        async with use_session(db) as db:
+            run = await db.scalar(select(Run).where(Run.id == run_id))
+            if not run:
+                return False
+            return run.to_dict()
+    except Exception as e:
+        logger.error(f"Error getting run: {traceback.format_exc()}")
+        return False
+
+
+async def get_version_runs(version_id: int, cursor: str = None, limit: int = None, db: AsyncSession = None) -> Page:
+    """
+    Runs of the version, newest first
+    """
+    try:
+        query = keyset(select(Run).where(Run.prompt_version_id == version_id), Run.id, cursor, limit, descending=True)
+        async with use_session(db) as db:
+            runs = await db.scalars(query)
+            return to_page([run.to_dict() for run in runs], limit, lambda run: run["id"])
+    except Exception as e:
+        logger.error(f"Error getting version runs: {traceback.format_exc()}")
+        return Page()
+
+
+async def get_runs_by_user(user_id: int, cursor: str = None, limit: int = None, db: AsyncSession = None) -> Page:
+    """
+    Runs started by the user, newest first
+    """
+    try:
+        query = keyset(select(Run).join(User, User.email == Run.email).where(User.id == user_id), Run.id, cursor, limit, descending=True)
+        async with use_session(db) as db:
+            runs = await db.scalars(query)
+            return to_page([run.to_dict() for run in runs], limit, lambda run: run["id"])
+    except Exception as e:
+        logger.error(f"Error getting runs by user: {traceback.format_exc()}")
+        return Page()
+
+
+async def create_run(model, prompt_version_id, email, prompt_id, number_of_tests, db: AsyncSession = None):
+    try:
+        async with use_session(db, savepoint=True) as db:
+            logger.debug(f"Creating run with model {model}, prompt_version_id {prompt_version_id}, email {email}, prompt_id {prompt_id}, number_of_tests {number_of_tests}")
+            run = Run(model=model, prompt_version_id=prompt_version_id, email=email, prompt_id=int(prompt_id), number_of_tests=number_of_tests)
+            db.add(run)
+            await db.flush()
+            await db.refresh(run)
+            return run.to_dict()
+    except Exception as e:
+        logger.error(f"Error creating run: {traceback.format_exc()}")
+        return False
+
+
+async def update_run(run_id, db: AsyncSession = None, **run_data):
+    try:
+        async with use_session(db, savepoint=True) as db:
+            logger.debug(f"Updating run info for run {run_id} with data {run_data}")
+            values = {key: value for key, value in run_data.items() if hasattr(Run, key)}
+            result = await db.execute(update(Run).where(Run.id == run_id).values(**values))
+            await db.flush()
+            return result.rowcount > 0
+    except Exception as e:
+        logger.error(f"Error updating run: {traceback.format_exc()}")
+        return False
+
+
+async def flush_run_results(results: List[dict], db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            await db.execute(insert(RunResult), results)
+            for run_id, count in Counter(result["run_id"] for result in results).items():
+                await db.execute(update(Run).where(Run.id == run_id).values(current_test=Run.current_test + count))
+            await db.flush()
+            return True
+    except Exception as e:
+        logger.error(f"Error flushing run results: {traceback.format_exc()}")
+        return False
+
+
+async def get_run_results(run_id: int, cursor: str = None, limit: int = None, db: AsyncSession = None) -> Page:
+    """
+    Results of the run in the order of their tests
+    """
+    try:
+        async with use_session(db) as db:
+            return await _query_run_results(db, run_id, cursor, limit)
+    except Exception as e:
+        logger.error(f"Error getting run results: {traceback.format_exc()}")
+        return Page()
+
+
+async def get_run_with_results(run_id: int, cursor: str = None, limit: int = 100, db: AsyncSession = None) -> dict:
+    try:
+        async with use_session(db) as db:
+            run = await db.scalar(select(Run).where(Run.id == run_id))
+            if not run:
+                return False
+            return await _run_with_results(db, run, cursor, limit)
+    except Exception as e:
+        logger.error(f"Error getting run with results: {traceback.format_exc()}")
+        return False
+
+
+async def check_run(prompt_version_id: int, cursor: str = None, limit: int = 100, db: AsyncSession = None) -> dict:
+    """
+    Returns the latest run of the prompt version with one page of its results, their next_cursor continues them
+    """
+    try:
+        async with use_session(db) as db:
+            run = await db.scalar(select(Run).where(Run.prompt_version_id == prompt_version_id).order_by(Run.id.desc()).limit(1))
+            if not run:
+                return False
+            return await _run_with_results(db, run, cursor, limit)
+    except Exception as e:
+        logger.error(f"Error checking run: {traceback.format_exc()}")
+
+
+EXPORT_SCOPES = ("run", "version", "project")
+
+
+def results_export_query(scope: str, scope_id: int):
+    """
+    Result rows of a run, the runs of a prompt version or the runs of a project, one row per test, ordered by run and test
+    """
+    query = (
+        select(
+            Run.id.label("run_id"),
+            Run.prompt_id,
+            Run.prompt_version_id,
+            PromptVersion.version_number,
+            Run.model,
+            RunResult.test_index,
+            RunResult.test_id,
+            RunResult.output,
+            RunResult.error,
+            RunResult.latency_ms,
+            RunResult.prompt_tokens,
+            RunResult.completion_tokens,
+            RunResult.cost,
+            RunResult.cached,
+            RunResult.created_at,
+            # runs from before run_results only have the result JSON
+            case((RunResult.id.is_(None), Run.result), else_=null()).label("legacy_result"),
+        )
+        .select_from(Run)
+        .outerjoin(RunResult, RunResult.run_id == Run.id)
+        .outerjoin(PromptVersion, PromptVersion.id == Run.prompt_version_id)
+    )
+    if scope == "run":
+        query = query.where(Run.id == scope_id)
+    elif scope == "version":
+        query = query.where(Run.prompt_version_id == scope_id)
+    else:
+        query = query.join(Prompt, Prompt.id == Run.prompt_id).where(Prompt.project_id == scope_id)
+    return query.order_by(Run.id.asc(), RunResult.test_index.asc())
+
+
+def _export_rows(keys: List[str], values) -> List[dict]:
+    row = dict(zip(keys, values))
+    legacy = row.pop("legacy_result")
+    if row["test_index"] is not None:
+        return [row]
+    if not isinstance(legacy, dict):
+        return []
+    rows = []
+    for test_index, output in sorted(legacy.items(), key=lambda item: int(item[0]) if str(item[0]).isdigit() else 0):
+        error = output[len("Error: "):] if isinstance(output, str) and output.startswith("Error: ") else None
+        rows.append(dict(row, test_index=int(test_index) if str(test_index).isdigit() else None,
+                         output=None if error is not None else output, error=error))
+    return rows
+
+
+async def stream_run_results(scope: str, scope_id: int, batch_size: int = 1000, db: AsyncSession = None):
+    """
+    Results of a run, of the runs of a prompt version or of all runs of a project as batches of flat dicts,
+    ordered by run and test. The rows are read from a server-side cursor batch_size at a time, so only one batch is in memory.
+    Without db the stream opens a session of its own, as a StreamingResponse outlives the session of the request
+    """
+    if scope not in EXPORT_SCOPES:
+        raise ValueError(f"Unknown export scope {scope}")
+    async with use_session(db) as db:
+        # a Core stream, the rows are plain columns and don't need the ORM
+        connection = await db.connection()
+        result = await connection.stream(results_export_query(scope, scope_id).execution_options(yield_per=batch_size))
+        keys = list(result.keys())
+        async for partition in result.partitions():
+            batch = []
+            for row in partition:
+                batch.extend(_export_rows(keys, row))
+            if batch:
+                yield batch
+
+
+# ------ TestSet functions ------
+
+async def get_project_testsets(project_id: int, cursor: str = None, limit: int = None, db: AsyncSession = None) -> Page:
+    """
+    Summaries of the testsets of the project (name, case_count, created_at), their cases are read with get_test_cases
+    """
+    try:
+        query = keyset(testset_summary_query().where(TestSet.project_id == project_id), TestSet.id, cursor, limit)
+        async with use_session(db) as db:
+            testsets = [dict(row._mapping) for row in await db.execute(query)]
+            return to_page(testsets, limit, lambda testset: testset["id"])
+    except Exception as e:
+        logger.error(f"Error getting project tests: {traceback.format_exc()}")
+        return Page()
+
+
+async def get_testset(testset_id: int, db: AsyncSession = None) -> dict:
+    """
+    Summary of one testset like in get_project_testsets, False if it doesn't exist
+    """
+    try:
+        async with use_session(db) as db:
+            testset = (await db.execute(testset_summary_query().where(TestSet.id == testset_id))).first()
+            return dict(testset._mapping) if testset else False
+    except Exception as e:
+        logger.error(f"Error getting testset: {traceback.format_exc()}")
+        return False
+
+
+async def _next_position(db, testset_id: int) -> int:
+    """
+    Locks the row of the testset, so one transaction at a time hands out positions, and returns its next free position
+    """
+    if await db.scalar(lock_testset_query(testset_id)) is None:
+        raise ValueError(f"Testset {testset_id} not found")
+    return await db.scalar(next_position_query(testset_id))
+
+
+async def _insert_rows(db, testset_id: int, position: int, cases: List[dict]) -> int:
+    # one executemany, which SQLAlchemy turns into multi-row INSERT statements
+    rows = position_rows(testset_id, position, cases)
+    if rows:
+        await db.execute(insert(TestCase), rows)
+    return len(rows)
+
+
+async def _insert_cases(db, testset_id: int, cases: List[dict]) -> int:
+    """
+    Appends cases (columns from case_row) to the testset
+    """
+    return await _insert_rows(db, testset_id, await _next_position(db, testset_id), cases)
+
+
+async def create_testset(testset_data: dict, db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            cases = [case_row(case) for case in testset_data.pop("tests", None) or []]
+            testset = TestSet(**testset_data)
+            db.add(testset)
+            await db.flush()
+            if cases:
+                await _insert_cases(db, testset.id, cases)
+            return True
+    except Exception as e:
+        logger.error(f"Error creating testset: {traceback.format_exc()}")
+        return False
+
+
+async def add_test_to_testset(testset_id: int, test_prompt, meta: dict = None, db: AsyncSession = None) -> bool:
+    """
+    Creates a new test inside existing testset
+    """
+    try:
+        async with use_session(db, savepoint=True) as db:
+            await _insert_cases(db, testset_id, [case_row({"prompt": test_prompt, "meta": meta})])
+            return True
+    except Exception as e:
+        logger.error(f"Error adding test to testset: {traceback.format_exc()}")
+        return False
+
+
+async def add_test_cases(testset_id: int, cases: list, db: AsyncSession = None) -> int:
+    """
+    Appends many cases to the testset, each a prompt string or a dict with prompt and meta. Returns how many were added.
+    Raises ValueError for an invalid case or a missing testset, nothing is added then
+    """
+    rows = []
+    for index, case in enumerate(cases):
+        try:
+            rows.append(case_row(case))
+        except ValueError as e:
+            raise ValueError(f"Test {index}: {e}")
+    async with use_session(db) as db:
+        return await _insert_cases(db, testset_id, rows)
+
+
+async def import_test_cases(testset_id: int, records, chunk_size: int = 2000, max_errors: int = 100, db: AsyncSession = None) -> dict:
+    """
+    Appends the cases of an upload while it is parsed. records is an async iterator of (line, case, error) from the parsers
+    of app.utils.test_import; valid cases are inserted chunk_size at a time in the transaction of the session, invalid ones
+    are skipped. Returns how many cases were added and failed, with the first max_errors errors and their lines.
+    Raises ValueError for a missing testset or a body that can't be read
+    """
+    added, failed, errors, chunk = 0, 0, [], []
+    async with use_session(db) as db:
+        position = await _next_position(db, testset_id)
+        async for line, case, error in records:
+            if error is None:
+                try:
+                    chunk.append(case_row(case))
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                failed += 1
+                if len(errors) < max_errors:
+                    errors.append({"line": line, "error": error})
+                continue
+            if len(chunk) >= chunk_size:
+                added += await _insert_rows(db, testset_id, position + added, chunk)
+                chunk = []
+        added += await _insert_rows(db, testset_id, position + added, chunk)
+    return {"added": added, "failed": failed, "errors": errors}
+
+
+async def get_test_cases(testset_id: int, cursor: str = None, limit: int = None, db: AsyncSession = None) -> Page:
+    """
+    Cases of the testset in their order
+    """
+    try:
+        async with use_session(db) as db:
+            return cases_page(await db.scalars(testset_cases_query(testset_id, cursor, limit)), limit)
+    except Exception as e:
+        logger.error(f"Error getting test cases: {traceback.format_exc()}")
+        return Page()
+
+
+async def stream_test_cases(testset_id: int, page_size: int = 100):
+    """
+    All cases of a testset in their order as pages of page_size, each page read with a session of its own.
+    Unlike get_test_cases it raises on errors, so a failed read can't be taken for the end of the testset
+    """
+    cursor = None
+    while True:
+        async with use_session() as db:
+            page = cases_page(await db.scalars(testset_cases_query(testset_id, cursor, page_size)), page_size)
+        if page:
+            yield page
+        if page.next_cursor is None:
+            return
+        cursor = page.next_cursor
+
+
+async def count_test_cases(testset_id: int, db: AsyncSession = None) -> int:
+    try:
+        async with use_session(db) as db:
+            return await db.scalar(select(func.count()).select_from(TestCase).where(TestCase.testset_id == testset_id))
+    except Exception as e:
+        logger.error(f"Error counting test cases: {traceback.format_exc()}")
+        return 0
+
+
+async def delete_test_from_testset(testset_id: int, test_id: int, db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            result = await db.execute(delete(TestCase).where(TestCase.id == test_id, TestCase.testset_id == testset_id))
+            return result.rowcount > 0
+    except Exception as e:
+        logger.error(f"Error deleting test from testset: {traceback.format_exc()}")
+        return False
+
+
+async def delete_testset(testset_id: int, db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            testset = await db.scalar(select(TestSet).where(TestSet.id == testset_id))
+            if not testset:
+                return False
+            await db.delete(testset)
+            await db.flush()
+            ownership_cache.delete(("testset", testset_id))
+            return True
+    except Exception as e:
+        logger.error(f"Error deleting testset: {traceback.format_exc()}")
+        return False
+
+
+# ------ Action functions ------
+
+async def log_action(project_id: int, name: str, type: str, db: AsyncSession = None):
+    try:
+        async with use_session(db, savepoint=True) as db:
+            action = Action(project_id=int(project_id) if project_id is not None else None, name=name, type=type)
+            db.add(action)
+            await db.flush()
+            await db.refresh(action)
+            return action.to_dict()
+    except Exception as e:
+        logger.error(f"Error logging action: {traceback.format_exc()}")
+        return False
+
+
+async def get_project_actions(project_id: int, cursor: str = None, limit: int = 20, db: AsyncSession = None) -> Page:
+    """
+    Actions of the project, newest first
+    """
+    try:
+        query = keyset(select(Action).where(Action.project_id == int(project_id)), Action.id, cursor, limit, descending=True)
+        async with use_session(db) as db:
+            actions = await db.scalars(query)
+            return to_page([action.to_dict() for action in actions], limit, lambda action: action["id"])
+    except Exception as e:
+        logger.error(f"Error getting project actions: {traceback.format_exc()}")
+        return Page()
+
+
+# ------ LLM cache functions ------
+
+async def get_llm_cache_entry(key: str, db: AsyncSession = None) -> dict:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            result = await db.execute(
+                update(LLMCacheEntry)
+                .where(LLMCacheEntry.key == key, LLMCacheEntry.expires_at > datetime.utcnow())
+                .values(hits=LLMCacheEntry.hits + 1)
+                .returning(LLMCacheEntry.response)
+            )
+            response = result.scalar()
+            await db.flush()
+            return response if response else False
+    except Exception as e:
+        logger.error(f"Error getting llm cache entry: {traceback.format_exc()}")
+        return False
+
+
+async def set_llm_cache_entry(key: str, model: str, response: dict, ttl_seconds: int, db: AsyncSession = None) -> bool:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            await db.merge(LLMCacheEntry(key=key, model=model, response=response, expires_at=datetime.utcnow() + timedelta(seconds=ttl_seconds), hits=0))
+            await db.flush()
+            return True
+    except Exception as e:
+        logger.error(f"Error setting llm cache entry: {traceback.format_exc()}")
+        return False
+
+
+async def delete_expired_llm_cache_entries(db: AsyncSession = None) -> int:
+    try:
+        async with use_session(db, savepoint=True) as db:
+            result = await db.execute(delete(LLMCacheEntry).where(LLMCacheEntry.expires_at <= datetime.utcnow()))
+            return result.rowcount
+    except Exception as e:
+        logger.error(f"Error deleting expired llm cache entries: {traceback.format_exc()}")
+        return 0
@@ -5,15 +5,29 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from datetime import datetime, timedelta
 from app.db.session import get_db_session
-from app.db.models import User, Project, Prompt, PromptVersion, Run, TestSet, Action
+from app.db.models import User, Project, Prompt, PromptVersion, Run, RunResult, TestSet, TestCase, Action, LLMCacheEntry
 import loguru
 import traceback
 from app.utils.auth import hash_password
+from app.utils.cache import TTLCache
+from app.db.version_storage import store_text, cache_text, reencode, detach, chain_query, missing_snapshots, rebuild_texts
+from app.db.pagination import Page, keyset, to_page
+from app.settings import settings
+from sqlalchemy import func, inspect, update, select, insert
+from sqlalchemy.orm import defer
 from sqlalchemy.orm.attributes import flag_modified
+from collections import Counter
 
 
 logger = loguru.logger
 
+# Users by email, shared by the auth middleware of all requests. Every function that changes a user drops its entry
+user_cache = TTLCache(max_size=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL_SECONDS)
+
+# Granted accesses, (kind, object id) -> (owner user id, project id). Deleting or changing a project clears it,
+# deleting a prompt or a testset drops its entry
+ownership_cache = TTLCache(max_size=settings.OWNERSHIP_CACHE_SIZE, ttl=settings.OWNERSHIP_CACHE_TTL_SECONDS)
+
 def get_user(user_id: int) -> dict:
     try:
         with get_db_session() as db:
@@ -78,6 +92,7 @@ def set_user_keys(email: str, keys: dict) -> bool:
             user.keys = keys
             db.add(user)
             db.commit()
+            user_cache.delete(email)
             return True
     except Exception as e:
         logger.error(f"Error setting user keys: {traceback.format_exc()}")
@@ -96,14 +111,18 @@ def set_user(user_data: dict) -> bool:
                 user = User(**user_data)
                 db.add(user)
                 db.commit()
+                user_cache.delete(user.email)
                 return True
 
+            old_email = user.email
             for key, value in user_data.items():
                 if hasattr(user, key):
                     setattr(user, key, value)
 
             db.add(user)
             db.commit()
+            user_cache.delete(old_email)
+            user_cache.delete(user.email)
             return True
     except Exception as e:
         logger.error(f"Error setting user: {traceback.format_exc()}")
@@ -134,6 +153,19 @@ def get_user_by_email(email: str) -> dict:
         logger.error(f"Error finding user by email: {traceback.format_exc()}")
         return False
 
+
+def get_cached_user_by_email(email: str) -> dict:
+    """
+    Same as get_user_by_email, but served from user_cache when possible. Returns a copy, so callers may change it
+    """
+    user = user_cache.get(email)
+    if user is None:
+        user = get_user_by_email(email)
+        if not user:
+            return False
+        user_cache.set(email, user)
+    return dict(user)
+
 def delete_user(user_id: int) -> bool:
     try:
         with get_db_session() as db:
@@ -142,6 +174,7 @@ def delete_user(user_id: int) -> bool:
                 return False
             db.delete(user)
             db.commit()
+            user_cache.delete(user.email)
             return True
     except Exception as e:
         logger.error(f"Error deleting user: {traceback.format_exc()}")
@@ -168,14 +201,14 @@ def get_project(project_id: int) -> dict:
         logger.error(f"Error getting project: {traceback.format_exc()}")
         return False
 
-def get_projects_by_user(user_id: int) -> List[dict]:
+def get_projects_by_user(user_id: int, cursor: str = None, limit: int = None) -> Page:
     try:
         with get_db_session() as db:
-            projects = db.query(Project).filter(Project.user_id == user_id).all()
-            return [project.to_dict() for project in projects]
+            projects = keyset(db.query(Project).filter(Project.user_id == user_id), Project.id, cursor, limit).all()
+            return to_page([project.to_dict() for project in projects], limit, lambda project: project["id"])
     except Exception as e:
         logger.error(f"Error getting projects by user: {traceback.format_exc()}")
-        return []
+        return Page()
 
 def set_project(project_data: dict) -> bool:
     try:
@@ -192,6 +225,7 @@ def set_project(project_data: dict) -> bool:
                     setattr(project, key, value)
             db.add(project)
             db.commit()
+            ownership_cache.clear()
             return True
     except Exception as e:
         logger.error(f"Error setting project: {traceback.format_exc()}")
@@ -216,19 +250,20 @@ def delete_project(project_id: int) -> bool:
                 return False
             db.delete(project)
             db.commit()
+            ownership_cache.clear()
             return True
     except Exception as e:
         logger.error(f"Error deleting project: {traceback.format_exc()}")
         return False
 
-def get_project_prompts(project_id: int) -> List[dict]:
+def get_project_prompts(project_id: int, cursor: str = None, limit: int = None) -> Page:
     try:
         with get_db_session() as db:
-            prompts = db.query(Prompt).filter(Prompt.project_id == project_id).all()
-            return [prompt.to_dict() for prompt in prompts]
+            prompts = keyset(db.query(Prompt).filter(Prompt.project_id == project_id), Prompt.id, cursor, limit).all()
+            return to_page([prompt.to_dict() for prompt in prompts], limit, lambda prompt: prompt["id"])
     except Exception as e:
         logger.error(f"Error getting project prompts: {traceback.format_exc()}")
-        return []
+        return Page()
 
 
 def get_project_prompt_versions(project_id: int, prompt_id: int) -> List[dict]:
@@ -237,14 +272,24 @@ def get_project_prompt_versions(project_id: int, prompt_id: int) -> List[dict]:
             prompt = db.query(Prompt).filter(Prompt.project_id == project_id, Prompt.id == prompt_id).first()
             if not prompt:
                 return []
-            return [version.to_dict() for version in prompt.versions]
+            return [version.to_dict() for version in _load_texts(db, list(prompt.versions))]
     except Exception as e:
         logger.error(f"Error getting project prompt versions: {traceback.format_exc()}")
         return []
 
 
 # Prompt functions
-def get_prompt(prompt_id: int, include_runs = True) -> dict:
+def get_prompt(
+    prompt_id: int,
+    include_runs = True,
+    results_limit: int = 100,
+    run_summaries: bool = False,
+    runs_limit: int = None,
+    include_text: bool = True,
+) -> dict:
+    """
+    Prompt with its versions, see async_functions.get_prompt for the options. Every level is loaded with one query
+    """
     try:
         with get_db_session() as db:
             prompt = db.query(Prompt).filter(Prompt.id == prompt_id).first()
@@ -252,20 +297,28 @@ def get_prompt(prompt_id: int, include_runs = True) -> dict:
                 return False
             prompt_dict = prompt.to_dict()
 
-            versions = db.query(PromptVersion).filter(PromptVersion.prompt_id == prompt_id).order_by(PromptVersion.version_number.asc()).all()
-            if not versions:
-                prompt_dict['versions'] = []
+            query = db.query(PromptVersion).filter(PromptVersion.prompt_id == prompt_id).order_by(PromptVersion.version_number.asc())
+            if not include_text:
+                query = query.options(defer(PromptVersion.prompt_text), defer(PromptVersion.delta))
+            versions = query.all()
+            if include_text:
+                _load_texts(db, versions)
+            prompt_dict['versions'] = [loaded_dict(version) for version in versions]
+            if not include_runs or not versions:
                 return prompt_dict
-            
-            if "versions" not in prompt_dict:
-                prompt_dict['versions'] = []
-            for version in versions:
-                version_dict = version.to_dict()
-                if include_runs:
-                    version_dict['runs'] = [run.to_dict() for run in version.runs]
-                else:
-                    del version_dict['runs']
-                prompt_dict['versions'].append(version_dict)
+
+            runs = db.scalars(versions_runs_query([version.id for version in versions], runs_limit, run_summaries)).all()
+            if run_summaries:
+                run_dicts = [loaded_dict(run) for run in runs]
+            else:
+                results = _query_runs_results(db, [run.id for run in runs], results_limit)
+                run_dicts = [with_results(run.to_dict(), results[run.id]) for run in runs]
+
+            version_runs = {version.id: [] for version in versions}
+            for run_dict in run_dicts:
+                version_runs[run_dict["prompt_version_id"]].append(run_dict)
+            for version_dict in prompt_dict['versions']:
+                version_dict['runs'] = version_runs[version_dict["id"]]
             return prompt_dict
     except Exception as e:
         logger.error(f"Error getting prompt: {traceback.format_exc()}")
@@ -312,6 +365,9 @@ def create_prompt_with_version(prompt_data: dict) -> bool:
         with get_db_session() as db:
             prompt = Prompt(**prompt_data)
             db.add(prompt)
+            db.flush()
+            if prompt.versions:
+                prompt.current_version_id = prompt.versions[-1].id
             db.commit()
             return True
     except Exception as e:
@@ -357,19 +413,21 @@ def delete_prompt(prompt_id: int) -> bool:
                 return False
             db.delete(prompt)
             db.commit()
+            ownership_cache.delete(("prompt", prompt_id))
             return True
     except Exception as e:
         logger.error(f"Error deleting prompt: {traceback.format_exc()}")
         return False
 
-def get_prompt_versions(prompt_id: int) -> List[dict]:
+def get_prompt_versions(prompt_id: int, cursor: str = None, limit: int = None) -> Page:
     try:
         with get_db_session() as db:
-            versions = db.query(PromptVersion).filter(PromptVersion.prompt_id == prompt_id).all()
-            return [version.to_dict() for version in versions]
+            query = db.query(PromptVersion).filter(PromptVersion.prompt_id == prompt_id)
+            versions = keyset(query, PromptVersion.version_number, cursor, limit).all()
+            return to_page([version.to_dict() for version in _load_texts(db, versions)], limit, lambda version: version["version_number"])
     except Exception as e:
         logger.error(f"Error getting prompt versions: {traceback.format_exc()}")
-        return []
+        return Page()
 
 # PromptVersion functions
 def get_prompt_version(version_id: int) -> dict:
@@ -378,26 +436,131 @@ def get_prompt_version(version_id: int) -> dict:
             version = db.query(PromptVersion).filter(PromptVersion.id == version_id).first()
             if not version:
                 return False
+            _load_texts(db, [version])
             return version.to_dict()
     except Exception as e:
         logger.error(f"Error getting prompt version: {traceback.format_exc()}")
         return False
 
+def latest_version_query(prompt_id: int):
+    return select(PromptVersion).join(Prompt, Prompt.current_version_id == PromptVersion.id).where(Prompt.id == int(prompt_id))
+
+
+def _load_texts(db, versions: List[PromptVersion]) -> List[PromptVersion]:
+    """
+    Rebuilds prompt_text of the versions stored as deltas, see async_functions._load_texts
+    """
+    rows = list(versions)
+    for snapshot_id in missing_snapshots(versions):
+        rows.extend(db.scalars(chain_query(snapshot_id)))
+    rebuild_texts(rows)
+    return versions
+
+
+def dependents_query(version_id: int):
+    return select(PromptVersion).where(PromptVersion.base_version_id == version_id)
+
+
+def _dependents(db, version: PromptVersion) -> List[PromptVersion]:
+    """
+    Versions stored as a delta against version, with their texts
+    """
+    dependents = db.scalars(dependents_query(version.id)).all()
+    _load_texts(db, dependents + [version])
+    return dependents
+
+
+def _delta_base(db, version: PromptVersion) -> PromptVersion:
+    base = db.get(PromptVersion, version.base_version_id) if version.delta is not None else None
+    if base is not None:
+        _load_texts(db, [base])
+    return base
+
+
+def _set_version_text(db, version: PromptVersion, text: str):
+    """
+    Changes the text of an existing version, the deltas based on it are rewritten against the new text
+    """
+    _load_texts(db, [version])
+    if version.prompt_text == text:
+        return
+    dependents = _dependents(db, version)
+    reencode(version, text, _delta_base(db, version))
+    for dependent in dependents:
+        reencode(dependent, dependent.prompt_text, version)
+
+
+def claim_version_number_query(prompt_id: int):
+    return (
+        update(Prompt)
+        .where(Prompt.id == prompt_id)
+        .values(latest_version_number=func.coalesce(Prompt.latest_version_number, 0) + 1)
+        .returning(Prompt.latest_version_number, Prompt.current_version_id)
+    )
+
+
+def _add_version(db, version_data: dict) -> PromptVersion:
+    """
+    Adds a version with the next number of its prompt and makes it the current one. Claiming the number locks
+    the row of the prompt until the transaction ends, so concurrent saves get consecutive numbers.
+    The number is written to version_data
+    """
+    prompt_id = int(version_data["prompt_id"])
+    claimed = db.execute(claim_version_number_query(prompt_id)).first()
+    if claimed is None:
+        raise ValueError(f"Prompt {prompt_id} not found")
+    version_data["version_number"], base_id = claimed
+
+    # the version is stored against the one it was saved over
+    base = db.get(PromptVersion, base_id) if base_id else None
+    if base is not None:
+        _load_texts(db, [base])
+    text = version_data.get("prompt_text")
+    version = PromptVersion(**version_data)
+    store_text(version, text, base)
+    db.add(version)
+    db.flush()
+    cache_text(version, text)
+    db.execute(update(Prompt).where(Prompt.id == prompt_id).values(current_version_id=version.id))
+    return version
+
+
+def get_latest_prompt_version(prompt_id: int) -> dict:
+    try:
+        with get_db_session() as db:
+            version = db.scalars(latest_version_query(prompt_id)).first()
+            if not version:
+                return False
+            _load_texts(db, [version])
+            return version.to_dict()
+    except Exception as e:
+        logger.error(f"Error getting latest prompt version: {traceback.format_exc()}")
+        return False
+
 def get_prompt_versions_by_prompt(prompt_id: int) -> List[dict]:
     try:
         with get_db_session() as db:
-            versions = db.query(PromptVersion).filter(PromptVersion.prompt_id == prompt_id).all()
-            return [version.to_dict() for version in versions]
+            versions = db.query(PromptVersion).filter(PromptVersion.prompt_id == prompt_id).order_by(PromptVersion.version_number.asc()).all()
+            return [version.to_dict() for version in _load_texts(db, versions)]
     except Exception as e:
         logger.error(f"Error getting prompt versions by prompt: {traceback.format_exc()}")
         return []
 
 
+def get_prompt_versions_by_numbers(prompt_id: int, version_numbers: List[int]) -> Dict[int, dict]:
+    try:
+        with get_db_session() as db:
+            versions = db.query(PromptVersion).filter(PromptVersion.prompt_id == prompt_id, PromptVersion.version_number.in_(version_numbers)).all()
+            return {version.version_number: version.to_dict() for version in _load_texts(db, versions)}
+    except Exception as e:
+        logger.error(f"Error getting prompt versions by numbers: {traceback.format_exc()}")
+        return {}
+
+
 def create_prompt_version(version_data: dict) -> bool:
     try:
         with get_db_session() as db:
-            version = PromptVersion(**version_data)
-            db.add(version)
+            _add_version(db, version_data)
             db.commit()
 
             log_action(version_data.get("project_id"), f"New prompt version {version_data.get('version_number')} created", "new")
@@ -415,13 +578,12 @@ def set_prompt_version(version_data: dict, latest_version: bool = True) -> bool:
         logger.debug(f"Setting prompt version: {version_id}")
         with get_db_session() as db:
             if latest_version:
-                version = db.query(PromptVersion).filter(PromptVersion.prompt_id == version_data.get("prompt_id")).order_by(PromptVersion.version_number.desc()).first()
+                version = db.scalars(latest_version_query(version_data.get("prompt_id"))).first()
             else:
                 version = db.query(PromptVersion).filter(PromptVersion.id == version_id).first() if version_id else None
             if not version:
                 logger.debug(f"Creating new prompt version: {version_data}")
-                version = PromptVersion(**version_data)
-                db.add(version)
+                _add_version(db, version_data)
                 db.commit()
 
                 log_action(version_data.get("project_id"), f"New prompt version {version_data.get('version_number')} created", "new")
@@ -429,7 +591,9 @@ def set_prompt_version(version_data: dict, latest_version: bool = True) -> bool:
                 return True
             logger.debug(f"Updating existing prompt version: {version_data}")
             for key, value in version_data.items():
-                if hasattr(version, key):
+                if key == "prompt_text":
+                    _set_version_text(db, version, value)
+                elif hasattr(version, key) and key not in PromptVersion.STORAGE_COLUMNS:
                     setattr(version, key, value)
             db.add(version)
             db.commit()
@@ -458,21 +622,35 @@ def delete_prompt_version(version_id: int) -> bool:
             version = db.query(PromptVersion).filter(PromptVersion.id == version_id).first()
             if not version:
                 return False
+            prompt_id = version.prompt_id
+            # the versions stored against this one are rewritten first
+            dependents = _dependents(db, version)
+            chain = db.scalars(chain_query(version.id)).all() if version.delta is None else []
+            detach(version, dependents, chain, _delta_base(db, version))
             db.delete(version)
+            db.flush()
+            # the current version moves back to the newest one left
+            latest = db.query(PromptVersion.id).filter(PromptVersion.prompt_id == prompt_id).order_by(PromptVersion.version_number.desc()).limit(1).scalar_subquery()
+            db.query(Prompt).filter(Prompt.id == prompt_id, Prompt.current_version_id == version_id).update(
+                {Prompt.current_version_id: latest}, synchronize_session=False
+            )
             db.commit()
             return True
     except Exception as e:
         logger.error(f"Error deleting prompt version: {traceback.format_exc()}")
         return False
 
-def get_version_runs(version_id: int) -> List[dict]:
+def get_version_runs(version_id: int, cursor: str = None, limit: int = None) -> Page:
+    """
+    Runs of the version, newest first
+    """
     try:
         with get_db_session() as db:
-            runs = db.query(Run).filter(Run.prompt_version_id == version_id).all()
-            return [run.to_dict() for run in runs]
+            runs = keyset(db.query(Run).filter(Run.prompt_version_id == version_id), Run.id, cursor, limit, descending=True).all()
+            return to_page([run.to_dict() for run in runs], limit, lambda run: run["id"])
     except Exception as e:
         logger.error(f"Error getting version runs: {traceback.format_exc()}")
-        return []
+        return Page()
 
 # Run functions
 def get_run(run_id: int) -> dict:
@@ -486,14 +664,18 @@ def get_run(run_id: int) -> dict:
         logger.error(f"Error getting run: {traceback.format_exc()}")
         return False
 
-def get_runs_by_user(user_id: int) -> List[dict]:
+def get_runs_by_user(user_id: int, cursor: str = None, limit: int = None) -> Page:
+    """
+    Runs started by the user, newest first
+    """
     try:
         with get_db_session() as db:
-            runs = db.query(Run).filter(Run.user_id == user_id).all()
-            return [run.to_dict() for run in runs]
+            query = db.query(Run).join(User, User.email == Run.email).filter(User.id == user_id)
+            runs = keyset(query, Run.id, cursor, limit, descending=True).all()
+            return to_page([run.to_dict() for run in runs], limit, lambda run: run["id"])
     except Exception as e:
         logger.error(f"Error getting runs by user: {traceback.format_exc()}")
-        return []
+        return Page()
 
 def get_runs_by_prompt_version(version_id: int) -> List[dict]:
     try:
@@ -549,72 +731,165 @@ def delete_run(run_id: int) -> bool:
         return False
 
 
-def get_project_testsets(project_id: int) -> List[dict]:
+def testset_summary_query():
+    """
+    Testsets without their cases, with the number of cases instead. The count reads the index of the cases
+    """
+    case_count = (
+        select(func.count()).select_from(TestCase).where(TestCase.testset_id == TestSet.id)
+        .correlate(TestSet).scalar_subquery().label("case_count")
+    )
+    return select(TestSet.id, TestSet.name, TestSet.created_at, TestSet.project_id, case_count)
+
+
+def get_project_testsets(project_id: int, cursor: str = None, limit: int = None) -> Page:
+    """
+    Summaries of the testsets of the project, their cases are read with get_test_cases
+    """
     try:
         with get_db_session() as db:
-            testsets = db.query(TestSet).filter(TestSet.project_id == project_id).all()
-            result = [testset.to_dict() for testset in testsets]
-            logger.debug(f"Testsets: {result}")
-            return result
+            query = keyset(testset_summary_query().where(TestSet.project_id == project_id), TestSet.id, cursor, limit)
+            testsets = [dict(row._mapping) for row in db.execute(query)]
+            return to_page(testsets, limit, lambda testset: testset["id"])
     except Exception as e:
         logger.error(f"Error getting project tests: {traceback.format_exc()}")
-        return []
+        return Page()
+
+
+def get_testset(testset_id: int) -> dict:
+    try:
+        with get_db_session() as db:
+            testset = db.execute(testset_summary_query().where(TestSet.id == testset_id)).first()
+            return dict(testset._mapping) if testset else False
+    except Exception as e:
+        logger.error(f"Error getting testset: {traceback.format_exc()}")
+        return False
 
 
 def get_tests_from_testset(testset_id: int) -> List[dict]:
     try:
         with get_db_session() as db:
-            testset = db.query(TestSet).filter(TestSet.id == testset_id).first()
-            if not testset:
-                return []
-            return testset.tests
+            cases = db.query(TestCase).filter(TestCase.testset_id == testset_id).order_by(TestCase.position.asc()).all()
+            return [case.to_dict() for case in cases]
     except Exception as e:
         logger.error(f"Error getting tests from testset: {traceback.format_exc()}")
         return []
-    
+
+
+def case_row(case) -> dict:
+    """
+    Columns of a new case from a prompt string or a dict with prompt and optional meta
+    """
+    if isinstance(case, str):
+        case = {"prompt": case}
+    if not isinstance(case, dict) or not isinstance(case.get("prompt"), str) or not case["prompt"]:
+        raise ValueError("A test case needs a non-empty prompt")
+    meta = case.get("meta")
+    if meta is not None and not isinstance(meta, dict):
+        raise ValueError("meta of a test case has to be an object")
+    return {"prompt": case["prompt"], "meta": meta}
+
+
+def lock_testset_query(testset_id: int):
+    # locks the row of the testset, so one transaction at a time hands out positions
+    return select(TestSet.id).where(TestSet.id == testset_id).with_for_update()
+
+
+def next_position_query(testset_id: int):
+    return select(func.coalesce(func.max(TestCase.position), -1) + 1).where(TestCase.testset_id == testset_id)
+
+
+def position_rows(testset_id: int, position: int, cases: List[dict]) -> List[dict]:
+    return [dict(case, testset_id=testset_id, position=position + offset) for offset, case in enumerate(cases)]
+
+
+def _insert_cases(db, testset_id: int, cases: List[dict]) -> int:
+    """
+    Appends cases (columns from case_row) to the testset
+    """
+    if db.scalar(lock_testset_query(testset_id)) is None:
+        raise ValueError(f"Testset {testset_id} not found")
+    rows = position_rows(testset_id, db.scalar(next_position_query(testset_id)), cases)
+    if rows:
+        db.execute(insert(TestCase), rows)
+    return len(rows)
+
+
 def create_testset(testset_data: dict) -> bool:
     try:
         with get_db_session() as db:
+            cases = [case_row(case) for case in testset_data.pop("tests", None) or []]
             testset = TestSet(**testset_data)
             db.add(testset)
+            db.flush()
+            if cases:
+                _insert_cases(db, testset.id, cases)
             db.commit()
             return True
     except Exception as e:
         logger.error(f"Error creating testset: {traceback.format_exc()}")
         return False
-    
-def add_test_to_testset(testset_id: int, test_prompt) -> bool:
+
+
+def add_test_to_testset(testset_id: int, test_prompt, meta: dict = None) -> bool:
     """
     Creates a new test inside existing testset
     """
     try:
         with get_db_session() as db:
-            testset = db.query(TestSet).filter(TestSet.id == testset_id).first()
-            if not testset:
-                return False
-            if testset.tests is None:
-                testset.tests = []
-            logger.debug(f"Testset tests before adding new one {testset.tests}")
-            testset.tests.append({"prompt": test_prompt, "id": len(testset.tests)})
-            flag_modified(testset, "tests")
+            _insert_cases(db, testset_id, [case_row({"prompt": test_prompt, "meta": meta})])
             db.commit()
-            logger.debug(f"Testset after adding test: {testset.to_dict()}")
             return True
     except Exception as e:
         logger.error(f"Error adding test to testset: {traceback.format_exc()}")
         return False
-    
+
+
+def add_test_cases(testset_id: int, cases: list) -> int:
+    """
+    Appends many cases to the testset, see async_functions.add_test_cases
+    """
+    rows = []
+    for index, case in enumerate(cases):
+        try:
+            rows.append(case_row(case))
+        except ValueError as e:
+            raise ValueError(f"Test {index}: {e}")
+    with get_db_session() as db:
+        added = _insert_cases(db, testset_id, rows)
+        db.commit()
+        return added
+
+
+def testset_cases_query(testset_id: int, cursor: str = None, limit: int = None):
+    """
+    Cases of a testset in their order, the page after cursor (see keyset)
+    """
+    return keyset(select(TestCase).where(TestCase.testset_id == testset_id), TestCase.position, cursor, limit)
+
+
+def cases_page(cases, limit: int = None) -> Page:
+    return to_page([case.to_dict() for case in cases], limit, lambda case: case["position"])
+
+
+def get_test_cases(testset_id: int, cursor: str = None, limit: int = None) -> Page:
+    """
+    Cases of the testset in their order
+    """
+    try:
+        with get_db_session() as db:
+            return cases_page(db.scalars(testset_cases_query(testset_id, cursor, limit)), limit)
+    except Exception as e:
+        logger.error(f"Error getting test cases: {traceback.format_exc()}")
+        return Page()
+
 
 def delete_test_from_testset(testset_id: int, test_id: int) -> bool:
     try:
         with get_db_session() as db:
-            testset = db.query(TestSet).filter(TestSet.id == testset_id).first()
-            if not testset:
-                return False
-            testset.tests = [i for i in testset.tests if i["id"] != test_id]
-            flag_modified(testset, "tests")
+            deleted = db.query(TestCase).filter(TestCase.id == test_id, TestCase.testset_id == testset_id).delete(synchronize_session=False)
             db.commit()
-            return True
+            return deleted > 0
     except Exception as e:
         logger.error(f"Error deleting test from testset: {traceback.format_exc()}")
         return False
@@ -627,6 +902,7 @@ def delete_testset(testset_id: int) -> bool:
                 return False
             db.delete(testset)
             db.commit()
+            ownership_cache.delete(("testset", testset_id))
             return True
     except Exception as e:
         logger.error(f"Error deleting testset: {traceback.format_exc()}")
@@ -666,34 +942,169 @@ def update_run(run_id, **run_data):
         return False
 
 
-def update_run_result(run_id, new_result_object):
+def add_run_result(run_id, test_index, output=None, error=None, latency_ms=None, prompt_tokens=None, completion_tokens=None, cost=None, cached=False, test_id=None):
+    """
+    Stores the result of a single test with a plain insert and bumps the progress counter of the run in SQL,
+    so the runs row is never read or rewritten as a whole
+    """
+    try:
+        with get_db_session() as db:
+            db.add(RunResult(
+                run_id=run_id,
+                test_index=test_index,
+                test_id=test_id,
+                output=output,
+                error=error,
+                latency_ms=latency_ms,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                cost=cost,
+                cached=cached,
+            ))
+            db.query(Run).filter(Run.id == run_id).update({Run.current_test: Run.current_test + 1}, synchronize_session=False)
+            db.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Error adding run result: {traceback.format_exc()}")
+        return False
+
+
+def flush_run_results(results: List[dict]) -> bool:
+    """
+    Writes a batch of buffered results (possibly of several runs) in one transaction:
+    one multi-row insert plus one counter update per run
+    """
+    try:
+        with get_db_session() as db:
+            db.bulk_insert_mappings(RunResult, results)
+            for run_id, count in Counter(result["run_id"] for result in results).items():
+                db.query(Run).filter(Run.id == run_id).update({Run.current_test: Run.current_test + count}, synchronize_session=False)
+            db.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Error flushing run results: {traceback.format_exc()}")
+        return False
+
+
+def loaded_dict(obj) -> dict:
+    """
+    to_dict() without the deferred columns that were not loaded, reading them would be a lazy load
+    """
+    unloaded = inspect(obj).unloaded | set(getattr(obj, "STORAGE_COLUMNS", ()))
+    return {c.name: getattr(obj, c.name) for c in obj.__table__.columns if c.name not in unloaded}
+
+
+def with_results(run_dict: dict, results: List[dict]) -> dict:
+    """
+    Adds a page of results to the serialized run. The legacy "result" map ({test index: output}) is
+    built from the same page for clients that read it; runs stored before run_results existed keep their JSON
+    """
+    run_dict["results"] = results
+    if results or not run_dict.get("result"):
+        run_dict["result"] = {
+            str(result["test_index"]): result["output"] if result["error"] is None else f"Error: {result['error']}"
+            for result in results
+        }
+    return run_dict
+
+
+def run_results_query(run_id: int, cursor: str = None, limit: int = None):
+    """
+    Results of a run in the order of their tests, the page after cursor (see keyset)
+    """
+    return keyset(select(RunResult).where(RunResult.run_id == run_id), RunResult.test_index, cursor, limit)
+
+
+def results_page(results, limit: int = None) -> Page:
+    return to_page([result.to_dict() for result in results], limit, lambda result: result["test_index"])
+
+
+def _query_run_results(db, run_id, cursor=None, limit=None) -> Page:
+    return results_page(db.scalars(run_results_query(run_id, cursor, limit)), limit)
+
+
+def _run_with_results(db, run, cursor=None, limit=100) -> dict:
+    return with_results(run.to_dict(), _query_run_results(db, run.id, cursor, limit))
+
+
+def versions_runs_query(version_ids: List[int], runs_limit: int = None, summaries: bool = False):
+    """
+    Runs of all versions in one query, the last runs_limit runs of every version when given
+    """
+    query = select(Run).where(Run.prompt_version_id.in_(version_ids)).order_by(Run.id.asc())
+    if summaries:
+        query = query.options(defer(Run.result))
+    if runs_limit:
+        rank = func.row_number().over(partition_by=Run.prompt_version_id, order_by=Run.id.desc()).label("rank")
+        ranked = select(Run.id, rank).where(Run.prompt_version_id.in_(version_ids)).subquery()
+        query = query.join(ranked, ranked.c.id == Run.id).where(ranked.c.rank <= runs_limit)
+    return query
+
+
+def runs_results_query(run_ids: List[int], limit: int = 100):
+    """
+    First limit results of every run in one query
+    """
+    rank = func.row_number().over(partition_by=RunResult.run_id, order_by=RunResult.test_index.asc()).label("rank")
+    ranked = select(RunResult.id, rank).where(RunResult.run_id.in_(run_ids)).subquery()
+    return (
+        select(RunResult)
+        .join(ranked, ranked.c.id == RunResult.id)
+        .where(ranked.c.rank <= limit)
+        .order_by(RunResult.run_id.asc(), RunResult.test_index.asc())
+    )
+
+
+def group_results(run_ids: List[int], results) -> Dict[int, List[dict]]:
+    """
+    Serialized results by run, runs without results get an empty list
+    """
+    grouped = {run_id: [] for run_id in run_ids}
+    for result in results:
+        grouped[result.run_id].append(result.to_dict())
+    return grouped
+
+
+def _query_runs_results(db, run_ids: List[int], limit: int = 100) -> Dict[int, List[dict]]:
+    if not run_ids:
+        return {}
+    return group_results(run_ids, db.scalars(runs_results_query(run_ids, limit)))
+
+
+def get_run_results(run_id: int, cursor: str = None, limit: int = None) -> Page:
+    """
+    Results of the run in the order of their tests
+    """
+    try:
+        with get_db_session() as db:
+            return _query_run_results(db, run_id, cursor, limit)
+    except Exception as e:
+        logger.error(f"Error getting run results: {traceback.format_exc()}")
+        return Page()
+
+
+def get_run_with_results(run_id: int, cursor: str = None, limit: int = 100) -> dict:
     try:
         with get_db_session() as db:
             run = db.query(Run).filter(Run.id == run_id).first()
             if not run:
                 return False
-            # logger.debug(f"Run result before update: {run.result}")
-            result = run.result
-            result[len(result)] = new_result_object
-            run.result = result
-            # logger.debug(f"Run result after update: {run.result}")
-            run.current_test += 1
-            # logger.debug(f"Run current test after update: {run.current_test}")
-            flag_modified(run, "current_test")
-            flag_modified(run, "result")
-            db.commit()
-            # logger.debug(f"Run result updated: {run.to_dict()}")
-            return True
+            return _run_with_results(db, run, cursor, limit)
     except Exception as e:
-        logger.error(f"Error updating run result: {traceback.format_exc()}")
+        logger.error(f"Error getting run with results: {traceback.format_exc()}")
         return False
 
 
-def check_run(prompt_version_id: int) -> dict:
+def check_run(prompt_version_id: int, cursor: str = None, limit: int = 100) -> dict:
+    """
+    Returns the latest run of the prompt version with one page of its results, their next_cursor continues them
+    """
     try:
         with get_db_session() as db:
-            run = db.query(Run).filter(Run.prompt_version_id == prompt_version_id).first()
-            return run.to_dict()
+            run = db.query(Run).filter(Run.prompt_version_id == prompt_version_id).order_by(Run.id.desc()).first()
+            if not run:
+                return False
+            return _run_with_results(db, run, cursor, limit)
     except Exception as e:
         logger.error(f"Error checking run: {traceback.format_exc()}")
 
@@ -710,11 +1121,53 @@ def log_action(project_id: int, name: str, type: str):
         return False
 
 
-def get_project_actions(project_id: int, limit: int = 20) -> List[dict]:
+def get_project_actions(project_id: int, cursor: str = None, limit: int = 20) -> Page:
+    """
+    Actions of the project, newest first
+    """
     try:
         with get_db_session() as db:
-            actions = db.query(Action).filter(Action.project_id == project_id).order_by(Action.timestamp.desc()).limit(limit).all()
-            return [action.to_dict() for action in actions]
+            actions = keyset(db.query(Action).filter(Action.project_id == project_id), Action.id, cursor, limit, descending=True).all()
+            return to_page([action.to_dict() for action in actions], limit, lambda action: action["id"])
     except Exception as e:
         logger.error(f"Error getting project actions: {traceback.format_exc()}")
-        return []
\ No newline at end of file
+        return Page()
+
+
+# ------ LLM cache functions ------
+
+def get_llm_cache_entry(key: str) -> dict:
+    try:
+        with get_db_session() as db:
+            entry = db.query(LLMCacheEntry).filter(LLMCacheEntry.key == key, LLMCacheEntry.expires_at > datetime.utcnow()).first()
+            if not entry:
+                return False
+            entry.hits += 1
+            db.commit()
+            return entry.response
+    except Exception as e:
+        logger.error(f"Error getting llm cache entry: {traceback.format_exc()}")
+        return False
+
+
+def set_llm_cache_entry(key: str, model: str, response: dict, ttl_seconds: int) -> bool:
+    try:
+        with get_db_session() as db:
+            entry = LLMCacheEntry(key=key, model=model, response=response, expires_at=datetime.utcnow() + timedelta(seconds=ttl_seconds), hits=0)
+            db.merge(entry)
+            db.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Error setting llm cache entry: {traceback.format_exc()}")
+        return False
+
+
+def delete_expired_llm_cache_entries() -> int:
+    try:
+        with get_db_session() as db:
+            deleted = db.query(LLMCacheEntry).filter(LLMCacheEntry.expires_at <= datetime.utcnow()).delete(synchronize_session=False)
+            db.commit()
+            return deleted
+    except Exception as e:
+        logger.error(f"Error deleting expired llm cache entries: {traceback.format_exc()}")
+        return 0
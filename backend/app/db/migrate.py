@@ -0,0 +1,114 @@
+"""
+Versioned schema migrations. Applied versions are recorded in the schema_migrations table, pending migrations from
+app.db.migrations are applied in order, each in its own transaction. Workers that start at the same time
+wait for each other on a Postgres advisory lock.
+
+Usage (from backend/): python -m app.db.migrate [upgrade|status|explain]
+"""
+import importlib
+import pkgutil
+import sys
+from typing import List
+import loguru
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, select, insert, func
+from app.db import migrations
+from app.db.session import engine
+
+logger = loguru.logger
+
+MIGRATIONS_LOCK_ID = 4171203
+
+metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime, default=func.now()),
+)
+
+
+def discover_migrations() -> list:
+    """
+    (version, name, module) of every migration, ordered by version
+    """
+    found = []
+    for module in pkgutil.iter_modules(migrations.__path__):
+        version = int(module.name[1:].split("_")[0])
+        found.append((version, module.name, importlib.import_module(f"{migrations.__name__}.{module.name}")))
+    return sorted(found, key=lambda migration: migration[0])
+
+
+def get_applied_versions(connection) -> set:
+    metadata.create_all(bind=connection)
+    versions = set(connection.scalars(select(schema_migrations.c.version)))
+    connection.commit()
+    return versions
+
+
+def _lock(connection, locked: bool):
+    if connection.dialect.name != "postgresql":
+        return
+    function = "pg_advisory_lock" if locked else "pg_advisory_unlock"
+    connection.execute(select(getattr(func, function)(MIGRATIONS_LOCK_ID)))
+    connection.commit()
+
+
+def run_migrations(bind=engine) -> List[str]:
+    """
+    Applies the pending migrations, returns their names
+    """
+    applied_now = []
+    with bind.connect() as connection:
+        _lock(connection, True)
+        try:
+            applied = get_applied_versions(connection)
+            for version, name, module in discover_migrations():
+                if version in applied:
+                    continue
+                logger.info(f"[DB] Applying migration {name}")
+                try:
+                    module.upgrade(connection)
+                    connection.execute(insert(schema_migrations).values(version=version, name=name))
+                    connection.commit()
+                except Exception:
+                    connection.rollback()
+                    logger.error(f"[DB] Migration {name} failed")
+                    raise
+                applied_now.append(name)
+        finally:
+            _lock(connection, False)
+
+    if applied_now:
+        logger.info(f"[DB] Applied {len(applied_now)} migrations")
+    else:
+        logger.info("[DB] Schema is up to date")
+    return applied_now
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+
+    if command == "upgrade":
+        run_migrations()
+    elif command == "status":
+        with engine.connect() as connection:
+            applied = get_applied_versions(connection)
+        for version, name, _ in discover_migrations():
+            print(f"{'applied' if version in applied else 'pending':>8}  {name}")
+    elif command == "explain":
+        from app.db.query_plans import check_query_plans
+
+        with engine.connect() as connection:
+            checks = check_query_plans(connection)
+        for check in checks:
+            scans = ", ".join(check["scans"])
+            print(f"{'ok' if check['uses_index'] else 'SEQ SCAN':>8}  {check['name']}: {scans}")
+        sys.exit(0 if all(check["uses_index"] for check in checks) else 1)
+    else:
+        print(__doc__)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
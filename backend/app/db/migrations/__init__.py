@@ -0,0 +1,5 @@
+"""
+Schema migrations, applied in order by app.db.migrate. Every module is named m<version>_<name>.py and has an
+upgrade(connection) function. Migrations must be safe to run on a database created from the current models
+(IF NOT EXISTS and friends), because the first one creates all tables with create_all
+"""
@@ -0,0 +1,8 @@
+"""
+Tables of all models. Databases created before migrations existed only get the tables they are missing
+"""
+from app.db.models import Base
+
+
+def upgrade(connection):
+    Base.metadata.create_all(bind=connection)
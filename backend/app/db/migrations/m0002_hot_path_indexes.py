@@ -0,0 +1,45 @@
+"""
+Indexes on the filter and sort columns of the helpers in app.db.functions and app.db.async_functions,
+and a unique version number per prompt. Duplicated version numbers are moved to the end of the history first
+"""
+from sqlalchemy import text
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_projects_user_id ON projects (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_prompts_project_id ON prompts (project_id)",
+    "CREATE INDEX IF NOT EXISTS ix_runs_prompt_version_id ON runs (prompt_version_id)",
+    "CREATE INDEX IF NOT EXISTS ix_runs_prompt_id ON runs (prompt_id)",
+    "CREATE INDEX IF NOT EXISTS ix_runs_email ON runs (email)",
+    "CREATE INDEX IF NOT EXISTS ix_testsets_project_id ON testsets (project_id)",
+    "CREATE INDEX IF NOT EXISTS ix_actions_project_id_timestamp ON actions (project_id, timestamp)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_prompt_versions_prompt_id_version_number ON prompt_versions (prompt_id, version_number)",
+]
+
+
+def renumber_duplicate_versions(connection):
+    duplicates = connection.execute(text(
+        "SELECT id, prompt_id, version_number FROM prompt_versions "
+        "WHERE (prompt_id, version_number) IN ("
+        "SELECT prompt_id, version_number FROM prompt_versions GROUP BY prompt_id, version_number HAVING count(*) > 1"
+        ") ORDER BY prompt_id, version_number, id"
+    )).all()
+
+    kept = set()
+    for version_id, prompt_id, version_number in duplicates:
+        # the oldest row keeps the number, the others get the next free ones
+        if (prompt_id, version_number) not in kept:
+            kept.add((prompt_id, version_number))
+            continue
+        connection.execute(
+            text(
+                "UPDATE prompt_versions SET version_number = "
+                "(SELECT max(version_number) + 1 FROM prompt_versions WHERE prompt_id = :prompt_id) WHERE id = :id"
+            ),
+            {"prompt_id": prompt_id, "id": version_id},
+        )
+
+
+def upgrade(connection):
+    renumber_duplicate_versions(connection)
+    for statement in INDEXES:
+        connection.execute(text(statement))
@@ -0,0 +1,19 @@
+"""
+Pointer to the latest version of every prompt, so it is read by primary key instead of sorting the version history
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    "ALTER TABLE prompts ADD COLUMN IF NOT EXISTS current_version_id BIGINT",
+    "ALTER TABLE prompts ADD COLUMN IF NOT EXISTS latest_version_number INTEGER NOT NULL DEFAULT 0",
+    "UPDATE prompts SET "
+    "latest_version_number = COALESCE((SELECT max(version_number) FROM prompt_versions WHERE prompt_id = prompts.id), 0), "
+    "current_version_id = ("
+    "SELECT id FROM prompt_versions WHERE prompt_id = prompts.id ORDER BY version_number DESC LIMIT 1"
+    ")",
+]
+
+
+def upgrade(connection):
+    for statement in STATEMENTS:
+        connection.execute(text(statement))
@@ -0,0 +1,19 @@
+"""
+Storage columns of prompt versions kept as deltas (app.db.version_storage). Existing versions stay full snapshots
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    "ALTER TABLE prompt_versions ALTER COLUMN prompt_text DROP NOT NULL",
+    "ALTER TABLE prompt_versions ADD COLUMN IF NOT EXISTS delta BYTEA",
+    "ALTER TABLE prompt_versions ADD COLUMN IF NOT EXISTS base_version_id BIGINT",
+    "ALTER TABLE prompt_versions ADD COLUMN IF NOT EXISTS snapshot_id BIGINT",
+    "ALTER TABLE prompt_versions ADD COLUMN IF NOT EXISTS delta_depth INTEGER NOT NULL DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS ix_prompt_versions_base_version_id ON prompt_versions (base_version_id)",
+    "CREATE INDEX IF NOT EXISTS ix_prompt_versions_snapshot_id ON prompt_versions (snapshot_id)",
+]
+
+
+def upgrade(connection):
+    for statement in STATEMENTS:
+        connection.execute(text(statement))
@@ -0,0 +1,28 @@
+"""
+Test cases move from the tests JSON array of testsets to the test_cases table, in the order of the array.
+Cases get new ids; keys of a case other than prompt and id are kept in meta
+"""
+from sqlalchemy import text, inspect
+from app.db.models import TestCase
+
+COPY_CASES = """
+INSERT INTO test_cases (testset_id, position, prompt, meta, created_at)
+SELECT
+    testsets.id,
+    cases.position - 1,
+    COALESCE(cases.value ->> 'prompt', cases.value #>> '{}', ''),
+    CASE WHEN json_typeof(cases.value) = 'object'
+        THEN NULLIF(cases.value::jsonb - 'prompt' - 'id', '{}'::jsonb)::json
+    END,
+    testsets.created_at
+FROM testsets
+CROSS JOIN LATERAL json_array_elements(CASE WHEN json_typeof(testsets.tests) = 'array' THEN testsets.tests ELSE '[]'::json END)
+    WITH ORDINALITY AS cases(value, position)
+"""
+
+
+def upgrade(connection):
+    TestCase.__table__.create(bind=connection, checkfirst=True)
+    if "tests" in {column["name"] for column in inspect(connection).get_columns("testsets")}:
+        connection.execute(text(COPY_CASES))
+        connection.execute(text("ALTER TABLE testsets DROP COLUMN tests"))
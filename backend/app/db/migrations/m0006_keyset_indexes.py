@@ -0,0 +1,26 @@
+"""
+Indexes for the keyset pages of the list helpers (app.db.pagination): (filter column, order column), so a page is one
+range of one index whatever its position. They replace the indexes on the filter columns alone
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    "CREATE INDEX IF NOT EXISTS ix_projects_user_id_id ON projects (user_id, id)",
+    "DROP INDEX IF EXISTS ix_projects_user_id",
+    "CREATE INDEX IF NOT EXISTS ix_prompts_project_id_id ON prompts (project_id, id)",
+    "DROP INDEX IF EXISTS ix_prompts_project_id",
+    "CREATE INDEX IF NOT EXISTS ix_testsets_project_id_id ON testsets (project_id, id)",
+    "DROP INDEX IF EXISTS ix_testsets_project_id",
+    "CREATE INDEX IF NOT EXISTS ix_runs_prompt_version_id_id ON runs (prompt_version_id, id)",
+    "DROP INDEX IF EXISTS ix_runs_prompt_version_id",
+    "CREATE INDEX IF NOT EXISTS ix_runs_email_id ON runs (email, id)",
+    "DROP INDEX IF EXISTS ix_runs_email",
+    # actions are listed newest first by id now, ids grow with the timestamps the actions are logged at
+    "CREATE INDEX IF NOT EXISTS ix_actions_project_id_id ON actions (project_id, id)",
+    "DROP INDEX IF EXISTS ix_actions_project_id_timestamp",
+]
+
+
+def upgrade(connection):
+    for statement in STATEMENTS:
+        connection.execute(text(statement))
@@ -1,9 +1,8 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Text, DateTime, Float, Table, BigInteger, JSON
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Text, DateTime, Float, Table, BigInteger, JSON, UniqueConstraint, Index, LargeBinary
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 import loguru
-from app.db.session import engine
 
 logger = loguru.logger
 
@@ -30,6 +29,8 @@ class User(Base):
 
 class Project(Base):
     __tablename__ = "projects"
+    # user_id first: the projects of a user, in id order for the keyset pages
+    __table_args__ = (Index("ix_projects_user_id_id", "user_id", "id"),)
     id = Column(BigInteger, primary_key=True, index=True)
     name = Column(String, nullable=False)
     description = Column(Text, nullable=True)
@@ -50,19 +51,27 @@ class Project(Base):
 
 class Prompt(Base):
     __tablename__ = "prompts"
+    __table_args__ = (Index("ix_prompts_project_id_id", "project_id", "id"),)
     id = Column(BigInteger, primary_key=True, index=True)
     name = Column(String, nullable=False)
     project_id = Column(BigInteger, ForeignKey("projects.id"))
     project = relationship("Project", back_populates="prompts")
     versions = relationship("PromptVersion", back_populates="prompt", cascade="all, delete-orphan")
     runs = relationship("Run", back_populates="prompt")
+
+    # latest version of the prompt, kept up to date by the functions that create versions.
+    # latest_version_number is the last number handed out, the numbers of deleted versions are not reused
+    current_version_id = Column(BigInteger, nullable=True)
+    latest_version_number = Column(Integer, nullable=False, default=0, server_default="0")
     
 
     def __init__(self, **kwargs):
+        prompt_text = kwargs.pop('prompt_text', None)
         super().__init__(**kwargs)
-        if 'prompt_text' in kwargs:
+        if prompt_text is not None:
+            self.latest_version_number = 1
             self.versions.append(PromptVersion(
-                prompt_text=kwargs['prompt_text'],
+                prompt_text=prompt_text,
                 version_number=1
             ))
 
@@ -71,15 +80,25 @@ class Prompt(Base):
 
 class PromptVersion(Base):
     __tablename__ = "prompt_versions"
+    # also serves the lookups of the versions of a prompt by prompt_id
+    __table_args__ = (Index("uq_prompt_versions_prompt_id_version_number", "prompt_id", "version_number", unique=True),)
     id = Column(BigInteger, primary_key=True, index=True)
     prompt_id = Column(BigInteger, ForeignKey("prompts.id", ondelete="CASCADE"))
     prompt = relationship("Prompt", back_populates="versions")
     version_number = Column(Integer, nullable=False)
-    prompt_text = Column(Text, nullable=False)
+    # NULL for versions stored as a delta, see app.db.version_storage
+    prompt_text = Column(Text, nullable=True)
     created_at = Column(DateTime, default=func.now())
     comments = Column(JSON, nullable=True)
     runs = relationship("Run", back_populates="prompt_version")
 
+    delta = Column(LargeBinary, nullable=True)
+    base_version_id = Column(BigInteger, nullable=True, index=True)
+    snapshot_id = Column(BigInteger, nullable=True, index=True)
+    delta_depth = Column(Integer, nullable=False, default=0, server_default="0")
+
+    STORAGE_COLUMNS = ("delta", "base_version_id", "snapshot_id", "delta_depth")
+
     def create_run(self, user_id=None, result=None, success=None, cost=None):
         run = Run(
             prompt_version_id=self.id,
@@ -94,10 +113,14 @@ class PromptVersion(Base):
         return run
 
     def to_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns if c.name not in self.STORAGE_COLUMNS}
 
 class Run(Base):
     __tablename__ = "runs"
+    __table_args__ = (
+        Index("ix_runs_prompt_version_id_id", "prompt_version_id", "id"),
+        Index("ix_runs_email_id", "email", "id"),
+    )
     id = Column(BigInteger, primary_key=True, index=True)
 
     model = Column(String, nullable=False)
@@ -119,22 +142,73 @@ class Run(Base):
     success = Column(Boolean, nullable=True)
     result = Column(JSON, default=dict)
 
-    prompt_id = Column(BigInteger, ForeignKey("prompts.id"))
+    prompt_id = Column(BigInteger, ForeignKey("prompts.id"), index=True)
     prompt = relationship("Prompt", back_populates="runs")
+
+    results = relationship("RunResult", back_populates="run", cascade="all, delete-orphan", passive_deletes=True)
     
 
     def to_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
+class RunResult(Base):
+    """
+    Result of a single test of a run. Rows are only ever inserted, so a run of N tests writes N small rows
+    instead of rewriting the growing Run.result JSON N times
+    """
+    __tablename__ = "run_results"
+    __table_args__ = (UniqueConstraint("run_id", "test_index", name="uq_run_results_run_test"),)
+    id = Column(BigInteger, primary_key=True, index=True)
+
+    run_id = Column(BigInteger, ForeignKey("runs.id", ondelete="CASCADE"), nullable=False)
+    run = relationship("Run", back_populates="results")
+
+    test_index = Column(Integer, nullable=False)
+    test_id = Column(Integer, nullable=True)
+
+    output = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    latency_ms = Column(Float, nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    cost = Column(Float, nullable=True)
+    cached = Column(Boolean, default=False)
+
+    created_at = Column(DateTime, default=func.now())
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
 class TestSet(Base):
     __tablename__ = "testsets"
+    __table_args__ = (Index("ix_testsets_project_id_id", "project_id", "id"),)
     id = Column(BigInteger, primary_key=True, index=True)
     name = Column(String, nullable=False)
     created_at = Column(DateTime, default=func.now())
-    tests = Column(JSON, nullable=True)
     project_id = Column(BigInteger, ForeignKey("projects.id"))
     project = relationship("Project", back_populates="tests")
+    cases = relationship("TestCase", back_populates="testset", cascade="all, delete-orphan", passive_deletes=True)
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+class TestCase(Base):
+    """
+    One case of a testset. Cases are ordered by position, their ids don't change when other cases are deleted
+    """
+    __tablename__ = "test_cases"
+    # also serves the paged reads of the cases of a testset
+    __table_args__ = (Index("uq_test_cases_testset_id_position", "testset_id", "position", unique=True),)
+    id = Column(BigInteger, primary_key=True, index=True)
+    testset_id = Column(BigInteger, ForeignKey("testsets.id", ondelete="CASCADE"), nullable=False)
+    testset = relationship("TestSet", back_populates="cases")
+    position = Column(BigInteger, nullable=False)
+    prompt = Column(Text, nullable=False)
+    meta = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=func.now())
 
     def to_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -142,6 +216,7 @@ class TestSet(Base):
 
 class Action(Base):
     __tablename__ = "actions"
+    __table_args__ = (Index("ix_actions_project_id_id", "project_id", "id"),)
     id = Column(BigInteger, primary_key=True, index=True)
     name = Column(String, nullable=False)
     timestamp = Column(DateTime, default=func.now())
@@ -154,5 +229,15 @@ class Action(Base):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
-Base.metadata.create_all(bind=engine)
-logger.info("Created all tables")
\ No newline at end of file
+class LLMCacheEntry(Base):
+    __tablename__ = "llm_cache"
+    key = Column(String(64), primary_key=True)
+    model = Column(String, nullable=False)
+    response = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=func.now())
+    expires_at = Column(DateTime, nullable=False, index=True)
+    hits = Column(Integer, default=0)
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
@@ -0,0 +1,62 @@
+"""
+Keyset pagination of the list helpers in app.db.functions and app.db.async_functions. A list is ordered by a unique
+column (id, or version_number within a prompt) and a page ends with a cursor, the opaque encoding of that column of its
+last row; the next page is the rows after it. Unlike OFFSET a page costs the same wherever it is in the list, and rows
+added or deleted meanwhile don't shift the pages. Every list has a composite index (filter column, key column), so a page
+is one range of one index.
+
+Helpers called without a limit return the whole list, the endpoints always pass one. Like their other errors, a cursor
+that can't be decoded gives an empty page, the endpoints reject it with 400 before (app.api.deps.page_args)
+"""
+import base64
+import binascii
+import json
+from typing import Callable, Optional
+
+MAX_PAGE_SIZE = 1000
+
+
+class Page(list):
+    """
+    Rows of one page. next_cursor continues after the last row, it is None on the last page
+    """
+
+    def __init__(self, rows=(), next_cursor: Optional[str] = None):
+        super().__init__(rows)
+        self.next_cursor = next_cursor
+
+
+def encode_cursor(key: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        raise ValueError("Invalid cursor") from None
+    if not isinstance(key, int) or isinstance(key, bool):
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def keyset(query, column, cursor: Optional[str] = None, limit: Optional[int] = None, descending: bool = False):
+    """
+    The query restricted to the rows after the cursor, ordered by column. Fetches one row more than limit,
+    so to_page() can tell whether another page follows. Raises ValueError for a cursor that can't be decoded
+    """
+    if cursor is not None:
+        key = decode_cursor(cursor)
+        query = query.where(column < key if descending else column > key)
+    query = query.order_by(column.desc() if descending else column.asc())
+    return query.limit(limit + 1) if limit is not None else query
+
+
+def to_page(rows: list, limit: Optional[int], key: Callable[[dict], int]) -> Page:
+    """
+    Page of the rows of a keyset() query, converted to dicts; key gives the value of the order column of a row
+    """
+    if limit is None or len(rows) <= limit:
+        return Page(rows)
+    rows = rows[:limit]
+    return Page(rows, encode_cursor(key(rows[-1])))
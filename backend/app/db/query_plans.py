@@ -0,0 +1,89 @@
+"""
+EXPLAIN check of the queries the helpers in app.db.functions and app.db.async_functions send on the hot paths.
+Sequential scans are disabled for the check, so on a small database the planner still shows which index it can use;
+a query that reports a sequential scan anyway has no index to use. Postgres only.
+
+Usage (from backend/): python -m app.db.migrate explain
+"""
+from datetime import datetime
+from sqlalchemy import select, func, text, or_
+from app.db.models import User, Project, Prompt, PromptVersion, Run, TestSet, Action, LLMCacheEntry
+from app.db.async_functions import results_export_query
+from app.db.functions import testset_summary_query, run_results_query, testset_cases_query
+from app.db.pagination import keyset, encode_cursor
+
+EMAIL = "user@example.com"
+# a page in the middle of a list
+CURSOR = encode_cursor(100)
+
+
+def _last_runs_of_versions():
+    rank = func.row_number().over(partition_by=Run.prompt_version_id, order_by=Run.id.desc()).label("rank")
+    ranked = select(Run.id, rank).where(Run.prompt_version_id.in_([1, 2])).subquery()
+    return select(Run).join(ranked, ranked.c.id == Run.id).where(ranked.c.rank <= 5)
+
+
+HOT_QUERIES = {
+    "get_user_by_email": lambda: select(User).where(User.email == EMAIL),
+    "get_projects_by_user": lambda: keyset(select(Project).where(Project.user_id == 1), Project.id, CURSOR, 100),
+    "get_project_prompts": lambda: keyset(select(Prompt).where(Prompt.project_id == 1), Prompt.id, CURSOR, 100),
+    "get_prompt_versions": lambda: keyset(select(PromptVersion).where(PromptVersion.prompt_id == 1), PromptVersion.version_number, CURSOR, 100),
+    "get_version_runs": lambda: keyset(select(Run).where(Run.prompt_version_id == 1), Run.id, CURSOR, 100, descending=True),
+    "get_runs_by_user": lambda: keyset(select(Run).join(User, User.email == Run.email).where(User.id == 1), Run.id, CURSOR, 100, descending=True),
+    "get_prompt (versions)": lambda: select(PromptVersion).where(PromptVersion.prompt_id == 1).order_by(PromptVersion.version_number.asc()),
+    "get_latest_prompt_version": lambda: select(PromptVersion).join(Prompt, Prompt.current_version_id == PromptVersion.id).where(Prompt.id == 1),
+    "prompt text chain": lambda: select(PromptVersion).where(or_(PromptVersion.id == 1, PromptVersion.snapshot_id == 1)),
+    "versions stored against a version": lambda: select(PromptVersion).where(PromptVersion.base_version_id == 1),
+    "get_prompt (runs)": lambda: select(Run).where(Run.prompt_version_id.in_([1, 2])),
+    "get_prompt (last runs)": _last_runs_of_versions,
+    "check_run": lambda: select(Run).where(Run.prompt_version_id == 1).order_by(Run.id.desc()).limit(1),
+    "delete_prompt (runs)": lambda: select(Run).where(Run.prompt_id == 1),
+    "update of users.email (runs cascade)": lambda: select(Run.id).where(Run.email == EMAIL),
+    "get_run_results": lambda: run_results_query(1, CURSOR, 100),
+    "stream_run_results (version)": lambda: results_export_query("version", 1),
+    "stream_run_results (project)": lambda: results_export_query("project", 1),
+    "get_project_testsets": lambda: keyset(testset_summary_query().where(TestSet.project_id == 1), TestSet.id, CURSOR, 100),
+    "get_testset": lambda: testset_summary_query().where(TestSet.id == 1),
+    "get_test_cases": lambda: testset_cases_query(1, CURSOR, 100),
+    "get_project_actions": lambda: keyset(select(Action).where(Action.project_id == 1), Action.id, CURSOR, 20, descending=True),
+    "get_object_owner (prompt)": lambda: select(Project.user_id, Project.id).join(Prompt, Prompt.project_id == Project.id).where(Prompt.id == 1),
+    "delete_expired_llm_cache_entries": lambda: select(LLMCacheEntry.key).where(LLMCacheEntry.expires_at <= datetime.utcnow()),
+}
+
+
+def _scans(plan: dict) -> list:
+    scans = []
+    if plan["Node Type"].endswith("Scan") and ("Relation Name" in plan or "Index Name" in plan):
+        relation = f" on {plan['Relation Name']}" if "Relation Name" in plan else ""
+        index = f" using {plan['Index Name']}" if "Index Name" in plan else ""
+        scans.append(f"{plan['Node Type']}{relation}{index}")
+    for child in plan.get("Plans", []):
+        scans.extend(_scans(child))
+    return scans
+
+
+def explain(connection, statement) -> dict:
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={"render_postcompile": True})
+    return connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()[0]["Plan"]
+
+
+def check_query_plans(connection) -> list:
+    """
+    For every hot query: the scans of its plan and whether all of them use an index
+    """
+    if connection.dialect.name != "postgresql":
+        raise RuntimeError("The query plan check needs Postgres")
+
+    checks = []
+    try:
+        connection.execute(text("SET LOCAL enable_seqscan = off"))
+        for name, build in HOT_QUERIES.items():
+            scans = _scans(explain(connection, build()))
+            checks.append({
+                "name": name,
+                "scans": scans,
+                "uses_index": not any(scan.startswith("Seq Scan") for scan in scans),
+            })
+    finally:
+        connection.rollback()
+    return checks
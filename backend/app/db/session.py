@@ -1,24 +1,100 @@
 from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 import loguru
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
 from app.settings import settings
+from app.db.pool import MeteredQueuePool, MeteredAsyncQueuePool
 
 logger = loguru.logger
 
-engine = create_engine(settings.DATABASE_URL)
+pool_options = dict(
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+)
+
+engine = create_engine(settings.DATABASE_URL, poolclass=MeteredQueuePool, **pool_options)
 SessionFactory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 SessionLocal = scoped_session(SessionFactory)
 
+# asyncpg engine for the request handlers, so a slow query doesn't block the event loop
+async_engine = create_async_engine(settings.ASYNC_DATABASE_URL, poolclass=MeteredAsyncQueuePool, **pool_options)
+AsyncSessionFactory = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+def get_pool_stats() -> dict:
+    """
+    State and checkout metrics of both connection pools of this worker
+    """
+    return {
+        "sync": engine.pool.get_stats(),
+        "async": async_engine.sync_engine.pool.get_stats(),
+    }
+
+
 @contextmanager
 def get_db_session():
     session = SessionLocal()
     try:
         yield session
         session.commit()
-    except Exception as e:
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error("[DB] Error in session: {}", e)
+        raise
+    except Exception:
         session.rollback()
-        logger.error(f"[DB] Error in session: {e}", exc_info=True)
         raise
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+
+@asynccontextmanager
+async def get_async_db_session():
+    session = AsyncSessionFactory()
+    try:
+        yield session
+        await session.commit()
+    except SQLAlchemyError as e:
+        await session.rollback()
+        logger.error("[DB] Error in async session: {}", e)
+        raise
+    except Exception:
+        # raised by the code using the session, e.g. the 400 or 404 of a handler, not a database error
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+@asynccontextmanager
+async def use_session(db: AsyncSession = None, savepoint: bool = False):
+    """
+    Session for a helper: the request session if one is given, otherwise a short one of its own.
+    The request session is committed once by get_request_db. Helpers that write and report a failure instead of raising
+    it pass savepoint=True, so a failed write rolls back only its own changes, not the earlier writes of the request.
+    Reads run in the request transaction directly, a savepoint would cost them two more round-trips
+    """
+    if db is None:
+        async with get_async_db_session() as session:
+            yield session
+        return
+
+    if not savepoint:
+        yield db
+        return
+
+    async with db.begin_nested():
+        yield db
+
+
+async def get_request_db():
+    """
+    FastAPI dependency with one session and one transaction for the whole request
+    """
+    async with get_async_db_session() as session:
+        yield session
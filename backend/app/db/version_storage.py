@@ -0,0 +1,191 @@
+"""
+Delta storage of prompt versions. A new version is stored as a compressed delta against the version it was saved over
+(the current version of its prompt), every PROMPT_SNAPSHOT_INTERVAL versions of a chain the full text is stored again.
+Snapshots keep the text in prompt_text, deltas keep it NULL and fill delta, base_version_id (the version the delta applies to),
+snapshot_id (the snapshot that starts the chain, so a chain is loaded with one query) and delta_depth.
+
+A version the delta of another version is based on never changes its text without rewriting that delta,
+so the text of a delta version is determined by (id, delta) and rebuilt texts are cached by that key.
+The helpers of app.db.functions and app.db.async_functions load the rows and rebuild prompt_text before to_dict(),
+the API never sees the storage columns.
+"""
+import json
+import zlib
+from difflib import SequenceMatcher
+from typing import Dict, Iterable, List, Set
+from sqlalchemy import select, or_, inspect
+from sqlalchemy.orm.attributes import set_committed_value, flag_modified
+from app.db.models import PromptVersion
+from app.settings import settings
+from app.utils.cache import TTLCache
+from app.utils.diffing import PAIRS_BUDGET, common_affix_lengths
+
+# (version id, delta) -> rebuilt text
+text_cache = TTLCache(max_size=settings.PROMPT_TEXT_CACHE_SIZE)
+
+
+def encode_delta(base: str, text: str) -> bytes:
+    """
+    Compressed list of operations that turn base into text: [start, end] copies base[start:end], a string is inserted
+    """
+    prefix, suffix = common_affix_lengths(base, text)
+    operations = [[0, prefix]] if prefix else []
+
+    base_lines = base[prefix:len(base) - suffix].splitlines(keepends=True)
+    text_lines = text[prefix:len(text) - suffix].splitlines(keepends=True)
+    if len(base_lines) * len(text_lines) <= PAIRS_BUDGET:
+        base_offsets = [prefix]
+        for line in base_lines:
+            base_offsets.append(base_offsets[-1] + len(line))
+        matcher = SequenceMatcher(None, base_lines, text_lines, autojunk=False)
+        for tag, base_start, base_end, text_start, text_end in matcher.get_opcodes():
+            if tag == "equal":
+                operations.append([base_offsets[base_start], base_offsets[base_end]])
+            elif text_end > text_start:
+                operations.append("".join(text_lines[text_start:text_end]))
+    elif text_lines:
+        operations.append("".join(text_lines))
+
+    if suffix:
+        operations.append([len(base) - suffix, len(base)])
+    return zlib.compress(json.dumps(_merge(operations), separators=(",", ":")).encode(), 9)
+
+
+def _merge(operations: list) -> list:
+    merged = []
+    for operation in operations:
+        if merged and isinstance(operation, list) and isinstance(merged[-1], list) and merged[-1][1] == operation[0]:
+            merged[-1] = [merged[-1][0], operation[1]]
+        elif merged and isinstance(operation, str) and isinstance(merged[-1], str):
+            merged[-1] += operation
+        else:
+            merged.append(operation)
+    return merged
+
+
+def apply_delta(base: str, delta: bytes) -> str:
+    return "".join(
+        base[operation[0]:operation[1]] if isinstance(operation, list) else operation
+        for operation in json.loads(zlib.decompress(delta))
+    )
+
+
+def _set_snapshot(version: PromptVersion, text: str):
+    version.prompt_text = text
+    version.delta = None
+    version.base_version_id = None
+    version.snapshot_id = None
+    version.delta_depth = 0
+    if inspect(version).persistent:
+        # prompt_text may hold a rebuilt text that was never written
+        flag_modified(version, "prompt_text")
+
+
+def store_text(version: PromptVersion, text: str, base: PromptVersion = None):
+    """
+    Sets the storage columns of a new version saved over base. The text of base has to be loaded
+    """
+    if settings.PROMPT_STORAGE_MODE != "delta" or base is None or text is None or base.prompt_text is None \
+            or (base.delta_depth or 0) + 1 >= settings.PROMPT_SNAPSHOT_INTERVAL:
+        _set_snapshot(version, text)
+        return
+    delta = encode_delta(base.prompt_text, text)
+    if len(delta) >= len(text.encode()):
+        _set_snapshot(version, text)
+        return
+    version.prompt_text = None
+    version.delta = delta
+    version.base_version_id = base.id
+    version.snapshot_id = base.snapshot_id or base.id
+    version.delta_depth = (base.delta_depth or 0) + 1
+
+
+def cache_text(version: PromptVersion, text: str):
+    """
+    Makes the text of a flushed version readable from the row and the cache without writing it
+    """
+    set_committed_value(version, "prompt_text", text)
+    if version.delta is not None:
+        text_cache.set((version.id, version.delta), text)
+
+
+def reencode(version: PromptVersion, text: str, base: PromptVersion = None):
+    """
+    Rewrites an existing version to the given text, keeping its place in the chain. For a delta version base is its
+    (possibly new) base with the text loaded
+    """
+    if version.delta is None:
+        version.prompt_text = text
+        flag_modified(version, "prompt_text")
+        return
+    version.base_version_id = base.id
+    version.delta = encode_delta(base.prompt_text, text)
+    version.prompt_text = None
+    cache_text(version, text)
+
+
+def detach(version: PromptVersion, dependents: List[PromptVersion], chain: List[PromptVersion], base: PromptVersion = None):
+    """
+    Rewrites the versions based on version so that it can be deleted. Texts of the dependents have to be loaded.
+    A delta version passes its dependents to its base, a snapshot turns every dependent into the snapshot
+    of the versions that follow it (chain are the rows with snapshot_id of version)
+    """
+    if version.delta is not None:
+        for dependent in dependents:
+            reencode(dependent, dependent.prompt_text, base)
+        return
+
+    roots = {dependent.id: dependent for dependent in dependents}
+    by_id = {row.id: row for row in chain}
+    for row in chain:
+        if row.id in roots or row.id == version.id:
+            continue
+        current = row
+        while current.base_version_id != version.id:
+            current = by_id[current.base_version_id]
+        row.snapshot_id = current.id
+        row.delta_depth -= current.delta_depth
+    for dependent in dependents:
+        _set_snapshot(dependent, dependent.prompt_text)
+
+
+def chain_query(snapshot_id: int):
+    return select(PromptVersion).where(or_(PromptVersion.id == snapshot_id, PromptVersion.snapshot_id == snapshot_id))
+
+
+def missing_snapshots(versions: Iterable[PromptVersion]) -> Set[int]:
+    """
+    Snapshots whose chains have to be loaded to rebuild the texts of the versions, empty when their bases are among them
+    or their texts are cached
+    """
+    loaded = {version.id for version in versions}
+    return {
+        version.snapshot_id
+        for version in versions
+        if version.delta is not None
+        and version.base_version_id not in loaded
+        and text_cache.get((version.id, version.delta)) is None
+    }
+
+
+def rebuild_texts(versions: Iterable[PromptVersion]):
+    """
+    Fills prompt_text of the delta versions without marking it as changed. The base of every delta version has to be
+    among versions unless its text is cached
+    """
+    by_id = {version.id: version for version in versions}
+    texts: Dict[int, str] = {version.id: version.prompt_text for version in by_id.values() if version.delta is None}
+    for version in by_id.values():
+        path = []
+        current = version
+        while current.id not in texts:
+            cached = text_cache.get((current.id, current.delta))
+            if cached is not None:
+                texts[current.id] = cached
+                set_committed_value(current, "prompt_text", cached)
+                break
+            path.append(current)
+            current = by_id[current.base_version_id]
+        for row in reversed(path):
+            texts[row.id] = apply_delta(texts[row.base_version_id], row.delta)
+            cache_text(row, texts[row.id])
@@ -1,15 +1,21 @@
 from fastapi import FastAPI, Depends, HTTPException, Request, Response
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import loguru
 import os
 import threading
 import uvicorn
 from sqlalchemy import inspect
-from app.middleware.auth import JWTAuthMiddleware
+from app.middleware.auth import JWTAuthMiddleware, user_lookup_stats
 
 from app.db.session import engine
-from app.db.functions import get_db_session
+from app.db.functions import get_db_session, user_cache
+from app.utils.openrouter import client_pool
+from app.utils.llm_cache import llm_cache
+from app.utils.run_writer import run_writer
+from app.utils.runner import testset_runner
+from app.db.migrate import run_migrations
 
 logger = loguru.logger
 
@@ -21,6 +27,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # the cursor of the next page of the list endpoints
+    expose_headers=["X-Next-Cursor"],
 )
 
 from app.api.routes import register_routes
@@ -29,6 +37,22 @@ register_routes(app)
 
 app.add_middleware(JWTAuthMiddleware)
 
+@app.on_event("startup")
+def migrate():
+    run_migrations()
+
+@app.on_event("startup")
+async def start_llm_cache_purge():
+    # reads skip expired rows of the llm_cache table, this deletes them
+    app.state.llm_cache_purge = asyncio.create_task(llm_cache.purge_periodically())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.llm_cache_purge.cancel()
+    await testset_runner.shutdown()
+    await run_writer.close()
+    await client_pool.aclose()
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
@@ -44,6 +68,10 @@ async def debug_routes():
         })
     return routes
 
+@app.get("/debug/user_cache")
+async def debug_user_cache():
+    return {**user_lookup_stats, "cached_users": len(user_cache)}
+
 @app.get("/debug/db")
 async def debug_db(db = Depends(get_db_session)):
     inspector = inspect(engine)
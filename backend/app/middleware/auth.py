@@ -1,53 +1,91 @@
-from fastapi import Request, HTTPException
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 import jwt
 from jwt import PyJWTError
 from app.settings import settings
-from app.db.functions import get_user_by_email
+from app.db.functions import user_cache
+from app.db.async_functions import get_cached_user_by_email
 import loguru
 
 allowed_paths = ["/health", "/auth/signup", "/auth/login"]
 
 logger = loguru.logger
 
+# Before user caching the middleware did two user lookups per request and handlers did one more
+MIDDLEWARE_USER_LOOKUPS = 2
+user_lookup_stats = {"requests": 0, "saved": 0}
+
 def check_url(url):
     for path in allowed_paths:
         if url.startswith(path):
             return True
     return False
 
-class JWTAuthMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        if request.method == "OPTIONS":
-            return await call_next(request)
-
-        if check_url(request.url.path):
-            return await call_next(request)
-
-        auth_header = request.headers.get("Authorization")
-        if not auth_header or not auth_header.startswith("Bearer "):
-            return JSONResponse(status_code=401, content={"detail": "Not authenticated"})
-
-        token = auth_header.split(" ", 1)[1]
-        try:
-            payload = jwt.decode(
-                token,
-                settings.SECRET_KEY,
-                algorithms=[settings.ALGORITHM],
-                audience=settings.AUDIENCE
-            )
-
-            if not get_user_by_email(payload["sub"]):
-                logger.debug(f"Invalid or expired token: {request.url.path}")
-                return JSONResponse(status_code=401, content={"detail": "Invalid or expired token"})
-            
-            if not get_user_by_email(payload["sub"])["is_verified"] and not request.url.path.startswith("/auth/send_email") and not request.url.path.startswith("/auth/verify_code"):
-                logger.debug(f"Email not verified: {request.url.path}")
-                return JSONResponse(status_code=401, content={"detail": "Email not verified"})
-
-            request.state.email = payload["sub"]
-        except PyJWTError:
-            logger.debug(f"Invalid or expired token: {request.url.path}")
-            return JSONResponse(status_code=401, content={"detail": "Invalid or expired token"})
-        return await call_next(request)
+async def authenticate(path: str, headers: Headers):
+    """
+    Resolves the user of the request. Returns (user, whether it came from user_cache, None) on success
+    and (None, False, error response) otherwise
+    """
+    auth_header = headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        return None, False, JSONResponse(status_code=401, content={"detail": "Not authenticated"})
+
+    token = auth_header.split(" ", 1)[1]
+    try:
+        payload = jwt.decode(
+            token,
+            settings.SECRET_KEY,
+            algorithms=[settings.ALGORITHM],
+            audience=settings.AUDIENCE
+        )
+    except PyJWTError:
+        logger.debug(f"Invalid or expired token: {path}")
+        return None, False, JSONResponse(status_code=401, content={"detail": "Invalid or expired token"})
+
+    from_cache = payload["sub"] in user_cache
+    user = await get_cached_user_by_email(payload["sub"])
+    if not user:
+        logger.debug(f"Invalid or expired token: {path}")
+        return None, False, JSONResponse(status_code=401, content={"detail": "Invalid or expired token"})
+
+    if not user["is_verified"] and not path.startswith("/auth/send_email") and not path.startswith("/auth/verify_code"):
+        logger.debug(f"Email not verified: {path}")
+        return None, False, JSONResponse(status_code=401, content={"detail": "Email not verified"})
+
+    return user, from_cache, None
+
+
+class JWTAuthMiddleware:
+    """
+    Pure ASGI auth middleware. Unlike BaseHTTPMiddleware it doesn't wrap the request and response streams
+    in an extra task, so it adds almost nothing to a request and doesn't get in the way of streaming responses
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or check_url(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        user, from_cache, error_response = await authenticate(scope["path"], Headers(scope=scope))
+        if error_response:
+            await error_response(scope, receive, send)
+            return
+
+        state = scope.setdefault("state", {})
+        state["email"] = user["email"]
+        state["user"] = user
+        state["user_lookups_saved"] = MIDDLEWARE_USER_LOOKUPS if from_cache else MIDDLEWARE_USER_LOOKUPS - 1
+
+        async def send_with_stats(message: Message):
+            if message["type"] == "http.response.start":
+                saved = state["user_lookups_saved"]
+                user_lookup_stats["requests"] += 1
+                user_lookup_stats["saved"] += saved
+                MutableHeaders(scope=message).append("X-User-Lookups-Saved", str(saved))
+            await send(message)
+
+        await self.app(scope, receive, send_with_stats)
@@ -11,9 +11,49 @@ load_dotenv(os.path.join(project_root, ".env.local"))
 
 class Settings:
     DATABASE_URL = f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+    ASYNC_DATABASE_URL = f"postgresql+asyncpg://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
     SECRET_KEY = os.getenv("SECRET_KEY")
     ALGORITHM = os.getenv("ALGORITHM")
     ACCESS_TOKEN_EXPIRE_HOURS = int(os.getenv("ACCESS_TOKEN_EXPIRE_HOURS"))
     AUDIENCE = os.getenv("AUDIENCE")
     RESEND_API_KEY = os.getenv("RESEND_API_KEY")
+
+    TESTSET_GLOBAL_CONCURRENCY = int(os.getenv("TESTSET_GLOBAL_CONCURRENCY", 64))
+    TESTSET_USER_CONCURRENCY = int(os.getenv("TESTSET_USER_CONCURRENCY", 16))
+    TESTSET_RUN_CONCURRENCY = int(os.getenv("TESTSET_RUN_CONCURRENCY", 8))
+    TESTSET_PAGE_SIZE = int(os.getenv("TESTSET_PAGE_SIZE", 500))
+    TESTSET_IMPORT_CHUNK_SIZE = int(os.getenv("TESTSET_IMPORT_CHUNK_SIZE", 2000))
+
+    OPENROUTER_MAX_CLIENTS = int(os.getenv("OPENROUTER_MAX_CLIENTS", 128))
+    OPENROUTER_CLIENT_IDLE_SECONDS = int(os.getenv("OPENROUTER_CLIENT_IDLE_SECONDS", 600))
+    OPENROUTER_MAX_CONNECTIONS = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", 32))
+
+    LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+    LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 2048))
+    LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+    LLM_CACHE_PURGE_SECONDS = int(os.getenv("LLM_CACHE_PURGE_SECONDS", 3600))
+
+    RUN_WRITER_BATCH_SIZE = int(os.getenv("RUN_WRITER_BATCH_SIZE", 50))
+    RUN_WRITER_FLUSH_MS = int(os.getenv("RUN_WRITER_FLUSH_MS", 250))
+
+    RUN_EVENTS_MAX_EVENTS = int(os.getenv("RUN_EVENTS_MAX_EVENTS", 2000))
+
+    USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+    USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", 60))
+
+    OWNERSHIP_CACHE_SIZE = int(os.getenv("OWNERSHIP_CACHE_SIZE", 10000))
+    OWNERSHIP_CACHE_TTL_SECONDS = int(os.getenv("OWNERSHIP_CACHE_TTL_SECONDS", 30))
+
+    PROMPT_STORAGE_MODE = os.getenv("PROMPT_STORAGE_MODE", "delta")
+    PROMPT_SNAPSHOT_INTERVAL = int(os.getenv("PROMPT_SNAPSHOT_INTERVAL", 20))
+    PROMPT_TEXT_CACHE_SIZE = int(os.getenv("PROMPT_TEXT_CACHE_SIZE", 1024))
+    DIFF_CACHE_SIZE = int(os.getenv("DIFF_CACHE_SIZE", 512))
+
+    EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+    PAGE_SIZE = int(os.getenv("PAGE_SIZE", 100))
 settings = Settings()
\ No newline at end of file
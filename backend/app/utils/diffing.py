@@ -0,0 +1,223 @@
+"""
+Change detection for prompt saves. The similarity is measured like the ratio of difflib (2 * matched / total characters), but it is
+computed in tiers that stop as soon as the answer is known, so the cost stays bounded for large prompts:
+
+1. equal texts, and the length bound (the similarity can't be higher than 2 * shorter / total)
+2. the common prefix and suffix are matched without any diffing, only the changed middle is compared
+3. the middle is aligned with SequenceMatcher by characters, words or lines: the finest unit whose number of pairs
+   (len(a) * len(b), what the alignment costs in the worst case) fits in PAIRS_BUDGET
+4. above the budget even for lines, only the multisets of lines are compared (an upper bound, linear time)
+
+With a threshold the multiset bound is checked before aligning, so rewrites are recognized without any alignment.
+
+The diffs between versions shown by the history view (diff_texts) are aligned the same way and cached by the content of both texts
+"""
+import hashlib
+import re
+from difflib import SequenceMatcher
+from app.settings import settings
+from app.utils.cache import TTLCache
+
+SIGNIFICANT_CHANGE_THRESHOLD = 0.92
+
+# pairs of units (characters, words or lines) the alignment of the changed middle may compare
+PAIRS_BUDGET = 250_000
+
+WORD_PATTERN = re.compile(r"\S+\s*|\s+")
+
+DIFF_GRANULARITIES = ("line", "word")
+# characters a unit of the granularity ends with
+UNIT_SEPARATORS = {"line": ("\n",), "word": (" ", "\n", "\t")}
+
+# (content hash of the old text, content hash of the new text, granularity) -> diff
+diff_cache = TTLCache(max_size=settings.DIFF_CACHE_SIZE)
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    # binary search over slice comparisons, they run in C
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _common_suffix_length(a: str, b: str, limit: int) -> int:
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:] == b[len(b) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_affix_lengths(a: str, b: str) -> tuple:
+    """
+    Lengths of the common prefix and of the common suffix of a and b, they never overlap
+    """
+    prefix = _common_prefix_length(a, b)
+    return prefix, _common_suffix_length(a, b, min(len(a), len(b)) - prefix)
+
+
+def _split_middle(a: str, b: str):
+    """
+    The finest units of a and b whose alignment fits in the budget, None if even the lines don't fit
+    """
+    if len(a) * len(b) <= PAIRS_BUDGET:
+        return a, b
+    a_words, b_words = WORD_PATTERN.findall(a), WORD_PATTERN.findall(b)
+    if len(a_words) * len(b_words) <= PAIRS_BUDGET:
+        return a_words, b_words
+    a_lines, b_lines = a.splitlines(keepends=True), b.splitlines(keepends=True)
+    if len(a_lines) * len(b_lines) <= PAIRS_BUDGET:
+        return a_lines, b_lines
+    return None
+
+
+def _matched_length(a_units, b_units) -> int:
+    matcher = SequenceMatcher(None, a_units, b_units, autojunk=False)
+    return sum(
+        sum(len(unit) for unit in a_units[block.a:block.a + block.size])
+        for block in matcher.get_matching_blocks()
+    )
+
+
+def _matched_length_upper_bound(a_units, b_units) -> int:
+    # the units both sides have regardless of their order, an alignment can't match more
+    counts = {}
+    for unit in a_units:
+        counts[unit] = counts.get(unit, 0) + 1
+    matched = 0
+    for unit in b_units:
+        if counts.get(unit, 0) > 0:
+            counts[unit] -= 1
+            matched += len(unit)
+    return matched
+
+
+def text_similarity(a: str, b: str, threshold: float = None) -> float:
+    """
+    Similarity of two texts from 0 to 1. With a threshold the computation stops once the result is known to be below it,
+    the returned value is then an upper bound
+    """
+    if a == b:
+        return 1.0
+    total = len(a) + len(b)
+    upper_bound = 2 * min(len(a), len(b)) / total
+    if threshold is not None and upper_bound < threshold:
+        return upper_bound
+
+    prefix, suffix = common_affix_lengths(a, b)
+    a_middle, b_middle = a[prefix:len(a) - suffix], b[prefix:len(b) - suffix]
+    matched = prefix + suffix
+    if not a_middle or not b_middle:
+        return 2 * matched / total
+
+    units = _split_middle(a_middle, b_middle)
+    if units is None:
+        a_lines, b_lines = a_middle.splitlines(keepends=True), b_middle.splitlines(keepends=True)
+        return 2 * (matched + _matched_length_upper_bound(a_lines, b_lines)) / total
+
+    a_units, b_units = units
+    if threshold is not None:
+        upper_bound = 2 * (matched + _matched_length_upper_bound(a_units, b_units)) / total
+        if upper_bound < threshold:
+            return upper_bound
+    return 2 * (matched + _matched_length(a_units, b_units)) / total
+
+
+def check_prompt_change(new_text: str, old_text: str, threshold: float = SIGNIFICANT_CHANGE_THRESHOLD):
+    """
+    Whether saving new_text over old_text is a significant change that deserves a new version, and the similarity
+    """
+    if not old_text or not new_text:
+        return True, 0.0
+    similarity = text_similarity(new_text, old_text, threshold)
+    return similarity < threshold, similarity
+
+
+def _units(text: str, granularity: str) -> list:
+    return text.splitlines(keepends=True) if granularity == "line" else WORD_PATTERN.findall(text)
+
+
+def _unit_affix_lengths(a: str, b: str, granularity: str) -> tuple:
+    """
+    Common prefix and suffix shortened to whole units, so the changes never start or end inside a line or word
+    """
+    prefix, suffix = common_affix_lengths(a, b)
+    separators = UNIT_SEPARATORS[granularity]
+    prefix = max(a.rfind(separator, 0, prefix) for separator in separators) + 1
+    # the separators inside the common suffix end a unit in both texts
+    ends = [a.find(separator, len(a) - suffix) for separator in separators]
+    suffix_start = min((end + 1 for end in ends if end != -1), default=len(a))
+    return prefix, len(a) - max(suffix_start, prefix)
+
+
+def _append(changes: list, op: str, text: str):
+    if not text:
+        return
+    if changes and changes[-1]["op"] == op:
+        changes[-1]["text"] += text
+    else:
+        changes.append({"op": op, "text": text})
+
+
+def diff_texts(old: str, new: str, granularity: str = "line") -> dict:
+    """
+    Changes that turn old into new, a list of {"op": "equal" | "delete" | "insert", "text"} aligned by lines or words.
+    Only the middle between the common prefix and suffix is aligned; when it is over the budget, word diffs fall back
+    to lines and line diffs replace the whole middle. The granularity that was used is returned with the changes
+    """
+    prefix, suffix = _unit_affix_lengths(old, new, granularity)
+    old_middle, new_middle = old[prefix:len(old) - suffix], new[prefix:len(new) - suffix]
+    changes = []
+    _append(changes, "equal", old[:prefix])
+
+    used = granularity
+    old_units, new_units = _units(old_middle, used), _units(new_middle, used)
+    if len(old_units) * len(new_units) > PAIRS_BUDGET and used == "word":
+        used = "line"
+        old_units, new_units = _units(old_middle, used), _units(new_middle, used)
+    if len(old_units) * len(new_units) <= PAIRS_BUDGET:
+        matcher = SequenceMatcher(None, old_units, new_units, autojunk=False)
+        for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+            if tag == "equal":
+                _append(changes, "equal", "".join(old_units[old_start:old_end]))
+                continue
+            _append(changes, "delete", "".join(old_units[old_start:old_end]))
+            _append(changes, "insert", "".join(new_units[new_start:new_end]))
+    else:
+        _append(changes, "delete", old_middle)
+        _append(changes, "insert", new_middle)
+
+    _append(changes, "equal", old[len(old) - suffix:])
+    return {"granularity": used, "changes": changes}
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def cached_diff(old: str, new: str, granularity: str = "line") -> dict:
+    """
+    diff_texts memoized by the content of both texts, versions with the same texts share the entry
+    """
+    key = (content_hash(old), content_hash(new), granularity)
+    diff = diff_cache.get(key)
+    if diff is None:
+        diff = diff_texts(old, new, granularity)
+        diff_cache.set(key, diff)
+    return diff
+
+
+def precompute_diffs(old: str, new: str):
+    """
+    Caches the diffs of a new version against the previous one, run as a background task after the save
+    """
+    for granularity in DIFF_GRANULARITIES:
+        cached_diff(old, new, granularity)
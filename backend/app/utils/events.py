@@ -0,0 +1,107 @@
+import asyncio
+import loguru
+from collections import deque
+from itertools import islice
+from app.settings import settings
+
+logger = loguru.logger
+
+
+class RunEventLog:
+    """
+    The latest max_events events of a run. Offsets count all events of the run, first is the offset of the oldest one kept
+    """
+
+    def __init__(self, run_id: int, email: str, max_events: int):
+        self.run_id = run_id
+        self.email = email
+        self.events = deque(maxlen=max_events)
+        self.count = 0
+        self.finished = False
+        self.condition = asyncio.Condition()
+
+    @property
+    def first(self) -> int:
+        return self.count - len(self.events)
+
+
+class RunEventBus:
+    """
+    In-memory event log of every active run. The runner publishes events, subscribers read them starting at any offset,
+    so a client that connects late (or reconnects) first gets what it missed and then follows the run live.
+
+    A log keeps only the latest max_events events, so the outputs of a long run don't pile up in memory. A subscriber
+    behind them gets a resync event instead of what it missed and has to read the run from the database.
+    Logs of finished runs are kept for retention_seconds and then dropped, after that the run has to be read from the database
+    """
+
+    def __init__(self, retention_seconds: int = 300, max_events: int = 2000):
+        self.retention_seconds = retention_seconds
+        self.max_events = max_events
+        self._logs = {}
+
+    def open(self, run_id: int, email: str) -> RunEventLog:
+        log = RunEventLog(run_id, email, self.max_events)
+        self._logs[run_id] = log
+        return log
+
+    def get(self, run_id: int) -> RunEventLog:
+        return self._logs.get(run_id)
+
+    async def publish(self, run_id: int, event: str, data: dict, final: bool = False):
+        log = self._logs.get(run_id)
+        if not log:
+            return
+        async with log.condition:
+            log.events.append((event, data))
+            log.count += 1
+            if final:
+                log.finished = True
+            log.condition.notify_all()
+
+        if final:
+            asyncio.get_running_loop().call_later(self.retention_seconds, self._drop, run_id, log)
+
+    def _drop(self, run_id: int, log: RunEventLog):
+        if self._logs.get(run_id) is log:
+            del self._logs[run_id]
+            logger.debug(f"Dropped event log of run {run_id}")
+
+    async def subscribe(self, run_id: int, offset: int = 0, heartbeat: float = 15):
+        """
+        Yields (offset, event, data) tuples until the run is finished. Yields None every heartbeat seconds without events.
+        When events after offset aren't kept anymore, yields (offset, "resync", {"missed": count}) with the offset before
+        the oldest kept event and continues from there
+        """
+        log = self._logs.get(run_id)
+        if not log:
+            return
+
+        while True:
+            async with log.condition:
+                try:
+                    await asyncio.wait_for(log.condition.wait_for(lambda: log.count > offset or log.finished), heartbeat)
+                except asyncio.TimeoutError:
+                    batch = None
+                else:
+                    missed = max(log.first - offset, 0)
+                    offset += missed
+                    batch = list(islice(log.events, offset - log.first, None))
+                finished = log.finished
+
+            if batch is None:
+                yield None
+                continue
+
+            if missed:
+                yield offset - 1, "resync", {"missed": missed}
+
+            for event, data in batch:
+                yield offset, event, data
+                offset += 1
+
+            if finished and offset >= log.count:
+                return
+
+
+run_events = RunEventBus(max_events=settings.RUN_EVENTS_MAX_EVENTS)
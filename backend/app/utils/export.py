@@ -0,0 +1,118 @@
+"""
+Encoders of result exports. Each takes the batches of app.db.async_functions.stream_run_results and yields the encoded bytes
+batch by batch, so a streamed export holds one batch of rows and its encoding at a time, whatever the size of the result.
+Parquet needs pyarrow, every batch becomes one row group
+"""
+import csv
+import io
+import json
+from typing import AsyncIterator, List
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+# column -> Parquet type, in the order of the export
+EXPORT_COLUMNS = {
+    "run_id": "int64",
+    "prompt_id": "int64",
+    "prompt_version_id": "int64",
+    "version_number": "int64",
+    "model": "string",
+    "test_index": "int64",
+    "test_id": "int64",
+    "output": "string",
+    "error": "string",
+    "latency_ms": "float64",
+    "prompt_tokens": "int64",
+    "completion_tokens": "int64",
+    "cost": "float64",
+    "cached": "bool",
+    "created_at": "timestamp",
+}
+
+EXPORT_MEDIA_TYPES = {
+    "jsonl": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+Batches = AsyncIterator[List[dict]]
+
+
+async def to_jsonl(batches: Batches) -> AsyncIterator[bytes]:
+    async for batch in batches:
+        yield "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in batch).encode()
+
+
+async def to_csv(batches: Batches) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(EXPORT_COLUMNS))
+    writer.writeheader()
+    yield buffer.getvalue().encode()
+    async for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+
+
+class _Sink:
+    """
+    Write-only file for ParquetWriter that keeps the written bytes until they are taken
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _parquet_schema():
+    types = {
+        "int64": pyarrow.int64(),
+        "float64": pyarrow.float64(),
+        "string": pyarrow.string(),
+        "bool": pyarrow.bool_(),
+        "timestamp": pyarrow.timestamp("us"),
+    }
+    # a fixed schema, a batch whose column is all null would infer a null type otherwise
+    return pyarrow.schema([(name, types[kind]) for name, kind in EXPORT_COLUMNS.items()])
+
+
+async def to_parquet(batches: Batches) -> AsyncIterator[bytes]:
+    schema = _parquet_schema()
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    try:
+        async for batch in batches:
+            writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+ENCODERS = {"jsonl": to_jsonl, "csv": to_csv, "parquet": to_parquet}
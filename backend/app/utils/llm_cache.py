@@ -0,0 +1,126 @@
+import asyncio
+import hashlib
+import json
+import threading
+import loguru
+from app.settings import settings
+from app.db import functions, async_functions
+from app.utils.cache import TTLCache
+
+logger = loguru.logger
+
+
+def make_cache_key(model: str, messages: list, params: dict) -> str:
+    """
+    Content address of a completion request: the hash of everything that is sent to the model
+    """
+    payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Two tier cache for completions. The first tier is an in-process LRU, the second one is the llm_cache table
+    shared between workers. Entries of both tiers expire after ttl seconds; expired rows of the table are skipped by reads
+    and deleted every purge_interval seconds (purge_periodically).
+
+    Cached responses keep the usage, cost and latency of the original request, so every hit adds
+    to the counters of tokens, money and time that were saved
+    """
+
+    def __init__(self, max_size: int, ttl: int, enabled: bool = True, purge_interval: int = 3600):
+        self.ttl = ttl
+        self.enabled = enabled
+        self.purge_interval = purge_interval
+        self.memory = TTLCache(max_size=max_size, ttl=ttl)
+
+        self._lock = threading.Lock()
+        self.stats = {
+            "memory_hits": 0,
+            "db_hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "saved_tokens": 0,
+            "saved_cost": 0.0,
+            "saved_latency_ms": 0.0,
+        }
+
+    def _count(self, counter: str, response: dict = None):
+        with self._lock:
+            self.stats[counter] += 1
+            if response:
+                usage = response.get("usage") or {}
+                self.stats["saved_tokens"] += usage.get("total_tokens") or 0
+                self.stats["saved_cost"] += response.get("cost") or 0.0
+                self.stats["saved_latency_ms"] += response.get("latency_ms") or 0.0
+
+    def count_bypass(self):
+        self._count("bypassed")
+
+    def get(self, key: str):
+        response = self.memory.get(key)
+        if response is not None:
+            self._count("memory_hits", response)
+            return response
+
+        response = functions.get_llm_cache_entry(key)
+        if response:
+            self.memory.set(key, response)
+            self._count("db_hits", response)
+            return response
+
+        self._count("misses")
+        return None
+
+    def set(self, key: str, model: str, response: dict):
+        self.memory.set(key, response)
+        functions.set_llm_cache_entry(key, model, response, self.ttl)
+
+    async def aget(self, key: str):
+        response = self.memory.get(key)
+        if response is not None:
+            self._count("memory_hits", response)
+            return response
+
+        response = await async_functions.get_llm_cache_entry(key)
+        if response:
+            self.memory.set(key, response)
+            self._count("db_hits", response)
+            return response
+
+        self._count("misses")
+        return None
+
+    async def aset(self, key: str, model: str, response: dict):
+        self.memory.set(key, response)
+        await async_functions.set_llm_cache_entry(key, model, response, self.ttl)
+
+    async def purge_expired(self) -> int:
+        deleted = await async_functions.delete_expired_llm_cache_entries()
+        if deleted:
+            logger.info(f"Deleted {deleted} expired llm cache entries")
+        return deleted
+
+    async def purge_periodically(self):
+        """
+        Purges the expired entries of the table right away and then every purge_interval seconds, until it is cancelled
+        """
+        while True:
+            await self.purge_expired()
+            await asyncio.sleep(self.purge_interval)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["db_hits"]) / lookups if lookups else 0.0
+        stats["memory_entries"] = len(self.memory)
+        return stats
+
+
+llm_cache = LLMResponseCache(
+    max_size=settings.LLM_CACHE_SIZE,
+    ttl=settings.LLM_CACHE_TTL_SECONDS,
+    enabled=settings.LLM_CACHE_ENABLED,
+    purge_interval=settings.LLM_CACHE_PURGE_SECONDS,
+)
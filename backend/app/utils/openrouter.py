@@ -1,20 +1,164 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from collections import OrderedDict, Counter
+from contextlib import contextmanager, asynccontextmanager
+import hashlib
+import threading
+import time
+import httpx
+import loguru
 import requests
+from app.settings import settings
 from app.utils.agents import get_agent
+from app.utils.llm_cache import llm_cache, make_cache_key
+from app.utils.singleflight import SingleFlight
 
-def make_llm_request(key: str, system_prompt: str, user_prompt: str, model: str = "mistralai/devstral-small:free"):
-    client = OpenAI(
-        base_url="https://openrouter.ai/api/v1",
-        api_key=key,
+try:
+    import h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = loguru.logger
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+SAMPLING_PARAMS = ("temperature", "top_p", "top_k", "max_tokens", "seed", "frequency_penalty", "presence_penalty", "repetition_penalty", "stop")
+
+
+class OpenRouterClientPool:
+    """
+    Keeps one OpenAI client per API key so that consecutive requests of the same user reuse
+    already established (keep-alive, HTTP/2 if h2 is installed) connections instead of doing TLS setup on every call.
+
+    Sync and async clients are pooled separately. Both pools are capped by max_clients, the least recently used client
+    is evicted when the cap is reached, and clients that were idle for more than idle_seconds are evicted on the next lookup.
+    Clients are borrowed with client() and async_client(), an evicted client is closed once the last call using it is done
+    """
+
+    def __init__(self, base_url: str = OPENROUTER_BASE_URL, max_clients: int = 128, idle_seconds: int = 600, max_connections: int = 32):
+        self.base_url = base_url
+        self.max_clients = max_clients
+        self.idle_seconds = idle_seconds
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=idle_seconds,
+        )
+
+        self._clients = OrderedDict()
+        self._async_clients = OrderedDict()
+        # calls using each client, and the evicted clients that are still used
+        self._users = Counter()
+        self._retired = set()
+        self._lock = threading.Lock()
+
+    def _evict(self, clients: OrderedDict) -> list:
+        """
+        Removes the clients over the cap or idle for too long. Returns the ones nobody uses, the others are closed on release
+        """
+        now = time.monotonic()
+        evicted = []
+        while clients:
+            key, (client, last_used) = next(iter(clients.items()))
+            if len(clients) <= self.max_clients and now - last_used < self.idle_seconds:
+                break
+            del clients[key]
+            if self._users[client]:
+                self._retired.add(client)
+            else:
+                evicted.append(client)
+        return evicted
+
+    def _acquire(self, clients: OrderedDict, key: str, create) -> tuple:
+        with self._lock:
+            entry = clients.pop(key, None)
+            client = entry[0] if entry else create(key)
+            clients[key] = (client, time.monotonic())
+            self._users[client] += 1
+            return client, self._evict(clients)
+
+    def _release(self, client) -> bool:
+        """
+        Ends a call using the client. True if the client was evicted meanwhile and has to be closed now
+        """
+        with self._lock:
+            self._users[client] -= 1
+            if self._users[client]:
+                return False
+            del self._users[client]
+            if client in self._retired:
+                self._retired.discard(client)
+                return True
+            return False
+
+    def _create_client(self, key: str) -> OpenAI:
+        return OpenAI(
+            base_url=self.base_url,
+            api_key=key,
+            http_client=httpx.Client(http2=HTTP2_AVAILABLE, limits=self.limits),
+        )
+
+    def _create_async_client(self, key: str) -> AsyncOpenAI:
+        return AsyncOpenAI(
+            base_url=self.base_url,
+            api_key=key,
+            http_client=httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=self.limits),
         )
-    completion = client.chat.completions.create(
-    #   extra_headers={
-    #     "HTTP-Referer": "<YOUR_SITE_URL>", # Optional. Site URL for rankings on openrouter.ai.
-    #     "X-Title": "<YOUR_SITE_NAME>", # Optional. Site title for rankings on openrouter.ai.
-    #   },
-    extra_body={},
-    model=model,
-    messages=[
+
+    @contextmanager
+    def client(self, key: str):
+        client, evicted = self._acquire(self._clients, key, self._create_client)
+        for old_client in evicted:
+            old_client.close()
+        try:
+            yield client
+        finally:
+            if self._release(client):
+                client.close()
+
+    @asynccontextmanager
+    async def async_client(self, key: str):
+        """
+        Async clients are bound to the event loop they were first used in, so this must only be used in the server loop
+        """
+        client, evicted = self._acquire(self._async_clients, key, self._create_async_client)
+        for old_client in evicted:
+            await old_client.close()
+        try:
+            yield client
+        finally:
+            if self._release(client):
+                await client.close()
+
+    async def aclose(self):
+        with self._lock:
+            clients = [client for client, _ in self._clients.values()]
+            async_clients = [client for client, _ in self._async_clients.values()]
+            async_clients += [client for client in self._retired if isinstance(client, AsyncOpenAI)]
+            clients += [client for client in self._retired if not isinstance(client, AsyncOpenAI)]
+            self._clients.clear()
+            self._async_clients.clear()
+            self._retired.clear()
+
+        for client in clients:
+            client.close()
+        for client in async_clients:
+            await client.close()
+        logger.info(f"Closed {len(clients) + len(async_clients)} OpenRouter clients")
+
+
+client_pool = OpenRouterClientPool(
+    max_clients=settings.OPENROUTER_MAX_CLIENTS,
+    idle_seconds=settings.OPENROUTER_CLIENT_IDLE_SECONDS,
+    max_connections=settings.OPENROUTER_MAX_CONNECTIONS,
+)
+
+
+llm_flights = SingleFlight()
+
+
+def build_messages(system_prompt: str, user_prompt: str) -> list:
+    return [
         {
         "role": "system",
         "content": system_prompt
@@ -24,8 +168,169 @@ def make_llm_request(key: str, system_prompt: str, user_prompt: str, model: str
         "content": user_prompt
         }
     ]
-    )
-    return completion.choices[0].message.content
+
+
+def completion_to_dict(completion, latency_ms: float) -> dict:
+    usage = completion.usage
+    return {
+        "content": completion.choices[0].message.content,
+        "usage": {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens,
+        } if usage else {},
+        # OpenRouter reports the price of the request when usage accounting is enabled
+        "cost": getattr(usage, "cost", None) if usage else None,
+        "latency_ms": latency_ms,
+    }
+
+
+def make_llm_completion(key: str, system_prompt: str, user_prompt: str, model: str = "mistralai/devstral-small:free", use_cache: bool = True, **params) -> dict:
+    """
+    Returns the content of the completion together with its usage, cost and latency.
+    Sampling params (temperature, seed, ...) are sent as is and are part of the cache key.
+    Pass use_cache=False for requests that are expected to give a different answer every time
+    """
+    messages = build_messages(system_prompt, user_prompt)
+
+    cache_key = None
+    if use_cache and llm_cache.enabled:
+        cache_key = make_cache_key(model, messages, params)
+        cached = llm_cache.get(cache_key)
+        if cached:
+            return {**cached, "cached": True}
+    else:
+        llm_cache.count_bypass()
+
+    with client_pool.client(key) as client:
+        started = time.perf_counter()
+        completion = client.chat.completions.create(
+        #   extra_headers={
+        #     "HTTP-Referer": "<YOUR_SITE_URL>", # Optional. Site URL for rankings on openrouter.ai.
+        #     "X-Title": "<YOUR_SITE_NAME>", # Optional. Site title for rankings on openrouter.ai.
+        #   },
+        extra_body={"usage": {"include": True}, **params},
+        model=model,
+        messages=messages
+        )
+    response = completion_to_dict(completion, (time.perf_counter() - started) * 1000)
+
+    if cache_key and response["content"] is not None:
+        llm_cache.set(cache_key, model, response)
+    return {**response, "cached": False}
+
+
+async def _fetch_completion_async(key: str, model: str, messages: list, params: dict, cache_key: str = None) -> dict:
+    async with client_pool.async_client(key) as client:
+        started = time.perf_counter()
+        completion = await client.chat.completions.create(
+        extra_body={"usage": {"include": True}, **params},
+        model=model,
+        messages=messages
+        )
+    response = completion_to_dict(completion, (time.perf_counter() - started) * 1000)
+
+    if cache_key and llm_cache.enabled and response["content"] is not None:
+        await llm_cache.aset(cache_key, model, response)
+    return response
+
+
+async def make_llm_completion_async(key: str, system_prompt: str, user_prompt: str, model: str = "mistralai/devstral-small:free", use_cache: bool = True, **params) -> dict:
+    """
+    Async version of make_llm_completion. Identical cacheable requests with the same API key that are in flight at the same time
+    are coalesced into one upstream call
+    """
+    messages = build_messages(system_prompt, user_prompt)
+
+    if not use_cache:
+        llm_cache.count_bypass()
+        return {**await _fetch_completion_async(key, model, messages, params), "cached": False}
+
+    cache_key = make_cache_key(model, messages, params)
+    if llm_cache.enabled:
+        cached = await llm_cache.aget(cache_key)
+        if cached:
+            return {**cached, "cached": True}
+
+    # only callers with the same key share a flight: the call is billed to that key and its errors (401, 402, 429) are its own.
+    # The cached response is shared once it succeeded
+    flight_key = f"{hashlib.sha256((key or '').encode()).hexdigest()}:{cache_key}"
+    response = await llm_flights.do(flight_key, _fetch_completion_async, key, model, messages, params, cache_key)
+    return {**response, "cached": False}
+
+
+async def stream_llm_completion(key: str, system_prompt: str, user_prompt: str, model: str = "mistralai/devstral-small:free", use_cache: bool = True, **params):
+    """
+    Relays the completion as it is generated. Yields ("token", text) for every delta and ("done", info) at the end,
+    where info holds the usage, cost and latency of the request.
+
+    The upstream stream is closed in finally, so closing or cancelling the generator (e.g. when the client disconnects)
+    stops the generation. A fully received completion is cached like a regular one
+    """
+    messages = build_messages(system_prompt, user_prompt)
+
+    cache_key = None
+    if use_cache and llm_cache.enabled:
+        cache_key = make_cache_key(model, messages, params)
+        cached = await llm_cache.aget(cache_key)
+        if cached:
+            yield "token", cached["content"]
+            yield "done", {"usage": cached["usage"], "cost": cached["cost"], "latency_ms": cached["latency_ms"], "cached": True}
+            return
+    elif not use_cache:
+        llm_cache.count_bypass()
+
+    started = time.perf_counter()
+    first_token_ms = None
+    content = []
+    usage = None
+
+    async with client_pool.async_client(key) as client:
+        stream = await client.chat.completions.create(
+        extra_body={"usage": {"include": True}, **params},
+        model=model,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True}
+        )
+        try:
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token_ms is None:
+                        first_token_ms = (time.perf_counter() - started) * 1000
+                    content.append(delta)
+                    yield "token", delta
+        finally:
+            await stream.close()
+
+    response = {
+        "content": "".join(content),
+        "usage": {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens,
+        } if usage else {},
+        "cost": getattr(usage, "cost", None) if usage else None,
+        "latency_ms": (time.perf_counter() - started) * 1000,
+    }
+    if cache_key:
+        await llm_cache.aset(cache_key, model, response)
+
+    yield "done", {"usage": response["usage"], "cost": response["cost"], "latency_ms": response["latency_ms"], "first_token_ms": first_token_ms, "cached": False}
+
+
+def make_llm_request(key: str, system_prompt: str, user_prompt: str, model: str = "mistralai/devstral-small:free", use_cache: bool = True, **params):
+    return make_llm_completion(key, system_prompt, user_prompt, model, use_cache=use_cache, **params)["content"]
+
+
+async def make_llm_request_async(key: str, system_prompt: str, user_prompt: str, model: str = "mistralai/devstral-small:free", use_cache: bool = True, **params):
+    completion = await make_llm_completion_async(key, system_prompt, user_prompt, model, use_cache=use_cache, **params)
+    return completion["content"]
 
 
 def openrouter_model_search(query: str):
@@ -0,0 +1,80 @@
+import asyncio
+from collections import Counter
+import loguru
+from app.settings import settings
+from app.db.async_functions import flush_run_results
+
+logger = loguru.logger
+
+
+class RunWriteError(Exception):
+    """
+    Results of a run couldn't be written, not even by the retries
+    """
+
+
+class RunProgressWriter:
+    """
+    Write-behind buffer for results of running testsets. Results of all runs are collected in memory and written
+    together with the progress counters in one transaction every max_batch results or flush_interval_ms milliseconds,
+    whatever comes first. The runner flushes explicitly when a run is finished, the app flushes on shutdown.
+
+    A batch that fails is retried max_attempts times with a growing delay. If it still can't be written, its results
+    are counted as lost per run, and the runner fails the runs that lost results (lost_results)
+    """
+
+    def __init__(self, max_batch: int = 50, flush_interval_ms: int = 250, max_attempts: int = 3, retry_delay_ms: int = 100):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay_ms / 1000
+
+        self._pending = []
+        self._lost = Counter()
+        self._lock = asyncio.Lock()
+        self._timer = None
+
+    async def add(self, **result):
+        self._pending.append(result)
+        if len(self._pending) >= self.max_batch:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            for attempt in range(self.max_attempts):
+                if attempt:
+                    await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+                if await flush_run_results(batch):
+                    logger.debug(f"Flushed {len(batch)} run results")
+                    return
+            lost = Counter(result["run_id"] for result in batch)
+            self._lost.update(lost)
+            logger.error(f"Lost {len(batch)} run results of runs {sorted(lost)}, flush failed {self.max_attempts} times")
+
+    def lost_results(self, run_id: int) -> int:
+        """
+        Number of results of the run that couldn't be written, forgotten once asked for
+        """
+        return self._lost.pop(run_id, 0)
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+
+run_writer = RunProgressWriter(
+    max_batch=settings.RUN_WRITER_BATCH_SIZE,
+    flush_interval_ms=settings.RUN_WRITER_FLUSH_MS,
+)
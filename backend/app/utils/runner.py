@@ -0,0 +1,178 @@
+import asyncio
+import loguru
+import traceback
+from datetime import datetime
+from app.settings import settings
+from app.db.async_functions import update_run, log_action, stream_test_cases
+from app.utils.openrouter import make_llm_completion_async
+from app.utils.events import run_events
+from app.utils.run_writer import run_writer, RunWriteError
+
+logger = loguru.logger
+
+
+class TestsetRunner:
+    """
+    Executes testsets on the event loop instead of a thread per run.
+
+    A run reads the cases of its testset page by page and hands them to as many workers as it may run tests in parallel,
+    so its memory doesn't grow with the size of the testset. Every test has to acquire two semaphores before calling the model:
+    the one of the user that started the run and the global one. They are always acquired in this order,
+    so runs can't deadlock each other
+    """
+
+    def __init__(self, global_concurrency: int, user_concurrency: int, run_concurrency: int):
+        self.global_limit = asyncio.Semaphore(global_concurrency)
+        self.user_concurrency = user_concurrency
+        self.run_concurrency = run_concurrency
+
+        self._user_limits = {}
+        self._user_runs = {}
+        self._tasks = set()
+
+    def _acquire_user_limit(self, email: str) -> asyncio.Semaphore:
+        if email not in self._user_limits:
+            self._user_limits[email] = asyncio.Semaphore(self.user_concurrency)
+            self._user_runs[email] = 0
+        self._user_runs[email] += 1
+        return self._user_limits[email]
+
+    def _release_user_limit(self, email: str):
+        self._user_runs[email] -= 1
+        if self._user_runs[email] == 0:
+            del self._user_runs[email]
+            del self._user_limits[email]
+
+    async def _run_test(self, run_id, index, test, system_prompt, model, api_key, user_limit, progress):
+        async with user_limit, self.global_limit:
+            logger.debug(f"Running test {index} of run {run_id}")
+            await run_events.publish(run_id, "test_started", {"index": index})
+            try:
+                completion = await make_llm_completion_async(api_key, system_prompt, test["prompt"], model)
+                result = completion["content"]
+                error = None
+            except Exception as e:
+                logger.error(f"Error running test {index} of run {run_id}: {traceback.format_exc()}")
+                completion = {}
+                result = f"Error: {e}"
+                error = str(e)
+        success = error is None
+        usage = completion.get("usage") or {}
+
+        await run_writer.add(
+            run_id=run_id,
+            test_index=index,
+            output=completion.get("content"),
+            error=error,
+            latency_ms=completion.get("latency_ms"),
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+            cost=completion.get("cost"),
+            cached=completion.get("cached", False),
+            test_id=test.get("id"),
+        )
+
+        progress["finished"] += 1
+        if not completion.get("cached"):
+            progress["cost"] += completion.get("cost") or 0.0
+        await run_events.publish(run_id, "test_finished", {"index": index, "result": result, "success": success, "current_test": progress["finished"]})
+        return success
+
+    async def _produce(self, testset_id: int, queue: asyncio.Queue, workers: int) -> int:
+        """
+        Queues the cases of the testset and returns how many. A failed read raises, which fails the run
+        """
+        index = 0
+        async for page in stream_test_cases(testset_id, page_size=settings.TESTSET_PAGE_SIZE):
+            for test in page:
+                await queue.put((index, test))
+                index += 1
+        for _ in range(workers):
+            await queue.put(None)
+        return index
+
+    async def _work(self, queue: asyncio.Queue, outcomes: list, run_id, system_prompt, model, api_key, user_limit, progress):
+        while (item := await queue.get()) is not None:
+            index, test = item
+            outcomes.append(await self._run_test(run_id, index, test, system_prompt, model, api_key, user_limit, progress))
+
+    async def run(self, run_id: int, email: str, project_id: int, testset_id: int, number_of_tests: int, system_prompt: str, model: str, api_key: str, concurrency: int = None):
+        """
+        Runs all tests of the testset and writes the progress into the Run row. Results are stored under the position
+        of the test in the testset, so the order is kept no matter in which order the tests finish
+        """
+        user_limit = self._acquire_user_limit(email)
+        progress = {"finished": 0, "cost": 0.0}
+        status = "Error"
+        try:
+            workers = max(1, min(concurrency or self.run_concurrency, self.run_concurrency))
+            await update_run(run_id, status="In Progress")
+            await run_events.publish(run_id, "run_started", {"run_id": run_id, "status": "In Progress", "number_of_tests": number_of_tests})
+
+            # a page waits in the queue while the workers run the previous one
+            queue = asyncio.Queue(maxsize=settings.TESTSET_PAGE_SIZE)
+            outcomes = []
+            async with asyncio.TaskGroup() as group:
+                producer = group.create_task(self._produce(testset_id, queue, workers))
+                for _ in range(workers):
+                    group.create_task(self._work(queue, outcomes, run_id, system_prompt, model, api_key, user_limit, progress))
+            if producer.result() != number_of_tests:
+                raise RuntimeError(f"Run {run_id} queued {producer.result()} of {number_of_tests} tests")
+
+            await run_writer.flush()
+            lost = run_writer.lost_results(run_id)
+            if lost:
+                raise RunWriteError(f"{lost} results of run {run_id} couldn't be written")
+            await update_run(run_id, status="Finished", finished_at=datetime.utcnow(), cost=progress["cost"], success=all(outcomes))
+            status = "Finished"
+            if all(outcomes):
+                await log_action(project_id, f"Finished running testset model {model}", "success")
+            else:
+                await log_action(project_id, f"Finished running testset model {model} with {outcomes.count(False)} failed tests", "error")
+        except asyncio.CancelledError:
+            # the server shuts down (see shutdown), the run is closed before the task ends
+            logger.warning(f"Run {run_id} with model {model} was cancelled")
+            await self._fail(run_id, project_id, f"Cancelled running testset model {model}")
+            raise
+        except Exception:
+            logger.error(f"Error running testset with model {model}: {traceback.format_exc()}")
+            await self._fail(run_id, project_id, f"Error running testset model {model}")
+        finally:
+            self._release_user_limit(email)
+            await run_events.publish(run_id, "run_finished", {"status": status, "current_test": progress["finished"]}, final=True)
+
+    async def _fail(self, run_id: int, project_id: int, action: str):
+        await run_writer.flush()
+        run_writer.lost_results(run_id)
+        await update_run(run_id, status="Error", finished_at=datetime.utcnow(), success=False)
+        await log_action(project_id, action, "error")
+
+    async def shutdown(self):
+        """
+        Cancels the runs in progress and waits until each of them marked its run as Error, so no run stays "In Progress".
+        Has to be awaited before run_writer is closed
+        """
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if tasks:
+            logger.info(f"Cancelled {len(tasks)} runs in progress")
+
+    def start(self, run_id: int, email: str, *args, **kwargs) -> asyncio.Task:
+        """
+        Schedules the run in the background. The task is referenced until it finishes so it is not garbage collected.
+        The event log of the run is opened right away, so clients can subscribe as soon as the run id is returned
+        """
+        run_events.open(run_id, email)
+        task = asyncio.create_task(self.run(run_id, email, *args, **kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+
+testset_runner = TestsetRunner(
+    global_concurrency=settings.TESTSET_GLOBAL_CONCURRENCY,
+    user_concurrency=settings.TESTSET_USER_CONCURRENCY,
+    run_concurrency=settings.TESTSET_RUN_CONCURRENCY,
+)
@@ -0,0 +1,50 @@
+import asyncio
+import loguru
+
+logger = loguru.logger
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller starts the coroutine,
+    everyone who comes while it is in flight waits on the same task and gets the same result or exception.
+
+    A waiter that is cancelled only stops waiting. The shared task is cancelled when its last waiter is gone
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    def _forget(self, key, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key, fn, *args, **kwargs):
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn(*args, **kwargs)))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            self.coalesced += 1
+            logger.debug(f"Joining in-flight call {key}")
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                logger.debug(f"All waiters of {key} are gone, cancelling the call")
+                self._forget(key, call)
+                call.task.cancel()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
@@ -0,0 +1,21 @@
+import json
+
+
+def format_sse(event: str, data, event_id=None) -> str:
+    """
+    Serializes one Server-Sent Event. Data is sent as JSON so that newlines in model output don't break the framing
+    """
+    message = ""
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    message += f"event: {event}\n"
+    message += f"data: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+    return message
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    # disables response buffering in nginx
+    "X-Accel-Buffering": "no",
+}
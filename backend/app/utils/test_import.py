@@ -0,0 +1,170 @@
+"""
+Incremental parsers of testset uploads. The body is decoded chunk by chunk and parsed record by record, so an import
+holds the current chunk and record only, never the whole file. Every parser yields (line, case, error): the line
+the record starts on, the case for case_row of app.db.functions and an error message for records that can't be parsed.
+
+- csv: a header with a prompt column, the other columns go into meta
+- jsonl: one prompt string or {"prompt": ..., "meta": {...}} per line, other keys go into meta
+- text: one prompt per line
+"""
+import codecs
+import csv
+import json
+from typing import AsyncIterator, Optional, Tuple
+
+IMPORT_FORMATS = ("csv", "jsonl", "text")
+CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/csv": "csv",
+    "application/x-ndjson": "jsonl",
+    "application/jsonl": "jsonl",
+    "application/x-jsonlines": "jsonl",
+    "text/plain": "text",
+}
+
+# a body without line breaks is rejected instead of being buffered whole
+MAX_LINE_LENGTH = 10_000_000
+
+Record = Tuple[int, object, Optional[str]]
+
+
+def import_format(requested: Optional[str], content_type: Optional[str]) -> Optional[str]:
+    """
+    Format of an upload: the requested one, otherwise the one of its content type. None if neither is known
+    """
+    if requested:
+        return requested if requested in IMPORT_FORMATS else None
+    return CONTENT_TYPES.get((content_type or "").split(";")[0].strip().lower())
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # lines end with "\n" only, "\r" and the other breaks of str.splitlines() may be part of a CSV field or a JSON string.
+    # Only the new chunk is searched for line breaks, the start of a line that spans many chunks is kept as a list of parts
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending, pending_length = [], 0
+    async for chunk in chunks:
+        try:
+            text = decoder.decode(chunk)
+        except UnicodeDecodeError:
+            raise ValueError("The file is not valid UTF-8") from None
+        lines = text.split("\n")
+        if len(lines) > 1:
+            pending.append(lines[0])
+            lines[0] = "".join(pending)
+            pending, pending_length = [], 0
+            for line in lines[:-1]:
+                yield line + "\n"
+        if lines[-1]:
+            pending.append(lines[-1])
+            pending_length += len(lines[-1])
+        if pending_length > MAX_LINE_LENGTH:
+            raise ValueError(f"A line is longer than {MAX_LINE_LENGTH} characters")
+    try:
+        pending.append(decoder.decode(b"", final=True))
+    except UnicodeDecodeError:
+        raise ValueError("The file is not valid UTF-8") from None
+    rest = "".join(pending)
+    if rest:
+        yield rest
+
+
+async def parse_text(chunks: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    line_number = 0
+    async for line in _lines(chunks):
+        line_number += 1
+        prompt = line.strip()
+        if prompt:
+            yield line_number, prompt, None
+
+
+def _json_case(value):
+    if not isinstance(value, dict):
+        return value
+    extra = {key: item for key, item in value.items() if key not in ("prompt", "meta", "id")}
+    meta = value.get("meta")
+    if not extra or (meta is not None and not isinstance(meta, dict)):
+        return value
+    return {"prompt": value.get("prompt"), "meta": {**extra, **(meta or {})}}
+
+
+async def parse_jsonl(chunks: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    line_number = 0
+    async for line in _lines(chunks):
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError as e:
+            yield line_number, None, f"Invalid JSON: {e}"
+            continue
+        yield line_number, _json_case(value), None
+
+
+def _ends_quoted(line: str, quoted: bool) -> bool:
+    """
+    Whether a quoted field is still open at the end of the line, given whether one was open at its start. Like the csv
+    module, only a quote at the start of a field opens a quoted field; quotes later in an unquoted field are literal
+    """
+    if not quoted and '"' not in line:
+        return False
+    index, field_start = 0, not quoted
+    while index < len(line):
+        if quoted:
+            end = line.find('"', index)
+            if end == -1:
+                return True
+            if line.startswith('"', end + 1):
+                index = end + 2
+                continue
+            quoted, index = False, end + 1
+        elif field_start and line.startswith('"', index):
+            quoted, field_start, index = True, False, index + 1
+        else:
+            comma = line.find(",", index)
+            if comma == -1:
+                return False
+            index, field_start = comma + 1, True
+    return quoted
+
+
+async def parse_csv(chunks: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    header = None
+    record, quoted, start, line_number = "", False, 0, 0
+    async for line in _lines(chunks):
+        line_number += 1
+        if not record:
+            start = line_number
+        record += line
+        # a quoted field may hold line breaks, the record then goes on in the next line
+        quoted = _ends_quoted(line, quoted)
+        if quoted:
+            if len(record) > MAX_LINE_LENGTH:
+                raise ValueError(f"The record on line {start} is longer than {MAX_LINE_LENGTH} characters")
+            continue
+        text, record = record, ""
+        if not text.strip():
+            continue
+        try:
+            fields = next(csv.reader([text]))
+        except csv.Error as e:
+            yield start, None, f"Invalid CSV: {e}"
+            continue
+
+        if header is None:
+            header = [name.strip().lower() for name in fields]
+            if "prompt" not in header:
+                raise ValueError("The CSV header needs a prompt column")
+            prompt_index = header.index("prompt")
+            continue
+        if len(fields) != len(header):
+            yield start, None, f"Expected {len(header)} fields, got {len(fields)}"
+            continue
+        meta = {name: value for index, (name, value) in enumerate(zip(header, fields)) if index != prompt_index and value != ""}
+        yield start, {"prompt": fields[prompt_index], "meta": meta or None}, None
+
+    if record.strip():
+        yield start, None, "Unterminated quoted field"
+
+
+PARSERS = {"csv": parse_csv, "jsonl": parse_jsonl, "text": parse_text}
@@ -0,0 +1,83 @@
+"""
+Compares requests/sec of the pure ASGI JWTAuthMiddleware against the previous BaseHTTPMiddleware implementation
+on /health (exempt from auth) and on an authenticated endpoint (/llm/cache/stats, which doesn't touch the database).
+The benchmark user is put into user_cache beforehand, so both variants resolve it without a query and only the middleware differs.
+
+Needs the backend environment (frontend/.env.local), since the app modules are imported.
+Usage (from backend/): python -m benchmarks.auth_middleware [number_of_requests] [concurrency]
+"""
+import asyncio
+import sys
+import time
+
+import httpx
+from fastapi import FastAPI, Request
+from starlette.datastructures import Headers
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from app.api.llm import router as llm_router
+from app.db.functions import user_cache
+from app.middleware.auth import JWTAuthMiddleware, authenticate, check_url
+from app.utils.auth import generate_jwt_token
+
+EMAIL = "benchmark@example.com"
+
+
+class LegacyJWTAuthMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        if request.method == "OPTIONS" or check_url(request.url.path):
+            return await call_next(request)
+
+        user, from_cache, error_response = await authenticate(request.url.path, request.headers)
+        if error_response:
+            return error_response
+
+        request.state.email = user["email"]
+        request.state.user = user
+        request.state.user_lookups_saved = 0
+        return await call_next(request)
+
+
+def build_app(middleware) -> FastAPI:
+    app = FastAPI()
+    app.include_router(llm_router)
+
+    @app.get("/health")
+    async def health_check():
+        return {"status": "ok"}
+
+    app.add_middleware(middleware)
+    return app
+
+
+async def requests_per_second(app: FastAPI, path: str, headers: dict, requests: int, concurrency: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def worker(count):
+            for _ in range(count):
+                response = await client.get(path, headers=headers)
+                assert response.status_code == 200, response.text
+
+        await worker(50)
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(requests // concurrency) for _ in range(concurrency)])
+        return (requests // concurrency * concurrency) / (time.perf_counter() - started)
+
+
+async def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    user_cache.ttl = None
+    user_cache.set(EMAIL, {"id": 0, "email": EMAIL, "is_verified": True, "keys": {}})
+    headers = {"Authorization": f"Bearer {generate_jwt_token(EMAIL)}"}
+
+    print(f"{requests} requests, concurrency {concurrency}")
+    for name, path, request_headers in (("/health", "/health", {}), ("authenticated", "/llm/cache/stats", headers)):
+        legacy = await requests_per_second(build_app(LegacyJWTAuthMiddleware), path, request_headers, requests, concurrency)
+        asgi = await requests_per_second(build_app(JWTAuthMiddleware), path, request_headers, requests, concurrency)
+        print(f"{name:>14}: BaseHTTPMiddleware {legacy:8.0f} req/s | pure ASGI {asgi:8.0f} req/s ({asgi / legacy:.2f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
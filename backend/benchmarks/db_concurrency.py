@@ -0,0 +1,109 @@
+"""
+Shows what a slow query does to the latency of other requests on the same worker. For both DB layers a slow request
+(SELECT pg_sleep) is started and, while it runs, a stream of quick requests (a user lookup) is sent to the same app.
+With the sync helpers the slow query blocks the event loop, so every quick request waits for it; with the async helpers they don't.
+The app is served by uvicorn in a thread of its own, a client in the same event loop would be blocked along with it and
+couldn't measure the wait.
+
+Needs the backend environment (frontend/.env.local with a reachable database).
+Usage (from backend/): python -m benchmarks.db_concurrency [slow_query_seconds] [quick_requests] [concurrency]
+"""
+import asyncio
+import socket
+import statistics
+import sys
+import threading
+import time
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from sqlalchemy import text
+
+from app.db import functions, async_functions
+from app.db.session import get_db_session, get_async_db_session
+
+EMAIL = "benchmark@example.com"
+
+
+def build_app(slow_seconds: float) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/sync/slow")
+    async def sync_slow():
+        with get_db_session() as db:
+            db.execute(text("SELECT pg_sleep(:seconds)"), {"seconds": slow_seconds})
+        return {"ok": True}
+
+    @app.get("/sync/quick")
+    async def sync_quick():
+        return {"user": bool(functions.get_user_by_email(EMAIL))}
+
+    @app.get("/async/slow")
+    async def async_slow():
+        async with get_async_db_session() as db:
+            await db.execute(text("SELECT pg_sleep(:seconds)"), {"seconds": slow_seconds})
+        return {"ok": True}
+
+    @app.get("/async/quick")
+    async def async_quick():
+        return {"user": bool(await async_functions.get_user_by_email(EMAIL))}
+
+    return app
+
+
+def serve(app: FastAPI) -> str:
+    """
+    Runs the app on a free local port in a background thread, returns its URL
+    """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+async def measure(client: httpx.AsyncClient, layer: str, quick_requests: int, concurrency: int) -> list:
+    latencies = []
+
+    async def worker(count):
+        for _ in range(count):
+            started = time.perf_counter()
+            await client.get(f"/{layer}/quick")
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    slow = asyncio.create_task(client.get(f"/{layer}/slow"))
+    await asyncio.sleep(0.05)
+    await asyncio.gather(*[worker(quick_requests // concurrency) for _ in range(concurrency)])
+    await slow
+    return latencies
+
+
+def percentile(values: list, q: float) -> float:
+    return statistics.quantiles(values, n=100)[int(q) - 1]
+
+
+async def main():
+    slow_seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    quick_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    url = serve(build_app(slow_seconds))
+    async with httpx.AsyncClient(base_url=url, timeout=None) as client:
+        # warm up both connection pools and the client connections
+        for layer in ("sync", "async"):
+            await asyncio.gather(*[client.get(f"/{layer}/quick") for _ in range(concurrency)])
+
+        print(f"slow query {slow_seconds}s, {quick_requests} quick requests, concurrency {concurrency}")
+        for layer in ("sync", "async"):
+            latencies = await measure(client, layer, quick_requests, concurrency)
+            print(
+                f"{layer:>5}: p50 {percentile(latencies, 50):8.1f} ms | p95 {percentile(latencies, 95):8.1f} ms | "
+                f"p99 {percentile(latencies, 99):8.1f} ms | max {max(latencies):8.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
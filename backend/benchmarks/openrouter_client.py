@@ -0,0 +1,101 @@
+"""
+Measures the per-call overhead of creating a new OpenAI client for every request (the old behaviour of make_llm_request)
+against reusing clients from OpenRouterClientPool. Requests go to a local mock of the chat completions endpoint that answers
+immediately, so the numbers are pure client + connection overhead. The real endpoint is behind TLS, so the difference there is larger.
+
+Needs the backend environment (frontend/.env.local with a reachable database), since the app modules are imported.
+Usage (from backend/): python -m benchmarks.openrouter_client [number_of_calls]
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_HOURS", "24")
+
+from openai import OpenAI
+from app.utils.openrouter import OpenRouterClientPool, build_messages
+
+COMPLETION = json.dumps({
+    "id": "bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "bench/model",
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}).encode()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(COMPLETION)))
+        self.end_headers()
+        self.wfile.write(COMPLETION)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_mock_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def bench_fresh_clients(base_url, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        client = OpenAI(base_url=base_url, api_key="bench")
+        client.chat.completions.create(model="bench/model", messages=build_messages("system", "user"))
+    return (time.perf_counter() - started) / calls
+
+
+def bench_pooled_clients(base_url, calls):
+    pool = OpenRouterClientPool(base_url=base_url)
+    started = time.perf_counter()
+    for _ in range(calls):
+        with pool.client("bench") as client:
+            client.chat.completions.create(model="bench/model", messages=build_messages("system", "user"))
+    return (time.perf_counter() - started) / calls
+
+
+async def bench_pooled_async_clients(base_url, calls):
+    pool = OpenRouterClientPool(base_url=base_url)
+    started = time.perf_counter()
+    for _ in range(calls):
+        async with pool.async_client("bench") as client:
+            await client.chat.completions.create(model="bench/model", messages=build_messages("system", "user"))
+    elapsed = (time.perf_counter() - started) / calls
+    await pool.aclose()
+    return elapsed
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    server, base_url = start_mock_server()
+
+    # warm up imports and the mock server
+    bench_pooled_clients(base_url, 5)
+
+    fresh = bench_fresh_clients(base_url, calls)
+    pooled = bench_pooled_clients(base_url, calls)
+    pooled_async = asyncio.run(bench_pooled_async_clients(base_url, calls))
+    server.shutdown()
+
+    print(f"calls per variant:   {calls}")
+    print(f"new client per call: {fresh * 1000:.3f} ms/call")
+    print(f"pooled sync client:  {pooled * 1000:.3f} ms/call ({fresh / pooled:.1f}x)")
+    print(f"pooled async client: {pooled_async * 1000:.3f} ms/call ({fresh / pooled_async:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compares the prompt change detector of app.utils.diffing with the previous check (character level
+SequenceMatcher.ratio() plus an ndiff that was thrown away) on prompts from 1 KB to 1 MB, for three kinds of saves:
+one inserted word, a changed word on every 50th line, and a rewrite of the whole prompt.
+
+The previous check is only run up to --legacy-max bytes (default 10 KB), above that it takes too long
+(about a minute for a single 100 KB save).
+Usage (from backend/): python -m benchmarks.prompt_change [--legacy-max BYTES]
+"""
+import random
+import sys
+import time
+from difflib import SequenceMatcher, ndiff
+
+from app.utils.diffing import check_prompt_change
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+WORDS = "you are a helpful assistant answer the question briefly and never make up facts always cite the sources".split()
+
+
+def make_text(size: int, rng: random.Random) -> str:
+    lines, length = [], 0
+    while length < size:
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14))) + "\n"
+        lines.append(line)
+        length += len(line)
+    return "".join(lines)
+
+
+def make_saves(text: str, rng: random.Random) -> dict:
+    middle = len(text) // 2
+    lines = text.splitlines(keepends=True)
+    scattered = [line.replace(" ", " changed ", 1) if index % 50 == 0 else line for index, line in enumerate(lines)]
+    return {
+        "one word": text[:middle] + "important " + text[middle:],
+        "every 50th line": "".join(scattered),
+        "rewrite": make_text(len(text), rng),
+    }
+
+
+def legacy_check(new_text: str, old_text: str):
+    ratio = SequenceMatcher(None, new_text, old_text).ratio()
+    if ratio < 0.92:
+        "\n".join(ndiff(old_text.splitlines(), new_text.splitlines()))
+        return True, ratio
+    return False, ratio
+
+
+def timed(function, *args) -> tuple:
+    started = time.perf_counter()
+    result = function(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main():
+    legacy_max = int(sys.argv[sys.argv.index("--legacy-max") + 1]) if "--legacy-max" in sys.argv else 10_000
+    rng = random.Random(42)
+
+    print(f"{'size':>9} | {'save':<16} | {'previous':>22} | {'new':>22}")
+    for size in SIZES:
+        text = make_text(size, rng)
+        for name, saved in make_saves(text, rng).items():
+            (significant, similarity), elapsed = timed(check_prompt_change, saved, text)
+            new = f"{elapsed:9.2f} ms {similarity:.3f} {'Y' if significant else 'N'}"
+            if size <= legacy_max:
+                (significant, ratio), elapsed = timed(legacy_check, saved, text)
+                previous = f"{elapsed:9.2f} ms {ratio:.3f} {'Y' if significant else 'N'}"
+            else:
+                previous = "skipped"
+            print(f"{size:>9} | {name:<16} | {previous:>22} | {new:>22}")
+    print("columns: time, similarity, significant change (Y/N)")
+
+
+if __name__ == "__main__":
+    main()
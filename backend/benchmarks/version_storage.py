@@ -0,0 +1,89 @@
+"""
+Storage ratio and text rebuild latency of the delta storage of prompt versions (app.db.version_storage), in memory.
+For prompts of 2 KB to 200 KB a history of autosaves is stored the way _add_version stores it; two kinds of saves:
+a word typed at a random place, and a line inserted or replaced.
+
+stored / full compares the bytes of the snapshot texts and the deltas with the bytes of every text stored in full.
+The deepest version of a chain is rebuilt cold (empty cache, PROMPT_SNAPSHOT_INTERVAL - 1 deltas applied) and warm (cached).
+Usage (from backend/): python -m benchmarks.version_storage [versions]
+"""
+import random
+import sys
+import time
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.db.models import PromptVersion
+from app.db.version_storage import store_text, cache_text, rebuild_texts, text_cache
+from app.settings import settings
+
+SIZES = [2_000, 20_000, 200_000]
+WORDS = "you are a helpful assistant answer the question briefly and never make up facts always cite the sources".split()
+
+
+def make_text(size: int, rng: random.Random) -> str:
+    lines, length = [], 0
+    while length < size:
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14))) + "\n"
+        lines.append(line)
+        length += len(line)
+    return "".join(lines)
+
+
+def type_word(text: str, rng: random.Random) -> str:
+    position = rng.randrange(len(text))
+    return text[:position] + rng.choice(WORDS) + " " + text[position:]
+
+
+def edit_line(text: str, rng: random.Random) -> str:
+    lines = text.splitlines(keepends=True)
+    index = rng.randrange(len(lines))
+    line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14))) + "\n"
+    lines[index:index + rng.randint(0, 1)] = [line]
+    return "".join(lines)
+
+
+def build_history(text: str, versions: int, save, rng: random.Random) -> list:
+    rows, base = [], None
+    for version_id in range(1, versions + 1):
+        row = PromptVersion(id=version_id, prompt_id=1, version_number=version_id)
+        store_text(row, text, base)
+        cache_text(row, text)
+        rows.append(row)
+        base, text = row, save(text, rng)
+    return rows
+
+
+def main():
+    versions = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rng = random.Random(42)
+
+    print(f"snapshot every {settings.PROMPT_SNAPSHOT_INTERVAL} versions, {versions} versions per prompt")
+    print(f"{'size':>7} | {'save':<10} | {'full':>10} | {'stored':>10} | {'ratio':>6} | {'cold':>10} | {'warm':>9}")
+    for size in SIZES:
+        for name, save in (("word", type_word), ("line", edit_line)):
+            rows = build_history(make_text(size, rng), versions, save, rng)
+            full = sum(len(row.prompt_text.encode()) for row in rows)
+            stored = sum(len(row.delta) if row.delta is not None else len(row.prompt_text.encode()) for row in rows)
+
+            deepest = max(rows, key=lambda row: row.delta_depth)
+            chain = [row for row in rows if row.id == deepest.snapshot_id or row.snapshot_id == deepest.snapshot_id]
+            expected = deepest.prompt_text
+            for row in chain:
+                if row.delta is not None:
+                    set_committed_value(row, "prompt_text", None)
+            text_cache.clear()
+
+            started = time.perf_counter()
+            rebuild_texts(chain)
+            cold = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            rebuild_texts([deepest])
+            warm = (time.perf_counter() - started) * 1000
+            assert deepest.prompt_text == expected
+
+            print(f"{size:>7} | {name:<10} | {full:>10} | {stored:>10} | {stored / full:>6.3f} | {cold:>7.2f} ms | {warm:>6.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+import importlib.util
+import os
+
+# app.settings needs these, the units under test don't use them
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_HOURS", "24")
+
+# the tests don't connect to a database, but app.db.session creates its engines on import
+for name, value in {"DB_USER": "test", "DB_PASSWORD": "test", "DB_HOST": "localhost", "DB_PORT": "5432", "DB_NAME": "test"}.items():
+    os.environ.setdefault(name, value)
+
+from app.settings import settings
+
+if importlib.util.find_spec("psycopg") is None:
+    # SQLAlchemy 2.1 maps postgresql:// to psycopg 3, earlier versions to psycopg2
+    settings.DATABASE_URL = settings.DATABASE_URL.replace("postgresql://", "postgresql+psycopg2://", 1)
@@ -0,0 +1,125 @@
+import random
+from difflib import SequenceMatcher
+
+import pytest
+
+from app.utils import diffing
+from app.utils.diffing import check_prompt_change, text_similarity
+
+
+def words(count: int, seed: int = 0) -> str:
+    generator = random.Random(seed)
+    return " ".join(generator.choice(["alpha", "beta", "gamma", "delta", "epsilon"]) for _ in range(count))
+
+
+@pytest.mark.parametrize("a, b", [
+    ("You are a helpful assistant.", "You are a helpful assistant!"),
+    ("Answer in English.", "Always answer in French, briefly."),
+    ("abc", "xyz"),
+    ("line one\nline two\n", "line one\nline 2\nline three\n"),
+])
+def test_similarity_of_small_texts_matches_difflib(a, b):
+    assert text_similarity(a, b) == pytest.approx(SequenceMatcher(None, a, b, autojunk=False).ratio())
+
+
+def test_equal_texts_are_similar_without_any_comparison():
+    assert text_similarity("same", "same") == 1.0
+
+
+def test_length_bound_is_returned_below_the_threshold():
+    # the shorter text can match at most 10 of the 110 characters on both sides
+    assert text_similarity("a" * 10, "b" * 100, threshold=0.9) == pytest.approx(20 / 110)
+
+
+def test_similarity_with_threshold_is_an_upper_bound():
+    a, b = words(400, seed=1), words(400, seed=2)
+    exact = text_similarity(a, b)
+    assert text_similarity(a, b, threshold=0.99) >= exact
+
+
+def test_similarity_of_large_texts_with_a_small_edit():
+    base = "\n".join(f"Rule {index}: {words(12, seed=index)}" for index in range(2000))
+    edited = base.replace("Rule 1000:", "Rule one thousand:")
+    similarity = text_similarity(base, edited)
+    assert 0.99 < similarity < 1
+
+
+def test_similarity_over_the_budget_falls_back_to_the_lines_bound(monkeypatch):
+    monkeypatch.setattr(diffing, "PAIRS_BUDGET", 4)
+    a = "one\ntwo\nthree\nfour\nA"
+    b = "four\nthree\ntwo\none\nB"
+    # the same four lines in another order: the multiset bound counts them all (19 of 20 characters), difflib doesn't
+    assert text_similarity(a, b) == 0.95
+    assert SequenceMatcher(None, a, b, autojunk=False).ratio() < 0.95
+
+
+def test_prompt_change_against_the_threshold():
+    old = "You are a helpful assistant. Answer the question of the user in a few sentences."
+    assert check_prompt_change(old + " ", old) == (False, pytest.approx(text_similarity(old + " ", old)))
+    significant, similarity = check_prompt_change("Translate the text to French.", old)
+    assert significant and similarity < diffing.SIGNIFICANT_CHANGE_THRESHOLD
+
+
+def test_empty_texts_are_always_a_significant_change():
+    assert check_prompt_change("", "prompt") == (True, 0.0)
+    assert check_prompt_change("prompt", "") == (True, 0.0)
+
+
+def sides(diff: dict) -> tuple:
+    """
+    The old and the new text a diff was made from
+    """
+    changes = diff["changes"]
+    old = "".join(change["text"] for change in changes if change["op"] != "insert")
+    new = "".join(change["text"] for change in changes if change["op"] != "delete")
+    return old, new
+
+
+@pytest.mark.parametrize("granularity", diffing.DIFF_GRANULARITIES)
+def test_diff_reconstructs_both_texts(granularity):
+    generator = random.Random(3)
+    for _ in range(200):
+        old = words(generator.randint(0, 30), seed=generator.random()).replace("gamma ", "gamma\n")
+        new = words(generator.randint(0, 30), seed=generator.random()).replace("beta ", "beta\n")
+        diff = diffing.diff_texts(old, new, granularity)
+        assert diff["granularity"] == granularity
+        assert sides(diff) == (old, new)
+
+
+def test_line_diff_keeps_whole_lines():
+    diff = diffing.diff_texts("first\nsecond line\nthird\n", "first\nsecond row\nthird\n")
+    assert diff["changes"] == [
+        {"op": "equal", "text": "first\n"},
+        {"op": "delete", "text": "second line\n"},
+        {"op": "insert", "text": "second row\n"},
+        {"op": "equal", "text": "third\n"},
+    ]
+
+
+def test_word_diff_keeps_whole_words():
+    diff = diffing.diff_texts("Answer in English please", "Answer in French please", "word")
+    assert diff["changes"] == [
+        {"op": "equal", "text": "Answer in "},
+        {"op": "delete", "text": "English "},
+        {"op": "insert", "text": "French "},
+        {"op": "equal", "text": "please"},
+    ]
+
+
+def test_word_diff_over_the_budget_falls_back_to_lines(monkeypatch):
+    monkeypatch.setattr(diffing, "PAIRS_BUDGET", 10)
+    old, new = "a b c d e\nsame\n", "a c b e d\nsame\n"
+    diff = diffing.diff_texts(old, new, "word")
+    assert diff["granularity"] == "line"
+    assert sides(diff) == (old, new)
+
+
+def test_line_diff_over_the_budget_replaces_the_middle(monkeypatch):
+    monkeypatch.setattr(diffing, "PAIRS_BUDGET", 1)
+    old, new = "head\none\ntwo\ntail\n", "head\ntwo\none\ntail\n"
+    assert diffing.diff_texts(old, new)["changes"] == [
+        {"op": "equal", "text": "head\n"},
+        {"op": "delete", "text": "one\ntwo\n"},
+        {"op": "insert", "text": "two\none\n"},
+        {"op": "equal", "text": "tail\n"},
+    ]
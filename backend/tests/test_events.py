@@ -0,0 +1,89 @@
+import asyncio
+
+from app.utils.events import RunEventBus
+
+
+async def publish(bus: RunEventBus, run_id: int, count: int, start: int = 0):
+    for index in range(start, start + count):
+        await bus.publish(run_id, "test_finished", {"index": index})
+
+
+async def read(bus: RunEventBus, run_id: int, offset: int, count: int) -> list:
+    events = []
+    async for item in bus.subscribe(run_id, offset, heartbeat=0.05):
+        events.append(item)
+        if len(events) == count:
+            break
+    return events
+
+
+def test_subscriber_resumes_from_its_offset():
+    bus = RunEventBus()
+
+    async def scenario():
+        bus.open(1, "a@b.c")
+        await publish(bus, 1, 5)
+        return await read(bus, 1, 3, 2)
+
+    assert asyncio.run(scenario()) == [(3, "test_finished", {"index": 3}), (4, "test_finished", {"index": 4})]
+
+
+def test_subscriber_follows_the_run_until_it_finishes():
+    bus = RunEventBus()
+
+    async def scenario():
+        bus.open(1, "a@b.c")
+        await publish(bus, 1, 2)
+
+        async def follow():
+            return [item async for item in bus.subscribe(1, 1, heartbeat=0.05)]
+
+        follower = asyncio.ensure_future(follow())
+        await asyncio.sleep(0.01)
+        await publish(bus, 1, 1, start=2)
+        await bus.publish(1, "run_finished", {"status": "Finished"}, final=True)
+        return await follower
+
+    assert [(offset, event) for offset, event, _ in asyncio.run(scenario())] == [
+        (1, "test_finished"), (2, "test_finished"), (3, "run_finished"),
+    ]
+
+
+def test_heartbeat_without_events():
+    bus = RunEventBus()
+
+    async def scenario():
+        bus.open(1, "a@b.c")
+        return await read(bus, 1, 0, 1)
+
+    assert asyncio.run(scenario()) == [None]
+
+
+def test_subscriber_behind_the_kept_events_gets_a_resync():
+    bus = RunEventBus(max_events=3)
+
+    async def scenario():
+        bus.open(1, "a@b.c")
+        await publish(bus, 1, 10)
+        return await read(bus, 1, 2, 4)
+
+    assert asyncio.run(scenario()) == [
+        (6, "resync", {"missed": 5}),
+        (7, "test_finished", {"index": 7}),
+        (8, "test_finished", {"index": 8}),
+        (9, "test_finished", {"index": 9}),
+    ]
+    assert len(bus.get(1).events) == 3
+
+
+def test_log_of_a_finished_run_is_dropped_after_the_retention():
+    bus = RunEventBus(retention_seconds=0.01)
+
+    async def scenario():
+        bus.open(1, "a@b.c")
+        await bus.publish(1, "run_finished", {}, final=True)
+        kept = bus.get(1) is not None
+        await asyncio.sleep(0.03)
+        return kept, bus.get(1)
+
+    assert asyncio.run(scenario()) == (True, None)
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from app.db import async_functions
+from app.utils import openrouter
+from app.utils.llm_cache import LLMResponseCache, make_cache_key
+
+RESPONSE = {"content": "answer", "usage": {"total_tokens": 30}, "cost": 0.25, "latency_ms": 800.0}
+
+
+@pytest.fixture
+def table(monkeypatch):
+    """
+    The llm_cache table as a dict
+    """
+    rows = {}
+
+    async def get_entry(key, db=None):
+        return rows.get(key, False)
+
+    async def set_entry(key, model, response, ttl_seconds, db=None):
+        rows[key] = response
+        return True
+
+    monkeypatch.setattr(async_functions, "get_llm_cache_entry", get_entry)
+    monkeypatch.setattr(async_functions, "set_llm_cache_entry", set_entry)
+    return rows
+
+
+def test_cache_key_covers_model_messages_and_params():
+    messages = [{"role": "user", "content": "hi"}]
+    key = make_cache_key("model", messages, {"temperature": 0, "seed": 1})
+    assert key == make_cache_key("model", messages, {"seed": 1, "temperature": 0})
+    assert key != make_cache_key("other", messages, {"temperature": 0, "seed": 1})
+    assert key != make_cache_key("model", messages, {"temperature": 1, "seed": 1})
+    assert key != make_cache_key("model", [{"role": "user", "content": "hi!"}], {"temperature": 0, "seed": 1})
+
+
+def test_lookups_go_through_memory_then_table(table):
+    cache = LLMResponseCache(max_size=10, ttl=60)
+
+    async def scenario():
+        assert await cache.aget("key") is None
+        table["key"] = RESPONSE
+        assert await cache.aget("key") == RESPONSE
+        del table["key"]
+        # kept in memory by the previous hit
+        assert await cache.aget("key") == RESPONSE
+
+    asyncio.run(scenario())
+    stats = cache.get_stats()
+    assert (stats["misses"], stats["db_hits"], stats["memory_hits"]) == (1, 1, 1)
+    assert stats["saved_tokens"] == 60 and stats["saved_cost"] == 0.5
+    assert stats["hit_rate"] == 2 / 3
+
+
+def test_memory_tier_is_bounded(table):
+    cache = LLMResponseCache(max_size=2, ttl=60)
+
+    async def scenario():
+        for key in ("a", "b", "c"):
+            await cache.aset(key, "model", RESPONSE)
+
+    asyncio.run(scenario())
+    assert len(cache.memory) == 2 and "a" not in cache.memory
+    assert set(table) == {"a", "b", "c"}
+
+
+def test_cached_completion_is_streamed_without_upstream_call(table, monkeypatch):
+    monkeypatch.setattr(openrouter, "llm_cache", LLMResponseCache(max_size=10, ttl=60))
+    table[make_cache_key("model", openrouter.build_messages("system", "user"), {})] = RESPONSE
+
+    class NoClients:
+        def async_client(self, key):
+            raise AssertionError("the cached completion must not be requested")
+
+    monkeypatch.setattr(openrouter, "client_pool", NoClients())
+
+    async def scenario():
+        return [event async for event in openrouter.stream_llm_completion("key", "system", "user", "model")]
+
+    assert asyncio.run(scenario()) == [
+        ("token", "answer"),
+        ("done", {"usage": {"total_tokens": 30}, "cost": 0.25, "latency_ms": 800.0, "cached": True}),
+    ]
+
+
+def test_identical_requests_are_coalesced_per_api_key(monkeypatch):
+    monkeypatch.setattr(openrouter, "llm_cache", LLMResponseCache(max_size=10, ttl=60, enabled=False))
+    calls = []
+
+    async def fetch(key, model, messages, params, cache_key=None):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return dict(RESPONSE)
+
+    monkeypatch.setattr(openrouter, "_fetch_completion_async", fetch)
+
+    async def scenario():
+        return await asyncio.gather(*(
+            openrouter.make_llm_completion_async(key, "system", "user", "model") for key in ("a", "a", "b", "b", "a")
+        ))
+
+    responses = asyncio.run(scenario())
+    assert sorted(calls) == ["a", "b"]
+    assert all(response["content"] == "answer" and response["cached"] is False for response in responses)
@@ -0,0 +1,43 @@
+import asyncio
+
+from app.utils.openrouter import OpenRouterClientPool
+
+
+def is_closed(client) -> bool:
+    return client._client.is_closed
+
+
+def test_clients_are_reused_per_key():
+    pool = OpenRouterClientPool()
+    with pool.client("a") as first, pool.client("a") as second, pool.client("b") as other:
+        assert first is second
+        assert other is not first
+
+
+def test_evicted_client_is_closed_after_its_last_call():
+    pool = OpenRouterClientPool(max_clients=1)
+
+    async def scenario():
+        async with pool.async_client("a") as a:
+            async with pool.async_client("b") as b:
+                # a is evicted by b but still in use
+                assert not is_closed(a)
+            assert not is_closed(a) and not is_closed(b)
+        assert is_closed(a)
+        async with pool.async_client("c"):
+            assert is_closed(b)
+        await pool.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_aclose_closes_evicted_clients_still_in_use():
+    pool = OpenRouterClientPool(max_clients=1)
+
+    async def scenario():
+        async with pool.async_client("a") as a:
+            async with pool.async_client("b") as b:
+                await pool.aclose()
+                assert is_closed(a) and is_closed(b)
+
+    asyncio.run(scenario())
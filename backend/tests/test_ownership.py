@@ -0,0 +1,100 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from app.api import deps
+from app.db import async_functions
+from app.db.functions import ownership_cache
+
+
+class ProjectSession:
+    """
+    Session that finds one project and records what is deleted
+    """
+
+    def __init__(self, project):
+        self.project = project
+        self.deleted = []
+
+    @asynccontextmanager
+    async def begin_nested(self):
+        yield
+
+    async def scalar(self, query):
+        return self.project
+
+    async def delete(self, instance):
+        self.deleted.append(instance)
+        self.project = None
+
+    async def flush(self):
+        pass
+
+
+@pytest.fixture
+def owners(monkeypatch):
+    """
+    (kind, id) -> (user id, project id) of the objects that exist, lookups are counted in owners.lookups
+    """
+    class Owners(dict):
+        lookups = []
+
+    owners = Owners()
+
+    async def get_object_owner(kind, object_id, db=None):
+        owners.lookups.append((kind, object_id))
+        return owners.get((kind, object_id))
+
+    monkeypatch.setattr(deps, "get_object_owner", get_object_owner)
+    ownership_cache.clear()
+    yield owners
+    ownership_cache.clear()
+
+
+def request(user_id: int):
+    return SimpleNamespace(state=SimpleNamespace(user={"id": user_id}, user_lookups_saved=0))
+
+
+def test_granted_access_is_cached(owners):
+    owners[("project", 1)] = (7, 1)
+
+    async def scenario():
+        await deps.check_access(request(7), None, "project", 1)
+        await deps.check_access(request(7), None, "project", 1)
+
+    asyncio.run(scenario())
+    assert owners.lookups == [("project", 1)]
+
+
+def test_denied_access_is_not_cached(owners):
+    owners[("project", 1)] = (7, 1)
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(HTTPException) as error:
+                await deps.check_access(request(8), None, "project", 1)
+            assert error.value.status_code == 401
+
+    asyncio.run(scenario())
+    assert len(owners.lookups) == 2
+
+
+def test_deleting_a_project_clears_the_cached_accesses(owners):
+    owners[("project", 1)] = (7, 1)
+    owners[("prompt", 5)] = (7, 1)
+
+    async def scenario():
+        await deps.check_access(request(7), None, "project", 1)
+        await deps.check_access(request(7), None, "prompt", 5, project_id=1)
+        assert await async_functions.delete_project(1, db=ProjectSession(SimpleNamespace(id=1)))
+        del owners[("project", 1)], owners[("prompt", 5)]
+        for kind, object_id in (("project", 1), ("prompt", 5)):
+            with pytest.raises(HTTPException) as error:
+                await deps.check_access(request(7), None, kind, object_id)
+            assert error.value.status_code == 404
+
+    asyncio.run(scenario())
+    assert len(ownership_cache) == 0
@@ -0,0 +1,79 @@
+import base64
+
+import pytest
+from fastapi import HTTPException, Response
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from app.api.deps import page_args, paged
+from app.db.models import Prompt
+from app.db.pagination import MAX_PAGE_SIZE, Page, decode_cursor, encode_cursor, keyset, to_page
+
+
+def sql(query) -> str:
+    return " ".join(str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})).split())
+
+
+@pytest.mark.parametrize("key", [0, 1, 41, 2 ** 62, -3])
+def test_cursor_round_trip(key):
+    cursor = encode_cursor(key)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == key
+
+
+@pytest.mark.parametrize("cursor", [
+    "!!",
+    "not a cursor",
+    base64.urlsafe_b64encode(b"{").decode(),
+    encode_cursor("41"),
+    encode_cursor(1.5),
+    encode_cursor(True),
+    encode_cursor(None),
+    encode_cursor([1]),
+])
+def test_invalid_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor)
+
+
+def test_keyset_continues_after_the_cursor():
+    query = keyset(select(Prompt).where(Prompt.project_id == 1), Prompt.id, encode_cursor(41), 20)
+    assert "prompts.project_id = 1 AND prompts.id > 41 ORDER BY prompts.id ASC LIMIT 21" in sql(query)
+
+
+def test_descending_keyset():
+    query = keyset(select(Prompt), Prompt.id, encode_cursor(41), 20, descending=True)
+    assert "prompts.id < 41 ORDER BY prompts.id DESC LIMIT 21" in sql(query)
+
+
+def test_keyset_without_limit_returns_the_whole_list():
+    assert "LIMIT" not in sql(keyset(select(Prompt), Prompt.id))
+
+
+def test_to_page_has_a_cursor_only_when_rows_follow():
+    rows = [{"id": index} for index in range(1, 12)]
+    page = to_page(rows, 10, lambda row: row["id"])
+    assert page == rows[:10] and decode_cursor(page.next_cursor) == 10
+    last = to_page(rows[:10], 10, lambda row: row["id"])
+    assert last == rows[:10] and last.next_cursor is None
+    assert to_page(rows, None, lambda row: row["id"]).next_cursor is None
+
+
+def test_page_args_rejects_an_invalid_cursor_with_400():
+    with pytest.raises(HTTPException) as error:
+        page_args("!!", 10)
+    assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("limit, kept", [(0, 1), (-5, 1), (50, 50), (MAX_PAGE_SIZE + 1, MAX_PAGE_SIZE)])
+def test_page_args_keeps_the_limit_in_range(limit, kept):
+    assert page_args(encode_cursor(3), limit) == {"cursor": encode_cursor(3), "limit": kept}
+
+
+def test_next_cursor_is_sent_as_a_header():
+    response = Response()
+    assert paged(response, Page([1, 2], "abc")) == [1, 2]
+    assert response.headers["X-Next-Cursor"] == "abc"
+    last = Response()
+    paged(last, Page([3]))
+    assert "X-Next-Cursor" not in last.headers
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from app.utils import run_writer
+from app.utils.run_writer import RunProgressWriter
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    """
+    Batches passed to flush_run_results. batches.failures is how many of the next attempts fail
+    """
+    class Batches(list):
+        failures = 0
+
+    written = Batches()
+
+    async def flush_run_results(results, db=None):
+        if written.failures:
+            written.failures -= 1
+            return False
+        written.append([result["test_index"] for result in results])
+        return True
+
+    monkeypatch.setattr(run_writer, "flush_run_results", flush_run_results)
+    return written
+
+
+def add(writer: RunProgressWriter, run_id: int, indexes):
+    async def scenario():
+        for index in indexes:
+            await writer.add(run_id=run_id, test_index=index)
+
+    return scenario()
+
+
+def test_results_are_written_in_batches(batches):
+    writer = RunProgressWriter(max_batch=3, flush_interval_ms=10_000)
+
+    async def scenario():
+        await add(writer, 1, range(7))
+        written_before_flush = list(batches)
+        await writer.flush()
+        return written_before_flush
+
+    assert asyncio.run(scenario()) == [[0, 1, 2], [3, 4, 5]]
+    assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_pending_results_are_written_after_the_interval(batches):
+    writer = RunProgressWriter(max_batch=50, flush_interval_ms=10)
+
+    async def scenario():
+        await add(writer, 1, range(2))
+        assert batches == []
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+    assert batches == [[0, 1]]
+
+
+def test_failed_batch_is_retried(batches):
+    writer = RunProgressWriter(max_batch=50, max_attempts=3, retry_delay_ms=1)
+    batches.failures = 2
+
+    async def scenario():
+        await add(writer, 1, range(2))
+        await writer.close()
+
+    asyncio.run(scenario())
+    assert batches == [[0, 1]]
+    assert writer.lost_results(1) == 0
+
+
+def test_batch_that_keeps_failing_is_counted_as_lost_per_run(batches):
+    writer = RunProgressWriter(max_batch=50, max_attempts=2, retry_delay_ms=1)
+    batches.failures = 2
+
+    async def scenario():
+        await add(writer, 1, range(3))
+        await add(writer, 2, range(2))
+        await writer.close()
+
+    asyncio.run(scenario())
+    assert batches == []
+    assert (writer.lost_results(1), writer.lost_results(2)) == (3, 2)
+    # the count is forgotten once asked for
+    assert writer.lost_results(1) == 0
@@ -0,0 +1,146 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.utils import runner
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.results = {}
+
+    async def add(self, **result):
+        self.results[result["test_index"]] = result
+
+    async def flush(self):
+        pass
+
+    def lost_results(self, run_id: int) -> int:
+        return 0
+
+
+@pytest.fixture
+def env(monkeypatch):
+    """
+    The runner without a database: the cases come from env.cases, the model answers with the upper case prompt
+    after env.delay(index) seconds and the writes of the run are recorded
+    """
+    env = SimpleNamespace(cases=[], delay=lambda index: 0, in_flight=0, max_in_flight=0, updates=[], actions=[], writer=RecordingWriter())
+
+    async def stream_test_cases(testset_id, page_size=100):
+        for start in range(0, len(env.cases), page_size):
+            yield [{"id": index, "prompt": prompt} for index, prompt in enumerate(env.cases[start:start + page_size], start)]
+
+    async def complete(key, system_prompt, prompt, model):
+        env.in_flight += 1
+        env.max_in_flight = max(env.max_in_flight, env.in_flight)
+        try:
+            await asyncio.sleep(env.delay(int(prompt.split()[-1])))
+        finally:
+            env.in_flight -= 1
+        return {"content": prompt.upper(), "usage": {}, "cost": 0.5}
+
+    async def update_run(run_id, **values):
+        env.updates.append((run_id, values))
+
+    async def log_action(project_id, name, type):
+        env.actions.append(type)
+
+    monkeypatch.setattr(runner, "stream_test_cases", stream_test_cases)
+    monkeypatch.setattr(runner, "make_llm_completion_async", complete)
+    monkeypatch.setattr(runner, "update_run", update_run)
+    monkeypatch.setattr(runner, "log_action", log_action)
+    monkeypatch.setattr(runner, "run_writer", env.writer)
+    monkeypatch.setattr(runner.settings, "TESTSET_PAGE_SIZE", 10)
+    return env
+
+
+def run(testset_runner: runner.TestsetRunner, run_id: int = 1, email: str = "a@b.c", number_of_tests: int = None, concurrency: int = None):
+    return testset_runner.run(run_id, email, 1, 1, number_of_tests, "system", "model", "key", concurrency=concurrency)
+
+
+def final_update(env, run_id: int = 1) -> dict:
+    return [values for update_id, values in env.updates if update_id == run_id][-1]
+
+
+def test_results_are_stored_under_the_position_of_their_case(env):
+    env.cases = [f"case {index}" for index in range(25)]
+    # later cases finish first
+    env.delay = lambda index: (25 - index) / 1000
+
+    asyncio.run(run(runner.TestsetRunner(64, 16, 8), number_of_tests=25))
+
+    assert {index: result["output"] for index, result in env.writer.results.items()} == {index: f"CASE {index}" for index in range(25)}
+    assert [result["test_id"] for _, result in sorted(env.writer.results.items())] == list(range(25))
+    update = final_update(env)
+    assert update["status"] == "Finished" and update["success"] is True and update["cost"] == 12.5
+    assert env.actions == ["success"]
+
+
+@pytest.mark.parametrize("requested, expected", [(None, 4), (10, 4), (2, 2)])
+def test_run_concurrency_is_capped_by_the_runner(env, requested, expected):
+    env.cases = [f"case {index}" for index in range(20)]
+    env.delay = lambda index: 0.005
+
+    asyncio.run(run(runner.TestsetRunner(64, 16, 4), number_of_tests=20, concurrency=requested))
+
+    assert env.max_in_flight == expected
+    assert len(env.writer.results) == 20
+
+
+def test_runs_of_one_user_share_the_user_limit(env):
+    env.cases = [f"case {index}" for index in range(12)]
+    env.delay = lambda index: 0.005
+    testset_runner = runner.TestsetRunner(64, 3, 8)
+
+    async def both():
+        await asyncio.gather(run(testset_runner, run_id=1, number_of_tests=12), run(testset_runner, run_id=2, number_of_tests=12))
+
+    asyncio.run(both())
+
+    assert env.max_in_flight == 3
+    assert final_update(env, 1)["status"] == final_update(env, 2)["status"] == "Finished"
+    # the semaphore of the user is dropped with its last run
+    assert testset_runner._user_limits == {}
+
+
+def test_failed_page_read_fails_the_run(env, monkeypatch):
+    env.cases = [f"case {index}" for index in range(30)]
+
+    async def broken(testset_id, page_size=100):
+        yield [{"id": 0, "prompt": "case 0"}]
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(runner, "stream_test_cases", broken)
+    asyncio.run(run(runner.TestsetRunner(64, 16, 8), number_of_tests=30))
+
+    update = final_update(env)
+    assert update["status"] == "Error" and update["success"] is False
+    assert env.actions == ["error"]
+
+
+def test_run_fails_when_the_testset_has_fewer_cases(env):
+    env.cases = [f"case {index}" for index in range(5)]
+
+    asyncio.run(run(runner.TestsetRunner(64, 16, 8), number_of_tests=6))
+
+    assert final_update(env)["status"] == "Error"
+
+
+def test_shutdown_marks_runs_in_progress_as_error(env):
+    env.cases = [f"case {index}" for index in range(100)]
+    env.delay = lambda index: 10
+    testset_runner = runner.TestsetRunner(64, 16, 8)
+
+    async def start_and_shut_down():
+        task = testset_runner.start(1, "a@b.c", 1, 1, 100, "system", "model", "key")
+        await asyncio.sleep(0.01)
+        await testset_runner.shutdown()
+        return task
+
+    task = asyncio.run(start_and_shut_down())
+
+    assert task.cancelled()
+    assert final_update(env)["status"] == "Error"
+    assert testset_runner._tasks == set()
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from app.utils.singleflight import SingleFlight
+
+
+def test_concurrent_calls_with_one_key_share_the_call():
+    flights = SingleFlight()
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return f"answer {key}"
+
+    async def scenario():
+        return await asyncio.gather(*(flights.do(key, fetch, key) for key in ("a", "a", "b", "a")))
+
+    assert asyncio.run(scenario()) == ["answer a", "answer a", "answer b", "answer a"]
+    assert sorted(calls) == ["a", "b"]
+    assert flights.coalesced == 2
+    assert flights.in_flight() == 0
+
+
+def test_waiters_share_the_exception():
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream error")
+
+    async def scenario():
+        return await asyncio.gather(flights.do("a", fail), flights.do("a", fail), return_exceptions=True)
+
+    first, second = asyncio.run(scenario())
+    assert isinstance(first, RuntimeError) and first is second
+
+
+def test_a_cancelled_waiter_doesnt_cancel_the_call():
+    flights = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "answer"
+
+    async def scenario():
+        leaving = asyncio.ensure_future(flights.do("a", fetch))
+        staying = asyncio.ensure_future(flights.do("a", fetch))
+        await asyncio.sleep(0.005)
+        leaving.cancel()
+        return await staying, leaving.cancelled()
+
+    assert asyncio.run(scenario()) == ("answer", True)
+
+
+def test_the_call_is_cancelled_with_its_last_waiter():
+    flights = SingleFlight()
+    finished = []
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        finished.append(True)
+
+    async def scenario():
+        waiter = asyncio.ensure_future(flights.do("a", fetch))
+        await asyncio.sleep(0.005)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.sleep(0.03)
+
+    asyncio.run(scenario())
+    assert finished == []
+    assert flights.in_flight() == 0
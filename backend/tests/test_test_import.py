@@ -0,0 +1,36 @@
+import asyncio
+
+from app.utils.test_import import parse_csv
+
+
+def parse(data: bytes, chunk_size: int = 7) -> list:
+    async def chunks():
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    async def records():
+        return [record async for record in parse_csv(chunks())]
+
+    return asyncio.run(records())
+
+
+def test_csv_quote_inside_unquoted_field_is_literal():
+    assert parse(b'prompt,tag\n5" screen,x\nnext,y\nthird,z\n') == [
+        (2, {"prompt": '5" screen', "meta": {"tag": "x"}}, None),
+        (3, {"prompt": "next", "meta": {"tag": "y"}}, None),
+        (4, {"prompt": "third", "meta": {"tag": "z"}}, None),
+    ]
+
+
+def test_csv_quoted_field_spans_lines():
+    assert parse(b'prompt,tag\n"two\nlines, ""quoted""",a\nnext,b\n') == [
+        (2, {"prompt": 'two\nlines, "quoted"', "meta": {"tag": "a"}}, None),
+        (4, {"prompt": "next", "meta": {"tag": "b"}}, None),
+    ]
+
+
+def test_csv_unterminated_quoted_field():
+    assert parse(b'prompt\nfirst\n"open\nrest\n') == [
+        (2, {"prompt": "first", "meta": None}, None),
+        (3, None, "Unterminated quoted field"),
+    ]
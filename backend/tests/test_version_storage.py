@@ -0,0 +1,99 @@
+import random
+
+import pytest
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.db import version_storage
+from app.db.models import PromptVersion
+from app.db.version_storage import apply_delta, detach, encode_delta, rebuild_texts, store_text
+from app.settings import settings
+
+TEXTS = [
+    "You are a helpful assistant.\nAnswer briefly.\nUse English.\n",
+    "You are a helpful assistant.\nAnswer in detail.\nUse English.\n",
+    "You are a helpful assistant.\nAnswer in detail.\nUse English.\nCite your sources.\n",
+    "You are a friendly assistant.\nAnswer in detail.\nCite your sources.\n",
+]
+
+
+@pytest.fixture(autouse=True)
+def delta_storage(monkeypatch):
+    monkeypatch.setattr(settings, "PROMPT_STORAGE_MODE", "delta")
+    monkeypatch.setattr(settings, "PROMPT_SNAPSHOT_INTERVAL", 10)
+    version_storage.text_cache.clear()
+    yield
+    version_storage.text_cache.clear()
+
+
+def save_chain(texts) -> list:
+    """
+    Versions with ids from 1 saved one over the other, like consecutive saves of a prompt
+    """
+    versions = []
+    for number, text in enumerate(texts, start=1):
+        version = PromptVersion(id=number, version_number=number)
+        store_text(version, text, versions[-1] if versions else None)
+        version_storage.cache_text(version, text)
+        versions.append(version)
+    return versions
+
+
+def reload(versions) -> dict:
+    """
+    Texts rebuilt from the storage columns alone, as after loading the rows in a new process
+    """
+    version_storage.text_cache.clear()
+    for version in versions:
+        if version.delta is not None:
+            set_committed_value(version, "prompt_text", None)
+    rebuild_texts(versions)
+    return {version.id: version.prompt_text for version in versions}
+
+
+def test_delta_round_trip():
+    generator = random.Random(5)
+    lines = [f"line {index}\n" for index in range(40)]
+    for _ in range(200):
+        base = "".join(generator.sample(lines, generator.randint(0, 20)))
+        text = "".join(generator.sample(lines, generator.randint(0, 20)))
+        if generator.random() < 0.5:
+            text = base[:generator.randint(0, len(base))] + "edited " + text
+        assert apply_delta(base, encode_delta(base, text)) == text
+
+
+def test_delta_over_the_budget_is_still_exact(monkeypatch):
+    monkeypatch.setattr(version_storage, "PAIRS_BUDGET", 1)
+    base, text = "head\none\ntwo\ntail\n", "head\ntwo\none\ntail\n"
+    assert apply_delta(base, encode_delta(base, text)) == text
+
+
+def test_chain_is_stored_as_deltas_of_one_snapshot():
+    versions = save_chain(TEXTS)
+    assert versions[0].delta is None and versions[0].prompt_text == TEXTS[0]
+    assert [(version.base_version_id, version.snapshot_id, version.delta_depth) for version in versions[1:]] == [
+        (1, 1, 1), (2, 1, 2), (3, 1, 3),
+    ]
+    assert reload(versions) == dict(enumerate(TEXTS, start=1))
+
+
+def test_snapshot_is_stored_again_after_the_interval(monkeypatch):
+    monkeypatch.setattr(settings, "PROMPT_SNAPSHOT_INTERVAL", 3)
+    versions = save_chain(TEXTS)
+    assert [version.delta is None for version in versions] == [True, False, False, True]
+
+
+def test_deleting_a_delta_version_rebases_its_dependents_on_its_base():
+    first, second, third, fourth = save_chain(TEXTS)
+    detach(second, [third], [second, third, fourth], base=first)
+    assert (third.base_version_id, third.snapshot_id, third.delta_depth) == (1, 1, 2)
+    assert reload([first, third, fourth]) == {1: TEXTS[0], 3: TEXTS[2], 4: TEXTS[3]}
+
+
+def test_deleting_a_snapshot_turns_its_dependent_into_the_snapshot():
+    first, second, third, fourth = save_chain(TEXTS)
+    detach(first, [second], [second, third, fourth])
+    assert second.delta is None and second.prompt_text == TEXTS[1] and second.delta_depth == 0
+    assert [(version.base_version_id, version.snapshot_id, version.delta_depth) for version in (third, fourth)] == [
+        (2, 2, 1), (3, 2, 2),
+    ]
+    assert reload([second, third, fourth]) == {2: TEXTS[1], 3: TEXTS[2], 4: TEXTS[3]}
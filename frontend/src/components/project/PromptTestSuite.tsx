@@ -8,7 +8,7 @@ import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@
 import { Progress } from '@/components/ui/progress';
 import { Play, RefreshCw, Copy, Upload, Trash, Check, X as XIcon } from 'lucide-react';
 import { promptsApi, testsetsApi, llmApi } from '@/lib/api';
-import type { TestSet, TestSetTest } from '@/types';
+import type { TestSet } from '@/types';
 
 interface PromptTestSuiteProps {
   projectId: string;
@@ -47,6 +47,7 @@ export function PromptTestSuite({ projectId, promptId }: PromptTestSuiteProps) {
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState<string | null>(null);
   const [testSets, setTestSets] = useState<TestSet[]>([]);
+  const [testCases, setTestCases] = useState<any[]>([]);
   const [selectedTestSetId, setSelectedTestSetId] = useState<number | null>(null);
   const [testSetName, setTestSetName] = useState('');
   const [modelSearch, setModelSearch] = useState('');
@@ -57,7 +58,7 @@ export function PromptTestSuite({ projectId, promptId }: PromptTestSuiteProps) {
   const modelSearchTimeout = useRef<NodeJS.Timeout | null>(null);
   const [runStatus, setRunStatus] = useState<any>(null);
   const [polling, setPolling] = useState(false);
-  const pollingRef = useRef<NodeJS.Timeout | null>(null);
+  const watchRef = useRef<AbortController | null>(null);
 
   useEffect(() => {
     async function fetchPrompts() {
@@ -102,8 +103,19 @@ export function PromptTestSuite({ projectId, promptId }: PromptTestSuiteProps) {
     fetchTestSets();
   }, [projectId]);
 
-  const selectedTestSet = testSets.find(ts => ts.id === selectedTestSetId) || null;
-  const testCases = selectedTestSet?.tests || [];
+  // the testset list has no tests, those of the selected testset are loaded on their own
+  const loadTestCases = async () => {
+    if (!selectedTestSetId) {
+      setTestCases([]);
+      return;
+    }
+    const res = await testsetsApi.getTests(selectedTestSetId);
+    setTestCases(res.data);
+  };
+
+  useEffect(() => {
+    loadTestCases().catch(() => setError('Failed to load tests.'));
+  }, [selectedTestSetId]);
 
   const handleSelectPrompt = async (id: string) => {
     setSelectedPromptId(id);
@@ -129,27 +141,29 @@ export function PromptTestSuite({ projectId, promptId }: PromptTestSuiteProps) {
     try {
       await testsetsApi.addTest(selectedTestSetId, newInput);
       setNewInput('');
-      const res = await testsetsApi.list(projectId);
-      setTestSets(res.data || []);
+      await loadTestCases();
     } catch (e) {
       setError('Failed to add test.');
     }
   };
 
-  const handleFileUpload = (e: React.ChangeEvent<HTMLInputElement>) => {
+  const handleFileUpload = async (e: React.ChangeEvent<HTMLInputElement>) => {
     const file = e.target.files?.[0];
     if (!file || !selectedTestSetId) return;
-    const reader = new FileReader();
-    reader.onload = async (event) => {
-      const text = event.target?.result as string;
-      const lines = text.split('\n').map(line => line.trim()).filter(Boolean);
-      for (const input of lines) {
-        await testsetsApi.addTest(selectedTestSetId, input);
+    const extension = file.name.split('.').pop()?.toLowerCase();
+    const format = extension === 'csv' ? 'csv' : extension === 'jsonl' || extension === 'ndjson' ? 'jsonl' : 'text';
+    setError(null);
+    try {
+      const res = await testsetsApi.importTests(selectedTestSetId, file, format);
+      if (res.data.failed) {
+        const first = res.data.errors[0];
+        setError(`${res.data.failed} rows were skipped (line ${first.line}: ${first.error}).`);
       }
-      const res = await testsetsApi.list(projectId);
-      setTestSets(res.data || []);
-    };
-    reader.readAsText(file);
+    } catch {
+      setError('Failed to upload tests.');
+    }
+    e.target.value = '';
+    await loadTestCases();
   };
 
   // Model search effect
@@ -173,27 +187,41 @@ export function PromptTestSuite({ projectId, promptId }: PromptTestSuiteProps) {
     // eslint-disable-next-line
   }, [modelSearch]);
 
-  // Polling for run status
-  const pollRunStatus = (promptVersionId: string | number) => {
+  // Follow run progress pushed by the backend
+  const watchRun = (runId: string | number) => {
     setPolling(true);
-    if (pollingRef.current) clearInterval(pollingRef.current);
-    pollingRef.current = setInterval(async () => {
-      try {
-        const res = await testsetsApi.checkRun(promptVersionId);
-        setRunStatus(res.data);
-        if (res.data.status === 'Finished' || res.data.status === 'Error') {
-          setPolling(false);
-          if (pollingRef.current) clearInterval(pollingRef.current);
-        }
-      } catch (e) {
-        // Optionally handle error
+    if (watchRef.current) watchRef.current.abort();
+    const controller = new AbortController();
+    watchRef.current = controller;
+
+    testsetsApi.watchRun(runId, (event, data) => {
+      if (event === 'snapshot') {
+        // also sent when the client fell behind the events the backend keeps, the results seen so far stay
+        setRunStatus((prev: any) => ({ ...data, result: { ...(prev?.result || {}), ...(data?.result || {}) } }));
+      } else if (event === 'run_started') {
+        setRunStatus({ status: data.status, current_test: 0, number_of_tests: data.number_of_tests, result: {} });
+      } else if (event === 'test_finished') {
+        setRunStatus((prev: any) => ({
+          ...prev,
+          current_test: data.current_test,
+          result: { ...(prev?.result || {}), [data.index]: data.result },
+        }));
+      } else if (event === 'run_finished') {
+        setRunStatus((prev: any) => ({ ...prev, status: data.status, current_test: data.current_test }));
       }
-    }, 2000);
+    }, controller.signal)
+      .catch(() => {
+        // Optionally handle error
+      })
+      .finally(() => {
+        setPolling(false);
+        setIsRunning(false);
+      });
   };
 
   useEffect(() => {
     return () => {
-      if (pollingRef.current) clearInterval(pollingRef.current);
+      if (watchRef.current) watchRef.current.abort();
     };
   }, []);
 
@@ -205,17 +233,12 @@ export function PromptTestSuite({ projectId, promptId }: PromptTestSuiteProps) {
     setRunStatus(null);
     setError(null);
     try {
-      // Get latest prompt version id
-      const promptRes = await promptsApi.get(projectId, selectedPromptId);
-      const versions = promptRes.data.versions || [];
-      const latest = versions[versions.length - 1];
-      const promptVersionId = latest?.id;
-      await testsetsApi.run(projectId, {
+      const runRes = await testsetsApi.run(projectId, {
         testset_id: selectedTestSetId,
         prompt_id: selectedPromptId,
         model: selectedModelObj.slug,
       });
-      pollRunStatus(promptVersionId);
+      watchRun(runRes.data.run_id);
     } catch (e) {
       setError('Failed to start test run.');
       setIsRunning(false);
@@ -251,8 +274,7 @@ export function PromptTestSuite({ projectId, promptId }: PromptTestSuiteProps) {
     if (!selectedTestSetId) return;
     try {
       await testsetsApi.deleteTest(selectedTestSetId, testId);
-      const res = await testsetsApi.list(projectId);
-      setTestSets(res.data || []);
+      await loadTestCases();
     } catch (e) {
       setError('Failed to delete test.');
     }
@@ -319,7 +341,7 @@ export function PromptTestSuite({ projectId, promptId }: PromptTestSuiteProps) {
               <Button onClick={addTestCase} disabled={!selectedTestSetId}>Add</Button>
               <label className="inline-flex items-center cursor-pointer">
                 <Upload className="w-4 h-4 mr-1" />
-                <input type="file" accept=".txt" className="hidden" onChange={handleFileUpload} disabled={!selectedTestSetId} />
+                <input type="file" accept=".txt,.csv,.jsonl,.ndjson" className="hidden" onChange={handleFileUpload} disabled={!selectedTestSetId} />
                 <span className="text-xs">Upload</span>
               </label>
             </div>
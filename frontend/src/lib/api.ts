@@ -30,6 +30,19 @@ api.interceptors.response.use(
   }
 );
 
+// Lists are paginated, the X-Next-Cursor header continues a list after its last page
+async function getAllPages(url: string) {
+  const data: any[] = [];
+  let cursor: string | undefined;
+  let response;
+  do {
+    response = await api.get(url, { params: { limit: 1000, cursor } });
+    data.push(...response.data);
+    cursor = response.headers['x-next-cursor'];
+  } while (cursor);
+  return { ...response, data };
+}
+
 export const authApi = {
   login: (email: string, password: string) =>
     api.post('/auth/login', { email, password }),
@@ -49,7 +62,7 @@ export const authApi = {
 };
 
 export const projectsApi = {
-  list: () => api.get('/users/projects'),
+  list: () => getAllPages('/users/projects'),
   create: (data: any) => api.post('/users/projects', data),
   get: (id: string) => api.get(`/users/projects/${id}`),
   update: (id: string, data: any) => api.put(`/users/projects/${id}`, data),
@@ -57,7 +70,7 @@ export const projectsApi = {
 };
 
 export const promptsApi = {
-  list: (projectId: string) => api.get(`/users/projects/${projectId}/prompts`),
+  list: (projectId: string) => getAllPages(`/users/projects/${projectId}/prompts`),
   create: (projectId: string, data: any) => api.post(`/users/projects/${projectId}/prompts`, data),
   get: (projectId: string, promptId: string) => api.get(`/users/projects/${projectId}/prompts/${promptId}`),
   update: (projectId: string, promptId: string, data: any) => api.put(`/users/projects/${projectId}/prompts/${promptId}`, data),
@@ -72,15 +85,61 @@ export const llmApi = {
 };
 
 export const testsetsApi = {
-  list: (projectId: string | number) => api.get(`/tests/testsets/${projectId}`),
+  list: (projectId: string | number) => getAllPages(`/tests/testsets/${projectId}`),
   create: (projectId: string | number, data: { name: string }) => api.post(`/tests/testsets/${projectId}`, data),
+  getTests: (testsetId: string | number) => getAllPages(`/tests/testsets/${testsetId}/tests`),
   addTest: (testsetId: string | number, prompt: string) => api.post(`/tests/testsets/${testsetId}/tests`, { prompt }),
+  importTests: (testsetId: string | number, file: File, format: 'csv' | 'jsonl' | 'text') =>
+    api.post(`/tests/testsets/${testsetId}/tests/import`, file, { params: { format }, headers: { 'Content-Type': 'application/octet-stream' } }),
   deleteTest: (testsetId: string | number, testId: string | number) => api.delete(`/tests/testsets/${testsetId}/tests/${testId}`),
   deleteTestset: (testsetId: string | number) => api.delete(`/tests/testsets/${testsetId}`),
   run: (projectId: string | number, data: { testset_id: number, prompt_id: string, model: string }) => api.post(`/tests/run_testset/${projectId}`, data),
   checkRun: (promptVersionId: string | number) => api.get(`/tests/check_run/${promptVersionId}`),
+  watchRun: (runId: string | number, onEvent: (event: string, data: any, id: number | null) => void, signal?: AbortSignal) =>
+    streamEvents(`/tests/runs/${runId}/events`, onEvent, signal),
 };
 
+// Reads a Server-Sent Events stream with fetch, since EventSource can't send the Authorization header
+export async function streamEvents(
+  path: string,
+  onEvent: (event: string, data: any, id: number | null) => void,
+  signal?: AbortSignal,
+) {
+  const token = localStorage.getItem('token');
+  const response = await fetch(`${process.env.NEXT_PUBLIC_API_URL}${path}`, {
+    headers: token ? { Authorization: `Bearer ${token}` } : {},
+    signal,
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Stream request failed with status ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const message = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = 'message';
+      let data = '';
+      let id: number | null = null;
+      for (const line of message.split('\n')) {
+        if (line.startsWith('event: ')) event = line.slice(7);
+        else if (line.startsWith('data: ')) data += line.slice(6);
+        else if (line.startsWith('id: ')) id = Number(line.slice(4));
+      }
+      if (data) onEvent(event, JSON.parse(data), id);
+    }
+  }
+}
+
 export const actionsApi = {
   list: (projectId: string) => api.get(`/users/actions/${projectId}`),
 };
@@ -87,6 +87,6 @@ export interface TestSet {
   id: number;
   name: string;
   createdAt: string;
-  tests: TestSetTest[];
+  case_count: number;
   projectId: number;
 }
\ No newline at end of file